@@ -10,11 +10,12 @@ LOCAL_STORAGE_PATH = "app/static"
 def create_app():
 
     from flask import Flask
-    from .configs.user_config import BACKEND_VERSION
+    from .configs.user_config import BACKEND_VERSION, EMBEDDING_CACHE_PRUNE_HOURS
     from .configs.conn_config import CELERY_RESULT_BACKEND, CELERY_BROKER_URL
     from .configs.secrets import FLASK_SECRET_KEY, OPENAI_API_KEY, STRIPE_SECRET_KEY
     from flask_cors import CORS
     import os
+    import sys
     import psutil
     import signal
     import stripe
@@ -67,6 +68,10 @@ def create_app():
     from . import db
     db.init_app(app)
 
+    # Tables and columns added since the database was made
+    from .migrations import migrate
+    migrate()
+
     from . import assets
     app.register_blueprint(assets.bp)
 
@@ -130,6 +135,9 @@ def create_app():
     from . import feed
     app.register_blueprint(feed.bp)
 
+    from . import metrics
+    app.register_blueprint(metrics.bp)
+
     socketio = SocketIO()
     socketio.init_app(app, cors_allowed_origins="*", async_mode='gevent')
 
@@ -168,12 +176,24 @@ def create_app():
         except:
             pass
 
+    scheduler = BackgroundScheduler()
+
     if 'ping' not in SETTINGS or SETTINGS['ping']:
         ping_url()  # Ping once on startup before setting up schedule
         # Schedule the ping function
-        scheduler = BackgroundScheduler()
         scheduler.add_job(ping_url, 'interval', hours=1)
-        scheduler.start()
+
+    def prune_embeddings():
+        from .embedding_cache import prune_embedding_cache
+        try:
+            n = prune_embedding_cache(new_conn=True)
+            if n:
+                print(f"Pruned {n} unused embeddings from the embedding cache.")
+        except Exception as e:
+            print(f"Couldn't prune embedding cache: {e}", file=sys.stderr)
+
+    scheduler.add_job(prune_embeddings, 'interval', hours=EMBEDDING_CACHE_PRUNE_HOURS)
+    scheduler.start()
 
     print("Backend create_app() complete.")
 
@@ -0,0 +1,96 @@
+import numpy as np
+
+"""
+
+Approximate nearest neighbour search for large retrievers: an IVF (inverted file) index, in plain NumPy.
+
+The (normalized) embeddings are clustered with spherical k-means; each chunk goes in the list of its nearest centroid.
+At query time, only the chunks in the nprobe lists whose centroids are closest to the query get scored exactly.
+
+The index is stored alongside the chunks in the chunk store as three sections:
+- ivf_centroids: float32 (nlist, dim)
+- ivf_order: int64 (n,) chunk positions, grouped by list
+- ivf_offsets: int64 (nlist+1,) where each list starts in ivf_order
+
+"""
+
+IVF_SECTIONS = ['ivf_centroids', 'ivf_order', 'ivf_offsets']
+
+ASSIGN_BATCH_SIZE = 8192  # rows at a time when assigning chunks to centroids (bounds memory to batch x nlist)
+TRAINING_POINTS_PER_LIST = 64
+
+
+def default_nlist(n):
+    return max(1, int(np.sqrt(n)))
+
+
+def default_nprobe(nlist):
+    return max(1, nlist // 16)
+
+
+def _assign(embeddings, centroids):
+    assignments = np.empty(len(embeddings), dtype=np.int64)
+    for start in range(0, len(embeddings), ASSIGN_BATCH_SIZE):
+        batch = np.asarray(embeddings[start:start+ASSIGN_BATCH_SIZE], dtype=np.float32)
+        assignments[start:start+len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+    return assignments
+
+
+# embeddings should be normalized; can be a memmap, in which case it's read in batches
+# Returns the three arrays in IVF_SECTIONS order
+def build_ivf_index(embeddings, nlist=None, n_iter=10, seed=0):
+    n = len(embeddings)
+    nlist = min(nlist or default_nlist(n), n)
+    rng = np.random.default_rng(seed)
+
+    # Train on a sample
+    n_train = min(n, nlist * TRAINING_POINTS_PER_LIST)
+    sample = np.asarray(embeddings[np.sort(rng.choice(n, size=n_train, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(n_train, size=nlist, replace=False)].copy()
+    for _ in range(n_iter):
+        sample_assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, sample_assignments, sample)
+        counts = np.bincount(sample_assignments, minlength=nlist)
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(n_train, size=int(empty.sum()))]  # re-seed empty lists
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        centroids = sums / norms
+
+    assignments = _assign(embeddings, centroids)
+    order = np.argsort(assignments, kind='stable').astype(np.int64)
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assignments, minlength=nlist))
+    return centroids.astype(np.float32), order, offsets
+
+
+class IVFIndex():
+    def __init__(self, centroids, order, offsets) -> None:
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.nlist = len(centroids)
+
+    # Returns sorted positions of the chunks worth scoring for query_vec
+    def candidates(self, query_vec, nprobe=None):
+        nprobe = min(nprobe or default_nprobe(self.nlist), self.nlist)
+        centroid_scores = self.centroids @ query_vec
+        probes = np.argpartition(-centroid_scores, nprobe-1)[:nprobe]
+        lists = [self.order[self.offsets[c]:self.offsets[c+1]] for c in probes]
+        return np.sort(np.concatenate(lists)) if len(lists) else np.array([], dtype=np.int64)
+
+
+# For tuning ANN_INDEX_MIN_CHUNKS / ANN_NPROBE: the fraction of the exact top k that the index also finds, averaged over queries.
+# embeddings and queries should be normalized.
+def recall_at_k(embeddings, queries, k=10, nlist=None, nprobe=None, index: IVFIndex=None):
+    if index is None:
+        index = IVFIndex(*build_ivf_index(embeddings, nlist=nlist))
+    total = 0
+    for query_vec in queries:
+        exact = set(np.argsort(-(embeddings @ query_vec))[:k].tolist())
+        candidates = index.candidates(query_vec, nprobe=nprobe)
+        scores = np.asarray(embeddings[candidates]) @ query_vec
+        approx = set(candidates[np.argsort(-scores)[:k]].tolist())
+        total += len(exact & approx) / max(len(exact), 1)
+    return total / max(len(queries), 1)
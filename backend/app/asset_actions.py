@@ -1,16 +1,18 @@
-from .exceptions import NoCreateError, UserIsNoneError
+from .exceptions import NoCreateError, UserIsNoneError, JobMismatchError
 from .auth import SynthUser, User
 from .configs.user_config import ALLOW_PUBLIC_UPLOAD
 import json
 from .auth import get_permissioning_string
-from .db import get_db, needs_db, with_lock, needs_special_db, ProxyDB, PooledCursor
+from .db import get_db, needs_db, with_lock, needs_special_db, ProxyDB, PooledCursor, fetch_page_with_total
 from .retriever import Retriever
+from .retriever_cache import RETRIEVER_CACHE
 from .configs.secrets import DB_TYPE
 from .configs.str_constants import CHAT_CONTEXT, SUMMARY_APPLY_JOB, SUMMARY_PAIRWISE_JOB, HAS_EDITED_ASSET_TITLE, HAS_EDITED_ASSET_DESC, PROTECTED_METADATA_KEYS, RETRIEVAL_SOURCE, BOOK_ORDER, RETRIEVAL_SOURCE
-from .jobs import complete_job, job_error_wrapper, start_job
+from .jobs import complete_job, job_error_wrapper, start_job, resume_job, clear_superseded_job_storage, get_job_metadata
 from .configs.user_config import ILLEGAL_SHARE_DOMAINS, MAX_CHAT_RETRIEVER_RESULTS, FRONTEND_URL
 from .prompts.suggest_questions_prompts import get_suggest_questions_system_prompt, get_suggest_questions_prompt, get_suggest_questions_system_prompt_detached
 from .integrations.lm import LM_PROVIDERS, LM, FAST_CHAT_MODEL
+from .lm_governor import run_governed
 from .utils import is_valid_email
 from .prompts.summary_prompts import get_summary_apply_instructions, get_summary_reduce_instructions
 from .worker import task_apply, task_general
@@ -19,6 +21,7 @@ from .reducer import Reducer
 import tempfile
 from .storage_interface import upload_asset_file, delete_resources_from_storage
 import os
+from flask import g, has_request_context
 
 # DO NOT IMPORT ANYTHING FROM templates.py (if needed, do dynamic import)
 
@@ -525,6 +528,7 @@ def add_asset_resource(asset_id, name, from_loc, path, title, db=None):
 @needs_db
 def delete_asset_resources(resources, db: ProxyDB=None):
     if len(resources):
+        RETRIEVER_CACHE.invalidate_resources([x['id'] for x in resources])
         delete_resources_from_storage(resources)
         curr = db.cursor()
         sql = """
@@ -537,6 +541,7 @@ def delete_asset_resources(resources, db: ProxyDB=None):
 @needs_db
 def delete_asset_retrieval_resources(resources, db: ProxyDB=None):
     if len(resources):
+        RETRIEVER_CACHE.invalidate_resources([x['resource_id'] for x in resources])
         delete_resources_from_storage(resources)
         sql = """
             DELETE FROM asset_retrieval_storage
@@ -556,7 +561,7 @@ def replace_asset_resource(asset_id, name, from_loc, path, title, no_commit=Fals
     curr.execute(sql, (asset_id, name))
     results = curr.fetchall()
     if results and len(results):
-        delete_asset_resources(results)
+        delete_asset_resources(results)  # also drops any cached retrievers for the old resources
 
     return add_asset_resource(asset_id, name, from_loc, path, title, no_commit=no_commit, db=db)
 
@@ -618,6 +623,21 @@ def delete_asset(asset_row, db=None):
     curr.execute(sql, (asset_id,))
     results = curr.fetchall()
     delete_asset_retrieval_resources(results)
+
+    # Delete the asset's merged retrieval index, if it has one (see merged_index.py)
+    sql = """
+    SELECT * FROM merged_retrieval_storage
+    WHERE `asset_id` = %s
+    """
+    curr.execute(sql, (asset_id,))
+    results = curr.fetchall()
+    if len(results):
+        delete_resources_from_storage(results)
+        sql = """
+        DELETE FROM merged_retrieval_storage
+        WHERE `asset_id` = %s
+        """
+        curr.execute(sql, (asset_id,))
     
     # NOTE: jobs resources are also attached to asset, so don't need to separately delete
     # However, we do not need to get rid of associated jobs storage
@@ -766,6 +786,57 @@ def get_assets(user: User, asset_ids, token=None, needs_edit_permission=False, d
     return res
 
 
+# Like get_assets, but returns a dict of asset id -> asset row for the ones the user can see (or edit), in one query.
+# Within a request, results are remembered per user and asset, so walks over many assets (e.g., retrieval sources) never check the same one twice.
+# Meant for reads: it won't see permission changes made earlier in the same request after an asset was checked.
+@needs_db
+def get_permitted_assets(user: User, asset_ids, needs_edit_permission=False, db=None):
+    asset_ids = list({int(x) for x in asset_ids})
+    if not len(asset_ids):
+        return {}
+
+    memo = None
+    if has_request_context():
+        if 'asset_permission_memo' not in g:
+            g.asset_permission_memo = {}
+        memo = g.asset_permission_memo
+    user_key = user.user_id if user else None
+
+    permitted = {}
+    to_check = []
+    for asset_id in asset_ids:
+        key = (user_key, needs_edit_permission, asset_id)
+        if memo is not None and key in memo:
+            if memo[key] is not None:
+                permitted[asset_id] = memo[key]
+        else:
+            to_check.append(asset_id)
+
+    if len(to_check):
+        perm_string = get_permissioning_string(user, edit_permission=needs_edit_permission, db=db)
+        asset_id_list = "(" + ",".join([str(x) for x in to_check]) + ")"
+        sql = f"""
+        WITH a AS (
+            SELECT * FROM assets
+            WHERE id IN {asset_id_list}
+        )
+        SELECT DISTINCT a.*
+        FROM a
+        LEFT JOIN asset_permissions ap ON a.id = ap.asset_id OR a.group_id = ap.group_id
+        WHERE {perm_string}
+        """
+        curr = db.cursor()
+        curr.execute(sql)
+        res = curr.fetchall()
+        found = {x['id']: x for x in res}
+        permitted.update(found)
+        if memo is not None:
+            for asset_id in to_check:
+                memo[(user_key, needs_edit_permission, asset_id)] = found.get(asset_id)
+
+    return permitted
+
+
 # Unpermissioned
 # Gets all assets in a group (for removing/adding group ids)
 @needs_db
@@ -788,9 +859,10 @@ def get_retriever_cache_name(retriever_type_name, asset_id):
 
 # Returns None if failed
 # retriever_type_name can be used to give an asset new/multiple retrievers (ex., when you don't need embeddings)
-# Note: force_create and cache were from an era in which retrievers were cached in memory; currently, they are not.
+# Loaded resource retrievers are cached in memory (see retriever_cache.py); no_cache skips the cache.
+# Note: force_create is from an era before that cache, and is unused.
 @needs_db
-def get_or_create_retriever(user: User, asset_row, asset_resources, retriever_type_name="retriever", retriever_options={}, force_create=False, no_cache=False, db=None):
+def get_or_create_retriever(user: User, asset_row, asset_resources, retriever_type_name="retriever", retriever_options={}, force_create=False, no_cache=False, job_id=None, db=None):
     
     retriever_name = get_retriever_cache_name(retriever_type_name, asset_row['id']) 
     # LOCK - using database lock
@@ -811,7 +883,7 @@ def get_or_create_retriever(user: User, asset_row, asset_resources, retriever_ty
             curr.execute("SET GLOBAL TRANSACTION ISOLATION LEVEL READ COMMITTED;")
 
         try:
-            retriever = Retriever(user, asset_resources, **retriever_options)
+            retriever = Retriever(user, asset_resources, no_cache=no_cache, asset_id=asset_row['id'], job_id=job_id, **retriever_options)
         except NoCreateError:  # probably: no_create was signaled, but a creation was necessary. 
             retriever = None
 
@@ -832,7 +904,7 @@ def get_asset_resources(user, asset_row, exclude=[], db=None):
 @needs_db
 def make_retriever(user, asset_row, retriever_type_name="retriever", retriever_options={}, force_create=False, no_cache=False, job_id=None, except_text=None, exclude=[], db=None):
     asset_resources = get_asset_resources(user, asset_row, exclude=exclude)
-    ret = get_or_create_retriever(user, asset_row, asset_resources, retriever_type_name=retriever_type_name, retriever_options=retriever_options, force_create=force_create, no_cache=no_cache, db=db)
+    ret = get_or_create_retriever(user, asset_row, asset_resources, retriever_type_name=retriever_type_name, retriever_options=retriever_options, force_create=force_create, no_cache=no_cache, job_id=job_id, db=db)
     if except_text and ret is None:
         raise Exception(except_text)
     
@@ -848,7 +920,7 @@ def make_retriever_job(user_obj, job_id, *args, **kwargs):
     @job_error_wrapper(job_id)
     def do_job():
         # In a job, don't have access to the cache.
-        ret = make_retriever(user, *args, db=db, **kwargs)
+        ret = make_retriever(user, *args, job_id=job_id, db=db, **kwargs)
 
     do_job()
 
@@ -1040,7 +1112,7 @@ def get_sources(user: User, asset_id, needs_edit_permission=False, ordered=False
     return results
 
 # Returns (results, total) (total = 0 if ignore_total=True)
-# IF YOU NEED TOTAL (get_total=True) PASS exclusive=True TO KEEP TOTAL VALUE FROM GETTING CORRUPTED
+# The total is counted in the same statement (see fetch_page_with_total), so it works on any connection (including a replica)
 @needs_db
 def search_assets(
                 user: User,
@@ -1164,10 +1236,10 @@ def search_assets(
         """
     
     # Factored this out so we could do a join for groups when appropriate.
-    def get_main_search_query(use_calc, ap_join_on, redefine=False, purchased_groups=False):
+    def get_main_search_query(ap_join_on, redefine=False, purchased_groups=False):
         purchased_groups_join = "LEFT JOIN asset_groups ag ON ag.id = a.group_id AND ag.product_id IS NOT NULL" if purchased_groups else ""
         return f"""
-        SELECT {"SQL_CALC_FOUND_ROWS" if use_calc else ""} a.*,
+        SELECT a.*,
             MAX(CASE
                 WHEN ({get_permissioning_string(user, edit_permission=True)})
                 THEN 1
@@ -1185,7 +1257,7 @@ def search_assets(
         """
     
     # Same goes here, though it's a modified query.
-    def get_ra_search_query(use_calc, ap_join_on, redefine=True, purchased_groups=False):
+    def get_ra_search_query(ap_join_on, redefine=True, purchased_groups=False):
         purchased_groups_join = "LEFT JOIN asset_groups ag ON ag.id = a.group_id AND ag.product_id IS NOT NULL" if purchased_groups else ""
         sql = ""
         if redefine:
@@ -1202,7 +1274,7 @@ def search_assets(
             )"""
         
         sql += f"""
-        SELECT {"SQL_CALC_FOUND_ROWS" if use_calc else ""} DISTINCT a.*,
+        SELECT DISTINCT a.*,
             MAX(
             CASE
                 WHEN ({get_permissioning_string(user, edit_permission=True)})
@@ -1261,15 +1333,14 @@ def search_assets(
 
     need_general_groups = groups_only or include_groups or (group_ids and len(group_ids)) or (include_group_ids and len(include_group_ids))
     if include_purchased_groups or need_general_groups:
-        group_sql = correct_sql_fn(not ignore_total, "a.group_id = ap.group_id", purchased_groups=(include_purchased_groups and not need_general_groups))
+        group_sql = correct_sql_fn("a.group_id = ap.group_id", purchased_groups=(include_purchased_groups and not need_general_groups))
 
     if not group_ids or not len(group_ids):
-        regular_sql = correct_sql_fn(not ignore_total and not group_sql, "a.id = ap.asset_id", redefine=(not group_sql))
+        regular_sql = correct_sql_fn("a.id = ap.asset_id", redefine=(not group_sql))
 
     sql = ""  # Will become the actual sql run.
     
     if group_sql and regular_sql:
-        # group sql is first because it has the CALC when appropriate.
         sql = f"""
         {preamble}
         {group_sql}
@@ -1288,20 +1359,19 @@ def search_assets(
         {preamble}
         {regular_sql}"""
 
+    curr = db.cursor()
+    if not ignore_total:
+        return fetch_page_with_total(curr, sql, order_by_clause, limit, offset)
+
     # Now do the ending.
     sql += f"""
     ORDER BY {order_by_clause}
     LIMIT {limit}
     OFFSET {offset}
     """
-    curr = db.cursor()
     curr.execute(sql)
     res = curr.fetchall()  # list of dictionaries
-    total = 0
-    if not ignore_total:  # and this is why we use the exclusive connection ... need to be the only one on it here.
-        curr.execute("SELECT FOUND_ROWS()")
-        total = curr.fetchone()['FOUND_ROWS()']
-    return res, total
+    return res, 0
 
 
 def suggest_questions(user: User, asset_row, context, detached=False, n=3):
@@ -1334,7 +1404,7 @@ def suggest_questions(user: User, asset_row, context, detached=False, n=3):
 
     llm_question = get_suggest_questions_prompt(n, real_q)
 
-    text = lm.run(llm_question, system_prompt=system_prompt, make_json=True)
+    text = run_governed(lm, llm_question, system_prompt=system_prompt, make_json=True)
     total_json = json.loads(text)  # if it throws a value error, it throws a value error!
     questions = total_json['questions']  # if it throws a key error, it throws a key error!
     return questions
@@ -1370,10 +1440,10 @@ def set_book_order(asset_id, order, db=None):
     curr.execute(sql, (BOOK_ORDER, asset_id, my_json))
 
 
-@needs_special_db(consistent_conn=True)
-def start_summary_apply_job(user: User, asset_row, db=None):
-    assert(user)
+SUMMARY_APPLY_COMBINE_CHUNKS = 5  # a resumed job has to use the same value, since stored batch indices depend on it (which its fingerprint checks)
 
+
+def _make_summary_applier(user: User, asset_row, db=None):
     retriever_options = {}
     retriever_type_name = 'retriever'
 
@@ -1382,16 +1452,49 @@ def start_summary_apply_job(user: User, asset_row, db=None):
     if not applier:
         raise Exception("Couldn't make applier in start summary apply job")
 
+    return applier
+
+
+# With refresh_cache, LM responses are made fresh rather than reused from a previous summary of the same text
+@needs_special_db(consistent_conn=True)
+def start_summary_apply_job(user: User, asset_row, refresh_cache=False, db=None):
+    assert(user)
+
+    applier = _make_summary_applier(user, asset_row, db=db)
+
     instructions = get_summary_apply_instructions()
-    meta = json.dumps({'instructions': instructions})
+    meta = {'instructions': instructions, 'fingerprint': applier.apply_fingerprint(instructions, combine_chunks=SUMMARY_APPLY_COMBINE_CHUNKS)}
 
     job_id = start_job(instructions, meta, asset_row['id'], SUMMARY_APPLY_JOB, new_conn=False, user_id=user.user_id, db=db)
+    # Earlier apply jobs that stopped partway won't be resumed now
+    clear_superseded_job_storage(asset_row['id'], SUMMARY_APPLY_JOB, except_job_id=job_id, db=db)
     
-    task_apply.apply_async(args=[pickle.dumps(applier), instructions], kwargs={'job_id': job_id, 'combine_chunks': 5, 'new_conn':True})
+    task_apply.apply_async(args=[pickle.dumps(applier), instructions], kwargs={'job_id': job_id, 'combine_chunks': SUMMARY_APPLY_COMBINE_CHUNKS, 'cache': True, 'refresh_cache': refresh_cache, 'new_conn':True})
 
     return job_id
 
 
+# Restarts an apply job that stopped partway, under the same job id
+# Chunks it already has responses for are skipped (see Retriever.apply), and the rest mostly come from the LM cache if they were made before it stopped
+# Raises JobMismatchError if the asset's chunks (or the batching) aren't what the job started with, e.g. after a re-upload
+# The caller should hold job_runner_lock, so that the job isn't also being run (or resumed) elsewhere
+@needs_special_db(consistent_conn=True)
+def resume_summary_apply_job(user: User, asset_row, job, db=None):
+    assert(user)
+
+    applier = _make_summary_applier(user, asset_row, db=db)
+
+    instructions = job['title']  # start_job gets the instructions as its title
+    fingerprint = get_job_metadata(job).get('fingerprint')
+    if not fingerprint or fingerprint != applier.apply_fingerprint(instructions, combine_chunks=SUMMARY_APPLY_COMBINE_CHUNKS):
+        raise JobMismatchError()
+    resume_job(job['id'], db=db)
+
+    task_apply.apply_async(args=[pickle.dumps(applier), instructions], kwargs={'job_id': job['id'], 'combine_chunks': SUMMARY_APPLY_COMBINE_CHUNKS, 'cache': True, 'new_conn':True})
+
+    return job['id']
+
+
 @needs_special_db(consistent_conn=True)
 def start_summary_reduce_job(user: User, asset_row, apply_job_id, db=None):
     assert(user)
@@ -6,9 +6,10 @@ from flask import (
 )
 import os
 from flask_cors import cross_origin
-from .exceptions import RetrieverEmbeddingsError, UserIsNoneError
+from .exceptions import RetrieverEmbeddingsError, UserIsNoneError, JobMismatchError
 import sys
-from .jobs import get_job, search_for_jobs, start_job, get_job_resource, delete_job
+from .jobs import get_job, search_for_jobs, start_job, get_job_resource, delete_job, can_resume_job, job_runner_lock
+from .locks import acquire_lock, release_lock
 from .configs.str_constants import *
 from .configs.user_config import RETRIEVER_JOB_TIMEOUT
 from .integrations.lm import DEFAULT_CHAT_MODEL, FAST_LONG_CONTEXT_MODEL, FAST_CHAT_MODEL, BALANCED_CHAT_MODEL
@@ -16,6 +17,7 @@ from .db import get_db
 from .template_response import MyResponse
 from .retriever import Chunk, Retriever
 from .integrations.lm import LM_PROVIDERS, LM, get_safe_retrieval_context_length, LMStreamResponse
+from .lm_governor import run_governed, stream_governed
 from .auth import User, token_optional, token_required, get_permissioning_string
 import json
 from .templates.templates import get_template_by_code, TEMPLATES
@@ -27,7 +29,7 @@ from .asset_actions import (
     make_retriever_job, mark_asset_title_as_updated, mark_asset_desc_as_updated, upload_asset,
     get_asset_metadata, get_permissions, save_chat, set_asset_permissions,
     search_assets, propagate_joint_permissions, get_sources, delete_asset,
-    suggest_questions, get_assets, start_summary_apply_job, start_summary_reduce_job,
+    suggest_questions, get_assets, start_summary_apply_job, start_summary_reduce_job, resume_summary_apply_job,
     get_book_order, set_book_order, get_asset_resource, add_resource_from_text
 )
 from .user import get_user_chat_model_code, get_user_templates, get_user_allowed_new_upload, inc_upload_counter
@@ -136,7 +138,7 @@ def manifest(user: User):
                                     group_ids=[group_id] if group_id else [], my_uploads=my_uploads, isolated=isolated,
                                     folders_first=folders_first, include_groups=include_groups, include_group_ids=include_group_ids,
                                     alphabetical=alphabetical, filter_tags_on_groups=filter_tags_on_groups, ignore_total=(not get_total),
-                                    needs_edit_permission=needs_edit_permission, exclude_ids=exclude_ids, exclusive_conn=get_total)
+                                    needs_edit_permission=needs_edit_permission, exclude_ids=exclude_ids, read_only=True)
 
     except UserIsNoneError:
         print("User is none error in /manifest; ignoring.", file=sys.stderr)
@@ -718,7 +720,7 @@ def chat(user: User):
 
         yield get_event({'type': META_EVENT, 'meta': {'sources': sources, 'inline_citations': inline_citations}})
 
-        for stream_response in model.stream(prompt, system_prompt=system_prompt, context=context, temperature=temperature, show_reasoning=True, images=images):
+        for stream_response in stream_governed(model, prompt, system_prompt=system_prompt, context=context, temperature=temperature, show_reasoning=True, images=images):
             stream_response: LMStreamResponse
             yield get_event({'type': TEXT_EVENT, 'text': stream_response.text, 'reasoning': stream_response.reasoning})
 
@@ -732,7 +734,7 @@ def chat(user: User):
                 for_web_retrieval_response = []
         system_prompt = get_web_query_system_prompt(context, for_web_retrieval_response, user_time)
         lm: LM = LM_PROVIDERS[FAST_CHAT_MODEL]
-        search_query: str = lm.run(txt, system_prompt=system_prompt)
+        search_query: str = run_governed(lm, txt, system_prompt=system_prompt)
         search_query = search_query.replace("\"", "")  # Bing API can't do keyword searches, and sometimes ChatGPT wraps its responses in quotes.
         return chat_response(search_query=search_query)
     else:
@@ -1036,12 +1038,7 @@ def get_chunk_(user: User):
     
     if ret:
         ret: Retriever
-
-        for chunk in ret.get_chunks():
-            chunk: Chunk
-            if chunk.index == int(chunk_index):
-                desired_chunk = chunk
-                break
+        desired_chunk = ret.get_chunks_by_indices([int(chunk_index)])[0]
     else:
         # Probably NoCreateError
         return MyResponse(False, reason="Probably haven't processed the text yet").to_json()
@@ -1194,7 +1191,7 @@ def get_recommendations(user: User):
     sys = get_chosen_group_system_prompt(groups)
     user_prompt = get_chosen_group_prompt(source_text)
     lm: LM = LM_PROVIDERS[BALANCED_CHAT_MODEL]
-    response = lm.run(user_prompt, system_prompt=sys, make_json=True)
+    response = run_governed(lm, user_prompt, system_prompt=sys, make_json=True)
 
     chosen_group_id = None
     try:
@@ -1317,18 +1314,61 @@ def get_or_make_summary(user: User):
             new_job_id = start_summary_reduce_job(user, asset, job['id'])
             return MyResponse(True, {'step': REDUCE_STEP, 'progress': 0, 'job_id': new_job_id}).to_json()
         else:
-            return MyResponse(True, {'step': APPLY_STEP, 'progress': job['progress'], 'job_id': job['id']}).to_json()
+            # If it stopped partway, it can be picked up with /summary/resume
+            return MyResponse(True, {'step': APPLY_STEP, 'progress': job['progress'], 'job_id': job['id'], 'can_resume': can_resume_job(job)}).to_json()
     # There's no summary
     if not make and not force_make:
         return MyResponse(True, {}).to_json()
     
     # Make one I guess.
-    new_job_id = start_summary_apply_job(user, asset)
+    new_job_id = start_summary_apply_job(user, asset, refresh_cache=bool(force_make))
     make_log(user, asset['id'], None, SUMMARY_ACTIVITY)
 
     return MyResponse(True, {'step': APPLY_STEP, 'progress': 0, 'job_id': new_job_id}).to_json()
 
 
+"""
+Restarts a summary's apply job that stopped partway, keeping the chunks it already finished
+A job that's still marked as running can be resumed once it's gone STALE_JOB_SECONDS without progress (its worker likely died without marking it)
+Use force to resume one sooner; either way, a job whose runner is still alive (it holds job_runner_lock) isn't run twice
+A job can't be resumed if the asset changed since it started (e.g., a re-upload); start over with force_make on /summary instead
+After this, keep polling /summary as usual
+"""
+@bp.route('/summary/resume', methods=('POST',))
+@cross_origin()
+@token_required
+def resume_summary(user: User):
+
+    asset_id = request.json.get('id')
+    job_id = request.json.get('job_id')
+    force = request.json.get('force')
+
+    asset = get_asset(user, asset_id)
+    if not asset:
+        return MyResponse(False, reason="Asset not found", status=404).to_json()
+
+    jobs = search_for_jobs(kind=SUMMARY_APPLY_JOB, asset_id=asset_id, order_by=[['time_uploaded', False]], job_id=job_id, limit=1, offset=0)
+    if not len(jobs):
+        return MyResponse(False, reason="Summary job not found", status=404).to_json()
+    job = jobs[0]
+
+    if job['is_complete'] or (not can_resume_job(job) and not force):
+        return MyResponse(True, {'step': "apply", 'progress': job['progress'], 'job_id': job['id']}).to_json()
+
+    # Held until the job's been handed off; the runner takes it too, so a second resume (or the job's old runner, if it's alive after all) can't run it at the same time
+    runner_lock = job_runner_lock(job['id'])
+    if acquire_lock(runner_lock, timeout=0) is None:
+        return MyResponse(True, {'step': "apply", 'progress': job['progress'], 'job_id': job['id']}).to_json()
+    try:
+        resume_summary_apply_job(user, asset, job)
+    except JobMismatchError as e:
+        return MyResponse(False, reason=str(e), status=409).to_json()
+    finally:
+        release_lock(runner_lock)
+
+    return MyResponse(True, {'step': "apply", 'progress': job['progress'], 'job_id': job['id']}).to_json()
+
+
 @bp.route('/quick-summary', methods=('POST',))
 @token_optional
 @cross_origin()
@@ -1379,7 +1419,7 @@ def quick_summary(user: User):
     
     def gen_text():
         total_summary = ""
-        for x in lm.stream(user_prompt, system_prompt=system_prompt, show_reasoning=False):
+        for x in stream_governed(lm, user_prompt, system_prompt=system_prompt, show_reasoning=False):
             x: LMStreamResponse
             total_summary += x.text
             yield x.text
@@ -1437,7 +1477,7 @@ def key_points(user: User):
     
     user_prompt = get_key_points_user_prompt()
 
-    llm_text = lm.run(user_prompt, system_prompt=system_prompt, make_json=True)
+    llm_text = run_governed(lm, user_prompt, system_prompt=system_prompt, make_json=True)
 
     llm_json = None
     bullet_json = None
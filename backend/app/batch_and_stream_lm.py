@@ -1,32 +1,51 @@
 import sys
 from flask import Response
 import json
-import random
 from .configs.str_constants import DIVIDER_TEXT, CHAT_ERROR_TEXT
 import concurrent.futures
-import time
+import asyncio
 import queue
-from .integrations.lm import LM, LM_PROVIDERS, DEFAULT_CHAT_MODEL
+from .integrations.lm import LM, LM_PROVIDERS, DEFAULT_CHAT_MODEL, run_on_lm_loop, LMLoopQueue
+from .lm_governor import governed_run, governed_stream, INTERACTIVE, BACKGROUND
 
 """
 
-This is designed to simply call the lm function in a multi-threaded way, no matter the function
+This is designed to simply call the lm function in a concurrent way, no matter the function
 There are usually ways to give batched calls directly to the API, but this should be easier for now.
 
+The calls run as coroutines on the LM loop (see integrations/lm.py), using the LMs' async methods and pooled connections,
+rather than on a pool of threads per call. max_threads is how many may be in flight at once.
+Every call also goes through the LM's rate limits (see lm_governor.py), at the priority given (INTERACTIVE or BACKGROUND).
+
 These functions do NOT do any streaming.
 
 """
 
+# Makes a semaphore limiting how many calls run at once (on the LM loop, where it's used)
+def _make_limit(n):
+    async def make():
+        return asyncio.Semaphore(n)
+    return run_on_lm_loop(make()).result()
+
+
+# Schedules func(*args, **kwargs) on the LM loop once limit allows; returns a concurrent.futures.Future
+def _submit(limit, func, *args, **kwargs):
+    async def limited():
+        async with limit:
+            return await func(*args, **kwargs)
+    return run_on_lm_loop(limited())
+
+
+def _cancel(futures):
+    for future in futures:
+        future.cancel()
+
+
 # Used by batched_lm and stream_progress_batched_lm
-def _batched_lm_worker(data, index, lm: LM, system_prompt, delay=None, make_json=False):
-    """Thread worker function"""
-    # Delay before starting the function
-    if not delay:
-        # Random delay so that if a bunch of batches go out quickly, they plausibly happen at different times.
-        delay = random.random() / 3  # between 0 and .33 seconds.
-    time.sleep(delay)    
-    # Call the target function
-    return lm.run(data, system_prompt=system_prompt, make_json=make_json), index
+# cache and refresh_cache are for the LM response cache (see integrations/lm.py)
+async def _batched_lm_worker(data, index, lm: LM, system_prompt, make_json=False, priority=INTERACTIVE, cache=False, refresh_cache=False):
+    """Coroutine worker function"""
+    return await governed_run(lm, data, priority=priority, system_prompt=system_prompt, make_json=make_json, cache=cache, refresh_cache=refresh_cache), index
 
 
 """
@@ -40,15 +59,16 @@ Yields tuples of result, index pairs
 """
 
 # data_list can be a generator
-def stream_batched_lm(data_list, max_threads=10, system_prompt=None, lm: LM=LM_PROVIDERS[DEFAULT_CHAT_MODEL], make_json=False):
-        
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-
-        futures = [executor.submit(_batched_lm_worker, data, index, lm, system_prompt=system_prompt, make_json=make_json) for index, data in enumerate(data_list)]
+def stream_batched_lm(data_list, max_threads=10, system_prompt=None, lm: LM=LM_PROVIDERS[DEFAULT_CHAT_MODEL], make_json=False, priority=INTERACTIVE, cache=False, refresh_cache=False):
         
+    limit = _make_limit(max_threads)
+    futures = [_submit(limit, _batched_lm_worker, data, index, lm, system_prompt=system_prompt, make_json=make_json, priority=priority, cache=cache, refresh_cache=refresh_cache) for index, data in enumerate(data_list)]
+    try:
         for future in concurrent.futures.as_completed(futures):
             result, index = future.result()
             yield result, index
+    finally:
+        _cancel(futures)  # if we stopped early
 
 """
 
@@ -58,36 +78,40 @@ Here, we submit data in parallel to the LMs and yield an index (but not the text
 
 This function uses a streaming callback to store its work - usually a database entry - does NOT return llm results.
 
+Indices come in the order the calls finish. Works as a sliding window: max_threads calls are kept in flight, and the next one starts as soon as any finishes,
+so only those are held in memory (data_list can be a generator) and one slow call doesn't hold up the rest.
+
+skip is a set of indices into data_list that are already done (e.g., a resumed job); they aren't sent or yielded, and the rest keep their indices.
+
 """
 
-def stream_progress_batched_lm(data_list, get_lm_part=lambda x:x, get_sys_part=lambda x:None, streamingCallback=None, max_threads=10, lm: LM=LM_PROVIDERS[DEFAULT_CHAT_MODEL], mini_batch_size=20):
+def stream_progress_batched_lm(data_list, get_lm_part=lambda x:x, get_sys_part=lambda x:None, streamingCallback=None, max_threads=10, lm: LM=LM_PROVIDERS[DEFAULT_CHAT_MODEL], priority=BACKGROUND, cache=False, refresh_cache=False, skip=None):
+
+    data_iter = ((index, data) for index, data in enumerate(data_list) if not skip or index not in skip)
+    in_flight = {}  # future -> (index, data)
 
-    # mini batches to avoid putting all of data_list in memory
-    def batch_effect(mini_batch):
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-            futures = [executor.submit(_batched_lm_worker, get_lm_part(data), index+offset, lm, system_prompt=get_sys_part(data)) for index, data in enumerate(mini_batch)]
+    def fill():
+        while len(in_flight) < max_threads:
+            nxt = next(data_iter, None)
+            if nxt is None:
+                return
+            index, data = nxt
+            future = run_on_lm_loop(_batched_lm_worker(get_lm_part(data), index, lm, system_prompt=get_sys_part(data), priority=priority, cache=cache, refresh_cache=refresh_cache))
+            in_flight[future] = (index, data)
 
-            for future in concurrent.futures.as_completed(futures):
+    try:
+        fill()
+        while len(in_flight):
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            finished = [(future, in_flight.pop(future)) for future in done]
+            fill()  # before the callbacks, so the window stays full while they run
+            for future, (_, data) in finished:
                 result, index = future.result()
                 if streamingCallback:
-                    streamingCallback(result, index, mini_batch[index-offset])
+                    streamingCallback(result, index, data)
                 yield index
-
-    mini_batch = []
-    offset = 0
-    for data in data_list:
-        mini_batch.append(data)
-        if len(mini_batch) < mini_batch_size:
-            continue
-
-        for effect in batch_effect(mini_batch):
-            yield effect
-        mini_batch = []
-        offset += mini_batch_size
-    
-    if len(mini_batch) > 0:
-        for effect in batch_effect(mini_batch):
-            yield effect
+    finally:
+        _cancel(in_flight)  # if we stopped early
 
 # Returns response - generator yielding comma separated index values.
 def stream_progress_batched_lm_resp(*args, **kwargs):
@@ -106,8 +130,8 @@ Then it yields plaintext until finished.
 
 """
 
-def _threaded_stream_lm(q, prompt, _index=0, stream_lm: LM=LM_PROVIDERS[DEFAULT_CHAT_MODEL], **prompt_kwargs):
-    q: queue.Queue
+async def _async_stream_lm(q, prompt, _index=0, stream_lm: LM=LM_PROVIDERS[DEFAULT_CHAT_MODEL], _priority=INTERACTIVE, **prompt_kwargs):
+    q: LMLoopQueue
 
     system_prompt = None
     if 'system_prompt' in prompt_kwargs:
@@ -132,7 +156,7 @@ def _threaded_stream_lm(q, prompt, _index=0, stream_lm: LM=LM_PROVIDERS[DEFAULT_
     q.put((_index, json.dumps(prompt_kwargs)))
 
     try:
-        for stream_resp in stream_lm.stream(prompt, system_prompt=system_prompt, context=context, **extra_kwargs):
+        async for stream_resp in governed_stream(stream_lm, prompt, priority=_priority, system_prompt=system_prompt, context=context, **extra_kwargs):
             q.put((_index, stream_resp.text))
     except Exception as e:
         print(f"Chat LM exception: {e}", file=sys.stderr)
@@ -143,47 +167,47 @@ def _threaded_stream_lm(q, prompt, _index=0, stream_lm: LM=LM_PROVIDERS[DEFAULT_
 # True multiplexed streaming LM
 # Used for getting question by question, token by token streaming
 # Yields strings that are JSON data with info on which partial response is for which prompt
-def stream_multiplexed_batched_lm(prompts, kwargs_list=None, max_threads=20, model: LM=LM_PROVIDERS[DEFAULT_CHAT_MODEL]):
+def stream_multiplexed_batched_lm(prompts, kwargs_list=None, max_threads=20, model: LM=LM_PROVIDERS[DEFAULT_CHAT_MODEL], priority=INTERACTIVE):
     if kwargs_list is None:
         kwargs_list = [{} for _ in prompts]
 
     if len(prompts) != len(kwargs_list):
         raise ValueError("Length of prompts and kwargs_list must be the same")
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-
-        futures = []
-        i = 0
+    futures = []
+    i = 0
 
-        q = queue.Queue()
+    q = LMLoopQueue()
 
-        for prompt, kwargs in zip(prompts, kwargs_list):
-            x = executor.submit(_threaded_stream_lm, q, prompt, stream_lm=model, _index=i, **kwargs)
-            futures.append(x)
-            i += 1
+    limit = _make_limit(max_threads)
+    for prompt, kwargs in zip(prompts, kwargs_list):
+        x = _submit(limit, _async_stream_lm, q, prompt, stream_lm=model, _index=i, _priority=priority, **kwargs)
+        futures.append(x)
+        i += 1
 
-        ct = 0
-        YIELD_BATCH_THRESHOLD = 100 if len(prompts) > 3 else 1  # in tokens
-        yielding_batch = []
+    ct = 0
+    YIELD_BATCH_THRESHOLD = 100 if len(prompts) > 3 else 1  # in tokens
+    yielding_batch = []
 
-        had_first = {}
+    had_first = {}
 
-        def get_combined(yielding_batch):
-            firsts = []
-            combined = {}
-            for tok in yielding_batch:
-                if tok['index'] in had_first:
-                    if tok['index'] in combined:
-                        combined[tok['index']] += tok['result']
-                    else:
-                        combined[tok['index']] = tok['result']
+    def get_combined(yielding_batch):
+        firsts = []
+        combined = {}
+        for tok in yielding_batch:
+            if tok['index'] in had_first:
+                if tok['index'] in combined:
+                    combined[tok['index']] += tok['result']
                 else:
-                    firsts.append(tok)
-                    had_first[tok['index']] = True
-            firsts_and_combined = [json.dumps(x) for x in firsts] + [json.dumps({'index': i, 'result': x}) for i, x in combined.items()]
-            to_yield = DIVIDER_TEXT.join(firsts_and_combined) + DIVIDER_TEXT
-            return to_yield
+                    combined[tok['index']] = tok['result']
+            else:
+                firsts.append(tok)
+                had_first[tok['index']] = True
+        firsts_and_combined = [json.dumps(x) for x in firsts] + [json.dumps({'index': i, 'result': x}) for i, x in combined.items()]
+        to_yield = DIVIDER_TEXT.join(firsts_and_combined) + DIVIDER_TEXT
+        return to_yield
 
+    try:
         num_timeouts = 0
         while True:
             try:
@@ -206,11 +230,11 @@ def stream_multiplexed_batched_lm(prompts, kwargs_list=None, max_threads=20, mod
                     combined = get_combined(yielding_batch)
                     yield combined
                     yielding_batch = []
-        
+    
         if yielding_batch:
             combined = get_combined(yielding_batch)
             yield combined
-        
+    
         for future in concurrent.futures.as_completed(futures):
             # Always good to waitpid
             # However - in future, should probably put some error handling stuff here.
@@ -218,3 +242,6 @@ def stream_multiplexed_batched_lm(prompts, kwargs_list=None, max_threads=20, mod
                 _ = future.result()
             except Exception as e:
                 print(f"Error occurred in thread: {e}", file=sys.stderr)
+    finally:
+        _cancel(futures)  # in case the client went away
+        q.close()
@@ -0,0 +1,377 @@
+import numpy as np
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import struct
+from .utils import normalize_embeddings
+from .ann_index import IVF_SECTIONS, IVFIndex, build_ivf_index
+
+"""
+
+On-disk format for the chunks of a ResourceRetriever (what gets stored in asset_retrieval_storage).
+
+The file is a single blob so that it can be uploaded/downloaded like any other file:
+
+[magic (8 bytes)][header length (uint64)][header (JSON)][sections...]
+
+Each section starts on an aligned offset given in the header, so that the numeric sections can be np.memmap'd directly:
+- embeddings: float32 matrix of shape (n, dim) - absent if the chunks have not been embedded; rows are unit length if the header says 'normalized'
+- indices: int64 chunk.index for each chunk
+- lengths: int64 length of each chunk's text in characters
+- txt_offsets / name_offsets: uint64 (n+1) byte offsets into the text and name blobs
+- txt / names: UTF-8 blobs
+- index_order: int64 positions of the chunks sorted (stably) by chunk.index, so that a chunk can be found by its index with a binary search
+
+Stores over a certain size also carry an ANN index, as extra sections (see ann_index.py).
+Extra sections are listed in the header after the standard ones, with their shape.
+
+Older retrievers were stored as a stream of pickled Chunk objects; see convert_legacy_chunk_file.
+
+"""
+
+MAGIC = b'ABBYCHK1'
+FORMAT_VERSION = 1
+SECTION_ALIGNMENT = 64
+EMBEDDING_DTYPE = np.float32
+
+# name -> dtype, in the order they're written
+SECTIONS = [
+    ('embeddings', EMBEDDING_DTYPE),
+    ('indices', np.int64),
+    ('lengths', np.int64),
+    ('txt_offsets', np.uint64),
+    ('name_offsets', np.uint64),
+    ('txt', np.uint8),
+    ('names', np.uint8),
+]
+
+
+def is_chunk_store(path):
+    try:
+        with open(path, 'rb') as fhand:
+            return fhand.read(len(MAGIC)) == MAGIC
+    except FileNotFoundError:
+        return False
+
+
+def _align(n):
+    return (n + SECTION_ALIGNMENT - 1) // SECTION_ALIGNMENT * SECTION_ALIGNMENT
+
+
+# Writes a chunk store incrementally; each section goes to its own temp file until finalize() stitches them together.
+# This way, neither the chunk texts nor the embeddings ever need to be in memory all at once.
+# normalized marks that the embeddings given to it are unit length
+class ChunkStoreWriter():
+    def __init__(self, path, normalized=False) -> None:
+        self.path = path
+        self.normalized = normalized
+        self.n = 0
+        self.dim = None
+        self._tmp_dir = tempfile.mkdtemp()
+        self._files = {name: open(os.path.join(self._tmp_dir, name), 'wb') for name, _ in SECTIONS}
+        self._txt_offset = 0
+        self._name_offset = 0
+        self._files['txt_offsets'].write(struct.pack('<Q', 0))
+        self._files['name_offsets'].write(struct.pack('<Q', 0))
+        self._extra_sections = []  # (name, dtype, shape)
+
+    # Used as a context manager, the store is finalized on a clean exit and thrown away on an exception
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.finalize()
+        else:
+            self.abort()
+
+    def add(self, index, source_name, txt, embedding=None):
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=EMBEDDING_DTYPE)
+            if self.dim is None:
+                if self.n > 0:
+                    raise ValueError("Either all chunks in a chunk store have embeddings or none do.")
+                self.dim = len(embedding)
+            elif len(embedding) != self.dim:
+                raise ValueError(f"Embedding has dimension {len(embedding)}, expected {self.dim}.")
+            self._files['embeddings'].write(embedding.tobytes())
+        elif self.dim is not None:
+            raise ValueError("Either all chunks in a chunk store have embeddings or none do.")
+
+        txt_bytes = txt.encode('utf-8')
+        name_bytes = (source_name or "").encode('utf-8')
+        self._txt_offset += len(txt_bytes)
+        self._name_offset += len(name_bytes)
+
+        self._files['indices'].write(struct.pack('<q', index))
+        self._files['lengths'].write(struct.pack('<q', len(txt)))
+        self._files['txt_offsets'].write(struct.pack('<Q', self._txt_offset))
+        self._files['name_offsets'].write(struct.pack('<Q', self._name_offset))
+        self._files['txt'].write(txt_bytes)
+        self._files['names'].write(name_bytes)
+        self.n += 1
+
+    # Adds a batch of chunks, with embeddings given as a 2D array (or None)
+    def add_many(self, chunks, embeddings=None):
+        for i, chunk in enumerate(chunks):
+            self.add(chunk.index, chunk.source_name, chunk.txt, embedding=None if embeddings is None else embeddings[i])
+
+    # Any other array to store alongside the chunks (like the ANN index)
+    def add_section(self, name, array):
+        if name in self._files or any(x[0] == name for x in self._extra_sections):
+            raise ValueError(f"Chunk store already has a section named {name}.")
+        array = np.ascontiguousarray(array)
+        with open(os.path.join(self._tmp_dir, name), 'wb') as fhand:
+            fhand.write(array.tobytes())
+        self._extra_sections.append((name, array.dtype, array.shape))
+
+    # The embeddings written so far, as a read-only (n, dim) memmap (or None)
+    def pending_embeddings(self):
+        if self.dim is None or self.n == 0:
+            return None
+        self._files['embeddings'].flush()
+        return np.memmap(os.path.join(self._tmp_dir, 'embeddings'), dtype=EMBEDDING_DTYPE, mode='r', shape=(self.n, self.dim))
+
+    def finalize(self, extra_header={}):
+        for fhand in self._files.values():
+            fhand.close()
+
+        indices = np.fromfile(os.path.join(self._tmp_dir, 'indices'), dtype=np.int64)
+        self.add_section('index_order', np.argsort(indices, kind='stable').astype(np.int64))
+
+        dim = self.dim or 0
+        sections = {}
+        section_sizes = [(name, dtype, os.path.getsize(os.path.join(self._tmp_dir, name))) for name, dtype in SECTIONS]
+        section_sizes += [(name, dtype, os.path.getsize(os.path.join(self._tmp_dir, name))) for name, dtype, _ in self._extra_sections]
+        shapes = {name: list(shape) for name, _, shape in self._extra_sections}
+
+        # The header includes the section offsets, which depend on the header length; iterate until they agree.
+        def make_header(start):
+            pos = start
+            for name, dtype, nbytes in section_sizes:
+                sections[name] = {'offset': pos, 'nbytes': nbytes, 'dtype': np.dtype(dtype).str}
+                if name in shapes:
+                    sections[name]['shape'] = shapes[name]
+                pos = _align(pos + nbytes)
+            header = {
+                'version': FORMAT_VERSION,
+                'n': self.n,
+                'dim': dim,
+                'normalized': bool(self.normalized),
+                'sections': sections,
+                **extra_header
+            }
+            return json.dumps(header).encode('utf-8')
+
+        header_bytes = make_header(0)
+        while True:
+            offset = _align(len(MAGIC) + 8 + len(header_bytes))
+            new_header_bytes = make_header(offset)
+            if _align(len(MAGIC) + 8 + len(new_header_bytes)) == offset:
+                header_bytes = new_header_bytes
+                break
+            header_bytes = new_header_bytes
+
+        with open(self.path, 'wb') as out:
+            out.write(MAGIC)
+            out.write(struct.pack('<Q', len(header_bytes)))
+            out.write(header_bytes)
+            for name, _, _ in section_sizes:
+                out.write(b'\0' * (sections[name]['offset'] - out.tell()))
+                with open(os.path.join(self._tmp_dir, name), 'rb') as fhand:
+                    shutil.copyfileobj(fhand, out)
+
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+        return self.path
+
+    # If something goes wrong before finalize
+    def abort(self):
+        for fhand in self._files.values():
+            try:
+                fhand.close()
+            except:
+                pass
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+
+# Read-only view over a chunk store file.
+# Numeric sections are memory-mapped (and so zero-copy); any chunk can be read by position in O(1).
+# Memory maps are opened lazily and dropped when pickled (retrievers get pickled to go to celery).
+class ChunkStore():
+    def __init__(self, path) -> None:
+        self.path = path
+        self._sections = None
+        with open(path, 'rb') as fhand:
+            magic = fhand.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError(f"File {path} is not a chunk store.")
+            header_len = struct.unpack('<Q', fhand.read(8))[0]
+            self.header = json.loads(fhand.read(header_len).decode('utf-8'))
+        self.n = self.header['n']
+        self.dim = self.header['dim']
+        self.normalized = self.header.get('normalized', False)
+        self._ann_index = None  # built in memory if asked for but not stored
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_sections'] = None
+        state['_ann_index'] = None
+        return state
+
+    def __len__(self):
+        return self.n
+
+    def _load_sections(self):
+        if self._sections is None:
+            sections = {}
+            for name, info in self.header['sections'].items():
+                dtype = np.dtype(info['dtype'])
+                count = info['nbytes'] // dtype.itemsize
+                if count == 0:
+                    sections[name] = np.zeros((0,), dtype=dtype)
+                else:
+                    sections[name] = np.memmap(self.path, dtype=dtype, mode='r', offset=info['offset'], shape=(count,))
+                if 'shape' in info:
+                    sections[name] = sections[name].reshape(info['shape'])
+            if self.dim:
+                sections['embeddings'] = sections['embeddings'].reshape((self.n, self.dim))
+            self._sections = sections
+        return self._sections
+
+    def close(self):
+        self._sections = None
+        self._ann_index = None
+
+    # Whether the sections are memory-mapped (after which the file itself can be deleted)
+    @property
+    def is_open(self):
+        return self._sections is not None
+
+    @property
+    def has_embeddings(self):
+        return self.dim > 0
+
+    # (n, dim) float32 memmap; do not write to it
+    @property
+    def embeddings(self):
+        if not self.has_embeddings:
+            return None
+        return self._load_sections()['embeddings']
+
+    @property
+    def has_ann_index(self):
+        return all(name in self.header['sections'] for name in IVF_SECTIONS)
+
+    # The stored IVF index; if there isn't one, one is built in memory (which can take a moment for a large store)
+    @property
+    def ann_index(self) -> IVFIndex:
+        if not self.has_embeddings:
+            return None
+        if self.has_ann_index:
+            sections = self._load_sections()
+            return IVFIndex(*[sections[name] for name in IVF_SECTIONS])
+        if self._ann_index is None:
+            self._ann_index = IVFIndex(*build_ivf_index(self.embeddings))
+        return self._ann_index
+
+    @property
+    def indices(self):
+        return self._load_sections()['indices']
+
+    @property
+    def lengths(self):
+        return [int(x) for x in self._load_sections()['lengths']]
+
+    def _blob_str(self, blob_name, offsets_name, pos):
+        sections = self._load_sections()
+        offsets = sections[offsets_name]
+        start, end = int(offsets[pos]), int(offsets[pos+1])
+        return bytes(sections[blob_name][start:end]).decode('utf-8')
+
+    def txt(self, pos):
+        return self._blob_str('txt', 'txt_offsets', pos)
+
+    def name(self, pos):
+        return self._blob_str('names', 'name_offsets', pos)
+
+    @property
+    def names(self):
+        return [self.name(i) for i in range(self.n)]
+
+    # pos is the position in the file, not necessarily chunk.index
+    def get_chunk(self, pos, with_embedding=True):
+        from .retriever import Chunk
+        if pos < 0 or pos >= self.n:
+            raise IndexError(f"Chunk position {pos} out of range for chunk store with {self.n} chunks.")
+        embedding = None
+        if with_embedding and self.has_embeddings:
+            embedding = self.embeddings[pos]
+        return Chunk(int(self.indices[pos]), self.name(pos), self.txt(pos), embedding=embedding)
+
+    def get_chunks(self, positions, with_embedding=True):
+        return [self.get_chunk(int(pos), with_embedding=with_embedding) for pos in positions]
+
+    # Positions sorted by chunk.index (stored in newer files, computed for older ones)
+    @property
+    def index_order(self):
+        sections = self._load_sections()
+        if 'index_order' not in sections:
+            sections['index_order'] = np.argsort(sections['indices'], kind='stable')
+        return sections['index_order']
+
+    # Position of the first chunk with each chunk.index in chunk_indices, or -1 if there's none
+    def positions_of(self, chunk_indices):
+        chunk_indices = np.asarray(chunk_indices, dtype=np.int64).reshape(-1)
+        if self.n == 0:
+            return np.full(len(chunk_indices), -1, dtype=np.int64)
+        order = self.index_order
+        sections = self._load_sections()
+        if 'sorted_indices' not in sections:
+            sections['sorted_indices'] = np.asarray(self.indices[order])
+        sorted_indices = sections['sorted_indices']
+        found_at = np.minimum(np.searchsorted(sorted_indices, chunk_indices, side='left'), self.n - 1)
+        return np.where(sorted_indices[found_at] == chunk_indices, order[found_at], -1).astype(np.int64)
+
+    # Chunks by chunk.index, in the order asked for; None where there's no such chunk
+    def get_chunks_by_indices(self, chunk_indices, with_embedding=True):
+        return [None if pos < 0 else self.get_chunk(int(pos), with_embedding=with_embedding) for pos in self.positions_of(chunk_indices)]
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self.get_chunk(i)
+
+
+# Converts a stream of pickled Chunk objects (the old retriever format) into a chunk store at dst_path.
+# Embeddings are normalized on the way.
+def convert_legacy_chunk_file(src_path, dst_path):
+    writer = ChunkStoreWriter(dst_path, normalized=True)
+    try:
+        with open(src_path, 'rb') as fhand:
+            while True:
+                try:
+                    chunk = pickle.load(fhand)
+                except EOFError:
+                    break
+                embedding = None if chunk.embedding is None else normalize_embeddings([chunk.embedding])[0]
+                writer.add(chunk.index, chunk.source_name, chunk.txt, embedding=embedding)
+    except:
+        writer.abort()
+        raise
+    return writer.finalize()
+
+
+# Makes a copy of the chunk store at src_path with an ANN index (replacing any existing one) at dst_path.
+def copy_with_ann_index(src_path, dst_path, batch_size=1000):
+    src = ChunkStore(src_path)
+    if not src.has_embeddings:
+        raise ValueError(f"Chunk store {src_path} has no embeddings to index.")
+    with ChunkStoreWriter(dst_path, normalized=src.normalized) as writer:
+        for start in range(0, len(src), batch_size):
+            positions = range(start, min(start + batch_size, len(src)))
+            writer.add_many(src.get_chunks(positions, with_embedding=False), src.embeddings[start:positions.stop])
+        for name, array in zip(IVF_SECTIONS, build_ivf_index(src.embeddings)):
+            writer.add_section(name, array)
+    src.close()
+    return dst_path
@@ -14,6 +14,8 @@ DB_USERNAME = secrets.DB_USERNAME or 'root'
 DB_PORT = int(secrets.DB_PORT) if secrets.DB_PORT else 3306
 DB_TYPE = secrets.DB_TYPE or 'local'  # 'local' or 'deployed' --> changes how app deals with transaction settings
 DB_NAME = secrets.DB_NAME or 'learn'
+DB_REPLICA_ENDPOINTS = [x.strip() for x in secrets.DB_REPLICA_ENDPOINTS.split(',') if x.strip()] if secrets.DB_REPLICA_ENDPOINTS else []  # read-only connections go here
+DB_POOL_MODE = secrets.DB_POOL_MODE or 'pooler'  # 'pooler' (through Redis to the db_pooler process) or 'direct' (a pool in each process; see db_direct.py)
 
 # An auth secret is required in any multi user setup that uses custom auth
 if 'auth' in SETTINGS and 'providers' in SETTINGS['auth'] and len(SETTINGS['auth']['providers']) and not ('system' in SETTINGS['auth'] and SETTINGS['auth']['system'] == 'custom'):
@@ -38,3 +40,14 @@ POOLER_CONNECTION_PARAMS = {
     'port': 6379,
     'db': 1,  # Note that this is different from 0, the one used above for celery.
 }
+EMBED_CACHE_CONNECTION_PARAMS = {
+    'host': 'localhost',
+    'port': 6379,
+    'db': 2,  # Shared embedding cache (see integrations/embed.py)
+}
+LM_CACHE_CONNECTION_PARAMS = {
+    'host': 'localhost',
+    'port': 6379,
+    'db': 3,  # LM response cache (see integrations/lm.py)
+}
+POOLER_CODEC = 'msgpack'  # 'msgpack' or 'json'; how the server encodes messages to the db pooler (see pooler_codec.py)
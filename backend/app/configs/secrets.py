@@ -25,7 +25,11 @@ DB_USERNAME = os.environ.get("DB_USERNAME")
 DB_PASSWORD = os.environ.get("DB_PASSWORD")
 DB_PORT = os.environ.get("DB_PORT")
 DB_NAME = os.environ.get("DB_NAME")
+DB_REPLICA_ENDPOINTS = os.environ.get("DB_REPLICA_ENDPOINTS")  # comma separated hosts of read replicas (same credentials, port, and db name)
 DB_TYPE = os.environ.get("DB_TYPE")  # 'local' or 'deployed' --> changes how app deals with transaction settings
+DB_POOL_MODE = os.environ.get("DB_POOL_MODE")  # 'pooler' or 'direct' --> whether queries go through the db_pooler process
+
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")  # bearer token for /metrics; the endpoints are off without one
 
 # For boto3 access
 AWS_ACCESS_KEY = os.environ.get("AWS_ACCESS_KEY")
@@ -56,6 +56,20 @@ MAX_CHAT_RETRIEVER_RESULTS = 7  # When a retriever query is made (without max ch
 
 RETRIEVER_JOB_TIMEOUT = 30  # in minutes, the max time we'll wait for a retriever to be created (e.g., a document to be processed)
 
+RETRIEVER_CACHE_MAX_BYTES = 2 * 1024 ** 3  # Max total size of the chunk files kept by the in-process retriever cache (see retriever_cache.py); 0 disables the cache.
+
+ANN_INDEX_MIN_CHUNKS = 20_000  # Resources with at least this many chunks get an approximate nearest neighbour index (see ann_index.py), which queries use instead of scoring every chunk.
+ANN_NPROBE = None  # Number of IVF lists scored per ANN query; None uses ~1/16th of them. Higher = better recall, slower.
+
+EMBED_CACHE_MAX_ENTRIES = 10_000  # Texts whose embeddings are kept in-process by the embedding cache (see integrations/embed.py); 0 disables it.
+EMBED_CACHE_TTL = 24 * 60 * 60  # in seconds, how long a cached embedding is used for
+EMBED_CACHE_USE_REDIS = True  # Also share cached embeddings between processes through redis (see EMBED_CACHE_CONNECTION_PARAMS)
+
+EMBEDDING_CACHE_RETENTION_DAYS = 90  # Stored chunk embeddings (see embedding_cache.py) that go unused for this long are deleted
+EMBEDDING_CACHE_PRUNE_HOURS = 6  # How often that's checked
+
+MERGED_INDEX_MIN_RESOURCES = 10  # Retrievers over at least this many resources (e.g., folders) query one merged index of all their chunks (see merged_index.py) instead of loading every resource.
+
 # Domains a user cannot give permissions to on an asset (a user can share with someone@gmail.com, but not all users with a gmail.com email domain – but can give permissions to everyone with a us.ai domain name, or a superspecial.com domain name email.)
 ILLEGAL_SHARE_DOMAINS = [
     'gmail.com',
@@ -1,40 +1,78 @@
 import click
-from flask import current_app, g
+from flask import current_app, g, request, has_request_context, has_app_context
 from .configs.secrets import *
 import warnings
 from .utils import get_unique_id
-from .configs.conn_config import POOLER_CONNECTION_PARAMS
+from .configs.conn_config import POOLER_CONNECTION_PARAMS, POOLER_CODEC, DB_POOL_MODE
+from .db_direct import DirectConn
+from .pooler_codec import encode_message, decode_message
+from .query_metrics import is_write
 import redis
-import json
-import time
+from .locks import acquire_lock, release_lock
 from functools import wraps
+from threading import Lock
 
 
 REDIS_TIMEOUT = 30  # in seconds
 def exec_via_redis(redis: redis.Redis, options):
     response_key = f"response:{get_unique_id()}"
     options['response_key'] = response_key
-    message = json.dumps(options)
+    message = encode_message(options, codec=POOLER_CODEC)
     redis.rpush('sql_queue', message)
     receipt = redis.blpop(response_key, timeout=REDIS_TIMEOUT)
     if not receipt:
         raise TimeoutError(f"Redis timeout occurred for command with options:\n {options}")
     message = receipt[1]
-    full = json.loads(message)
+    full, _ = decode_message(message)
     if full['error_status']:
         raise Exception(f"Error passed from db pool: {full['error_text']}")
     return full['data']
 
 
+STREAM_BATCH_SIZE = 200  # rows per message when streaming
+
+# Sends options for a 'stream' command right away; returns a generator over the rows, which are read from Redis a batch at a time.
+# If the generator is dropped before the end, the pooler is told to stop.
+def stream_via_redis(redis: redis.Redis, options):
+    response_key = f"response:{get_unique_id()}"
+    options['response_key'] = response_key
+    message = encode_message(options, codec=POOLER_CODEC)
+    redis.rpush('sql_queue', message)
+
+    def rows():
+        done = False
+        try:
+            while True:
+                receipt = redis.blpop(response_key, timeout=REDIS_TIMEOUT)
+                if not receipt:
+                    raise TimeoutError(f"Redis timeout occurred while streaming for command with options:\n {options}")
+                full, _ = decode_message(receipt[1])
+                if full['error_status']:
+                    done = True
+                    raise Exception(f"Error passed from db pool: {full['error_text']}")
+                if not full['more']:
+                    done = True
+                    return
+                yield from full['data']
+        finally:
+            if not done:
+                redis.set(f"{response_key}:stop", 1, ex=REDIS_TIMEOUT)
+                redis.delete(response_key)
+    return rows()
+
+
 NO_CALL = {'lastrowid', 'rowcount'}  # these attributes don't return functions, but rather their attribute values, as expected
+DEFERRED_CURSOR_FUNCTIONS = {'execute', 'executemany'}  # their return values aren't used, so they wait to go with the next call that needs a response
 class PooledCursor():
     id: str
     db_id: str
-    def __init__(self, db_id) -> None:
-        self.db_id = db_id
+    def __init__(self, pooled_conn) -> None:
+        self.pooled_conn: PooledConn = pooled_conn
+        self.db_id = pooled_conn.id
         self.id = get_unique_id()
-        self.redis = redis.Redis(**POOLER_CONNECTION_PARAMS)
-        # Create new cursor
+        # The endpoint using it goes along with its statements, so the pooler's query metrics can be broken down by endpoint
+        self.endpoint = request.endpoint if has_request_context() else None
+        # Create new cursor (goes with the cursor's first real call)
         options = {
             'type': 'new_cursor',
             'name': '',
@@ -43,7 +81,7 @@ class PooledCursor():
             'kwargs': {},
             'args': []
         }
-        exec_via_redis(self.redis, options)
+        self.pooled_conn.defer(options)
 
     # Forwards curr.functions
     def forward(self, name, *args, **kwargs):
@@ -53,11 +91,35 @@ class PooledCursor():
             'db_id': self.db_id,
             'curr_id': self.id,
             'kwargs': kwargs,
-            'args': args
+            'args': args,
+            'endpoint': self.endpoint
         }
-        message = exec_via_redis(self.redis, options)
+        if is_write(name, args):
+            if self.pooled_conn.read_only:
+                raise Exception("Tried to write with a read-only connection.")
+            note_write()
+        if name in DEFERRED_CURSOR_FUNCTIONS:
+            # So execute + fetchall (+ new_cursor before it) is one round trip, as is execute + commit
+            self.pooled_conn.defer(options)
+            return None
+        message = self.pooled_conn.send(options)
         return message
 
+    # Runs query on a server-side cursor in the pooler and returns a generator over the resulting rows (dicts).
+    # Rows come over in batches as they're read, rather than one round trip per fetchone / everything at once with fetchall.
+    # Doesn't change what the cursor itself has fetched.
+    def stream(self, query, args=None, batch_size=STREAM_BATCH_SIZE):
+        options = {
+            'type': 'stream',
+            'name': '',
+            'db_id': self.db_id,
+            'curr_id': self.id,
+            'kwargs': {'batch_size': batch_size},
+            'args': [query, args],
+            'endpoint': self.endpoint
+        }
+        return self.pooled_conn.stream(options)
+
     # Get attributes (not functions). Note that these are split up due to the JSON message passing limitations (we couldn't "get" a complex object, like a function).
     def get(self, name):
         options = {
@@ -68,7 +130,22 @@ class PooledCursor():
             'kwargs': {},
             'args': []
         }
-        return exec_via_redis(self.redis, options)
+        return self.pooled_conn.send(options)
+
+    # With defer, the close goes with the connection's next round trip
+    def close(self, defer=False):
+        options = {
+            'type': 'cursor_function',
+            'name': 'close',
+            'db_id': self.db_id,
+            'curr_id': self.id,
+            'kwargs': {},
+            'args': []
+        }
+        if defer:
+            self.pooled_conn.defer(options)
+        else:
+            return self.pooled_conn.send(options)
     
     def __getattr__(self, name):
         if name in NO_CALL:
@@ -79,32 +156,107 @@ class PooledCursor():
         return method
 
 
+# Commands that don't matter if the connection never runs anything
+def _is_no_op_when_unused(options):
+    return options['type'] in ('new_connection', 'new_cursor', 'commit') or (options['type'] == 'cursor_function' and options['name'] == 'close')
+
+
+"""
+
+Commands whose responses aren't needed right away (new connection, new cursor, execute, ...) are held by the PooledConn
+and sent along with the next one that does need a response, as a single 'batch' message with one combined response.
+Order is kept per connection, so the pooler runs everything in the order it was called.
+An error in a deferred command surfaces on the call that sends it: execute never raises, so a try around an execute has to include
+the fetch or commit after it (or a ProxyDB.flush, when it shouldn't commit yet).
+When a batch fails, the pooler skips the statements and commits after the failing one, but still runs the closes.
+
+"""
 class PooledConn():
     id: str
     r: redis.Redis
-    def __init__(self, consistent_conn=False, exclusive_conn=False) -> None:
+    def __init__(self, consistent_conn=False, exclusive_conn=False, read_only=False) -> None:
         self.id = get_unique_id()
         self.r = redis.Redis(**POOLER_CONNECTION_PARAMS)
+        self.pending = []
+        self.pending_lock = Lock()
+        self.sent = False  # whether anything has gone to the pooler yet
+        self.read_only = read_only  # goes to a replica, if there are any
         options = {
             'type': 'new_connection',
             'name': '',
             'db_id': self.id,
             'curr_id': None,
-            'kwargs': {'consistent': consistent_conn, 'exclusive': exclusive_conn},
+            'kwargs': {'consistent': consistent_conn, 'exclusive': exclusive_conn, 'read_only': read_only},
             'args': []
         }
-        exec_via_redis(self.r, options)
+        self.defer(options)
+
+    def defer(self, options):
+        with self.pending_lock:
+            self.pending.append(options)
+
+    # Sends options, along with anything deferred; returns the response to options
+    def send(self, options):
+        with self.pending_lock:
+            ops = self.pending + [options]
+            self.pending = []
+            self.sent = True
+        if len(ops) == 1:
+            return exec_via_redis(self.r, options)
+        batch = {
+            'type': 'batch',
+            'name': '',
+            'db_id': self.id,
+            'curr_id': None,
+            'kwargs': {},
+            'args': [],
+            'ops': ops
+        }
+        return exec_via_redis(self.r, batch)[-1]
+
+    # Sends a 'stream' command, along with anything deferred; returns the generator over its rows
+    def stream(self, options):
+        with self.pending_lock:
+            options['ops'] = self.pending
+            self.pending = []
+            self.sent = True
+        return stream_via_redis(self.r, options)
+
+    def flush(self):
+        with self.pending_lock:
+            ops = self.pending
+            self.pending = []
+            self.sent = self.sent or len(ops) > 0
+        if len(ops) == 1:
+            exec_via_redis(self.r, ops[0])
+        elif len(ops):
+            batch = {
+                'type': 'batch',
+                'name': '',
+                'db_id': self.id,
+                'curr_id': None,
+                'kwargs': {},
+                'args': [],
+                'ops': ops
+            }
+            exec_via_redis(self.r, batch)
 
     def close(self):
+        with self.pending_lock:
+            # Never used: the pooler doesn't even know about it
+            if not self.sent and all(_is_no_op_when_unused(x) for x in self.pending):
+                self.pending = []
+                return
         options = {
             'type': 'close_connection',
             'name': '',
             'db_id': self.id,
             'curr_id': None,
         }
-        exec_via_redis(self.r, options)
+        self.send(options)
 
-    def commit(self):
+    # With defer, the commit goes with the next round trip (e.g., the close)
+    def commit(self, defer=False):
         options = {
             'type': 'commit',
             'name': '',
@@ -113,7 +265,10 @@ class PooledConn():
             'kwargs': {},
             'args': []
         }
-        exec_via_redis(self.r, options)
+        if defer:
+            self.defer(options)
+        else:
+            self.send(options)
 
     def escape_string(self, text):
         options = {
@@ -124,7 +279,7 @@ class PooledConn():
             'kwargs': {},
             'args': [text]
         }
-        return exec_via_redis(self.r, options)
+        return self.send(options)
 
 
 # Every call to get_db returns a new ProxyDB object, which itself (re-)uses a PooledDB redis connection + identity
@@ -137,42 +292,50 @@ class ProxyDB():
         self.cursors = []        
 
     def cursor(self) -> PooledCursor:
-        new_cursor = PooledCursor(self.pooled_conn.id)
+        new_cursor = PooledCursor(self.pooled_conn)
         self.cursors.append(new_cursor)
         return new_cursor
     
     def escape_string(self, text):
         return self.pooled_conn.escape_string(text)
+
+    # Sends anything deferred (executes, ...) now, without committing, so that an error in it comes from here rather than from a later call
+    def flush(self):
+        self.pooled_conn.flush()
     
-    def close_cursors(self, exempt=[]):
+    # With defer, the closes go with the connection's next round trip
+    def close_cursors(self, exempt=[], defer=False):
         for curr in self.cursors:
             curr: PooledCursor
             if curr.id not in exempt:
-                curr.close()
+                curr.close(defer=True)
         self.cursors = [x for x in self.cursors if x.id in exempt]
+        if not defer:
+            self.pooled_conn.flush()
 
     def close(self):
-        self.close_cursors()
+        self.close_cursors(defer=True)
         self.pooled_conn.close()
 
+    # Cursors are closed in the same round trip as the commit (and the close of the connection, if close)
     def commit(self, close_cursors=True, close=False):
-        self.pooled_conn.commit()
+        if close or close_cursors:
+            self.close_cursors(defer=True)
+        self.pooled_conn.commit(defer=close)
         if close:
-            self.close()
-        elif close_cursors:
-            self.close_cursors()
+            self.pooled_conn.close()
 
 
 # Wrapper for non-endpoint functions that require use of the db
 def needs_db(func):
     @wraps(func)
-    def wrapper(*args, db: ProxyDB=None, new_conn=False, exclusive_conn=False, consistent_conn=False, no_commit=False, **kwargs):
+    def wrapper(*args, db: ProxyDB=None, new_conn=False, exclusive_conn=False, consistent_conn=False, read_only=False, no_commit=False, **kwargs):
         # Close connection iff the connection is fresh
         needs_close = False
         # We want to close cursors, but can't close a calling function's cursors if they are sharing the database
         exempt_cursor_ids = []
         if not db:
-            real_db = get_db(new_connection=new_conn, exclusive_conn=exclusive_conn, consistent_conn=consistent_conn)
+            real_db = get_db(new_connection=new_conn, exclusive_conn=exclusive_conn, consistent_conn=consistent_conn, read_only=read_only)
             needs_close = new_conn or exclusive_conn or consistent_conn  # don't want to close if it's the global connection (g.db)
         else:
             real_db = db
@@ -190,16 +353,16 @@ def needs_db(func):
     return wrapper
 
 # If you can figure out how to deduplicate this code with the above, I will give you $20.
-def needs_special_db(new_conn=False, exclusive_conn=False, consistent_conn=False, no_close=False):
+def needs_special_db(new_conn=False, exclusive_conn=False, consistent_conn=False, read_only=False, no_close=False):
     def decorator(func):
         @wraps(func)
-        def wrapper(*args, db: ProxyDB=None, new_conn=new_conn, exclusive_conn=exclusive_conn, consistent_conn=consistent_conn, no_commit=False, **kwargs):
+        def wrapper(*args, db: ProxyDB=None, new_conn=new_conn, exclusive_conn=exclusive_conn, consistent_conn=consistent_conn, read_only=read_only, no_commit=False, **kwargs):
             # Close connection iff the connection is fresh
             needs_close = False
             # We want to close cursors, but can't close a calling function's cursors if they are sharing the database
             exempt_cursor_ids = []
             if not db:
-                real_db = get_db(new_connection=new_conn, exclusive_conn=exclusive_conn, consistent_conn=consistent_conn)
+                real_db = get_db(new_connection=new_conn, exclusive_conn=exclusive_conn, consistent_conn=consistent_conn, read_only=read_only)
                 needs_close = new_conn or exclusive_conn or consistent_conn  # don't want to close if it's the global connection (g.db)
             else:
                 real_db = db
@@ -218,47 +381,15 @@ def needs_special_db(new_conn=False, exclusive_conn=False, consistent_conn=False
     return decorator
 
 
-# A polling lock so that we don't cause delays with the db pool
+# A lock shared by every process, in Redis (see locks.py); waits up to REDIS_TIMEOUT for it and returns whether it got it.
 # TO USER OF THE FUNCTION, APPEARS AS THOUGH IT'S BLOCKING - perhaps poorly named...
-@needs_db
+# db isn't used anymore (waiting doesn't go through the pooler), but callers still pass it
 def db_polling_lock(name, db: ProxyDB = None):
-
-    # Two phases for performance
-    # We use IS_FREE_LOCK as a pure polling solution
-    # And then "poll" using GET_LOCK, which is blocking, but has a short timeout. 
-    curr = db.cursor()
-    start = time.time()
-    timeout = REDIS_TIMEOUT  # Arbitrary
-    while True:
-        if time.time() - start > timeout:
-            return False
-        sql = f"SELECT IS_FREE_LOCK('{db.escape_string(name)}') as 'lock';"
-        curr.execute(sql)
-        res = curr.fetchone()
-        if res['lock']:
-            break
-        else:
-            time.sleep(.1)
-    
-    while True:
-        if time.time() - start > timeout:
-            return False
-        sql = f"SELECT GET_LOCK('{db.escape_string(name)}', .1) as 'lock';"
-        curr.execute(sql)
-        res = curr.fetchone()
-        if res['lock']:
-            break
-        else:
-            time.sleep(.1)
-
-    return True
+    return acquire_lock(name, timeout=REDIS_TIMEOUT) is not None
 
 
-@needs_db
 def db_release_lock(name, db: ProxyDB = None):
-    curr = db.cursor()
-    sql = f"SELECT RELEASE_LOCK('{name}');"
-    curr.execute(sql)
+    release_lock(name)
 
 
 def with_lock(lock_name, db):
@@ -280,21 +411,71 @@ def with_lock(lock_name, db):
     return decorator
 
 
-def get_db(new_connection=False, consistent_conn=False, exclusive_conn=False) -> ProxyDB:
+PAGE_TOTAL_COLUMN = '_page_total'
+
+# Runs body (a SELECT, which can start with WITH) sorted and paged; returns (rows, total), where total is the number of rows in all of body.
+# The total comes from COUNT(*) OVER () in the same statement: body runs once, and it works on any connection (including a replica),
+# unlike a second COUNT(*) over body (which runs it again) or SQL_CALC_FOUND_ROWS + FOUND_ROWS() (which has to be the next statement on the same connection).
+# Body's rows are aliased as a, so order_by_clause can use a.column or just column. Only a page past the end needs a count of its own.
+def fetch_page_with_total(curr, body, order_by_clause, limit, offset):
+    curr.execute(f"""
+        SELECT a.*, COUNT(*) OVER () AS {PAGE_TOTAL_COLUMN}
+        FROM ({body}) AS a
+        ORDER BY {order_by_clause}
+        LIMIT {limit}
+        OFFSET {offset}
+    """)
+    rows = curr.fetchall()
+    if rows:
+        total = rows[0][PAGE_TOTAL_COLUMN]
+        for row in rows:
+            del row[PAGE_TOTAL_COLUMN]
+    elif int(offset) > 0:
+        curr.execute(f"SELECT COUNT(*) AS _count FROM ({body}) AS counted")
+        total = curr.fetchone()['_count']
+    else:
+        total = 0
+    return rows, total
+
+
+# Called when a statement that could write is executed, on any connection; see get_db
+def note_write():
+    if has_app_context():
+        g.wrote_to_db = True
+
+
+# A PooledConn, or a DirectConn in 'direct' mode (same interface, no pooler process)
+def make_conn(consistent_conn=False, exclusive_conn=False, read_only=False):
+    if DB_POOL_MODE == 'direct':
+        return DirectConn(consistent_conn=consistent_conn, exclusive_conn=exclusive_conn, read_only=read_only)
+    return PooledConn(consistent_conn=consistent_conn, exclusive_conn=exclusive_conn, read_only=read_only)
+
+
+# read_only = reads can go to a replica (ignored for consistent and exclusive connections, which are always on the primary).
+# Once anything in this request (or app context) has written, on any connection and committed or not, read_only is ignored too,
+# so that it reads its own writes: g.db sees the uncommitted ones, and new connections are on the primary, past any replica lag.
+def get_db(new_connection=False, consistent_conn=False, exclusive_conn=False, read_only=False) -> ProxyDB:
+    read_only = read_only and not (consistent_conn or exclusive_conn)
     try:
+        if read_only and g.get('wrote_to_db'):
+            read_only = False
         # TODO: consistent connection can have its own global variable
         if new_connection or consistent_conn or exclusive_conn:
-            new_conn = PooledConn(consistent_conn=consistent_conn, exclusive_conn=exclusive_conn)
+            new_conn = make_conn(consistent_conn=consistent_conn, exclusive_conn=exclusive_conn, read_only=read_only)
             new_db = ProxyDB(new_conn)
             return new_db
+        if read_only:
+            if 'read_db' not in g:
+                g.read_db = make_conn(read_only=True)
+            return ProxyDB(g.read_db)
         if 'db' not in g:
-            g.db = PooledConn()
+            g.db = make_conn()
         return ProxyDB(g.db)
     except RuntimeError as e:
         # Usually means working outside of application context
         # Typtically undesirable to get here, but in some cases need it
         warnings.warn(f"Tried to use existing connection for database, but RuntimeError occurred: {str(e)}.")
-        new_conn = PooledConn()
+        new_conn = make_conn(read_only=read_only)
         return ProxyDB(new_conn)
 
 
@@ -0,0 +1,384 @@
+from .configs.conn_config import DB_ENDPOINT, DB_NAME, DB_PASSWORD, DB_PORT, DB_USERNAME, DB_REPLICA_ENDPOINTS
+import pymysql
+from pymysql.constants import CLIENT, CR
+import random
+import sys
+import time
+import zlib
+import weakref
+from collections import deque
+from threading import Lock, Timer
+from queue import Queue, Empty
+from .utils import get_unique_id, make_json_serializable
+from .query_metrics import QUERY_STATS, fingerprint, is_write
+
+"""
+
+In-process connection pool, used instead of the Redis db pooler when DB_POOL_MODE is 'direct' (see get_db in db.py).
+
+Meant for single-node deployments and celery workers, where a round trip through Redis to another process buys nothing.
+DirectConn takes the same commands as PooledConn, so PooledCursor and ProxyDB work on top of either one; it just runs them here.
+The pool is laid out like the one in db_pooler.py: N_POOL shared connections (consistent connections are hashed to one of the last N_CONSISTENT)
+and N_EXCL exclusive ones, then N_PER_REPLICA for each read replica, each used under its own lock. Under gevent, the threading locks are monkey patched to be cooperative.
+Connections are chosen as the pooler does: the least loaded of the group, counting those holding or waiting on its lock, then the ids on it.
+And as with the pooler's monitor, a DirectConn kept waiting for BLOCKED_AFTER moves to another connection in its group if nothing ties it to its own (no open cursors or uncommitted writes).
+
+Streamed queries (see Stream) are read a batch at a time as the caller iterates, holding the connection until the caller is done,
+unless something else needs the connection first, in which case the rest is read into memory.
+
+Results go through make_json_serializable, so callers get the same data they would through the pooler.
+Statement timings go to this process's QUERY_STATS (queue_wait is always 0, since there's no queue).
+
+"""
+
+db_params = {
+    'host': DB_ENDPOINT,
+    'user': DB_USERNAME,
+    'passwd': DB_PASSWORD,
+    'port': DB_PORT,
+    'database': DB_NAME,
+    'client_flag': CLIENT.MULTI_STATEMENTS,
+    'cursorclass': pymysql.cursors.DictCursor
+}
+N_POOL = 10
+N_EXCL = 2
+N_CONSISTENT = 3  # the last N_CONSISTENT of the pool are for consistent connections
+N_PER_REPLICA = 3
+N_REPLICA = N_PER_REPLICA * len(DB_REPLICA_ENDPOINTS)
+N_CONNECTIONS = N_POOL + N_EXCL + N_REPLICA
+
+LOCK_TIMEOUT = 5  # in seconds, for exclusive connections
+BLOCKED_AFTER = LOCK_TIMEOUT  # in seconds; as in db_pooler.py
+BUSY_TIMEOUT = 30  # in seconds; how long a command waits for a connection in all, like the pooler client's REDIS_TIMEOUT
+
+LOST_CONNECTION_ERRORS = (CR.CR_CONN_HOST_ERROR, CR.CR_SERVER_GONE_ERROR, CR.CR_SERVER_LOST)
+
+
+# As in db_pooler.py: a lock wait timeout or deadlock is an OperationalError too, but isn't fixed (or made safe to retry) by reconnecting
+def is_connection_lost(e):
+    if isinstance(e, pymysql.InterfaceError):
+        return True
+    return isinstance(e, pymysql.OperationalError) and len(e.args) > 0 and e.args[0] in LOST_CONNECTION_ERRORS
+
+# Connections are made the first time they're used
+CONNECTIONS = [None] * N_CONNECTIONS
+CONNECTION_LOCKS = [Lock() for _ in range(N_CONNECTIONS)]
+
+SHARED_INDICES = list(range(0, N_POOL - N_CONSISTENT))
+CONSISTENT_INDICES = list(range(N_POOL - N_CONSISTENT, N_POOL))
+REPLICA_INDICES = list(range(N_POOL + N_EXCL, N_CONNECTIONS))
+
+LOAD_LOCK = Lock()
+LOADS = [0] * N_CONNECTIONS  # number holding or waiting on each connection's lock (under LOAD_LOCK)
+ASSIGNED_COUNTS = [0] * N_CONNECTIONS  # number of DirectConns on each connection (under LOAD_LOCK)
+
+STREAMS = [None] * N_CONNECTIONS  # a weak reference to the Stream holding each connection, if any (under STREAMS_LOCK); weak, so a dropped Stream is still collected
+STREAMS_LOCK = Lock()
+
+AVAILABLE_EXCL_CONNS = Queue(maxsize=N_EXCL)
+for i in range(N_EXCL):
+    AVAILABLE_EXCL_CONNS.put(N_POOL + i)
+
+
+# Should be called with the connection's lock
+def _get_connection(index) -> pymysql.Connection:
+    if CONNECTIONS[index] is None or not CONNECTIONS[index].open:
+        params = db_params
+        if index >= N_POOL + N_EXCL:
+            params = {**db_params, 'host': DB_REPLICA_ENDPOINTS[(index - N_POOL - N_EXCL) // N_PER_REPLICA]}
+        CONNECTIONS[index] = pymysql.connect(**params)
+    return CONNECTIONS[index]
+
+
+# Should be called with LOAD_LOCK
+def least_loaded_index(indices):
+    return min(indices, key=lambda i: (LOADS[i], ASSIGNED_COUNTS[i], random.random()))
+
+
+# The group an index can be moved within; empty for exclusive connections
+def _group(index):
+    for group in (SHARED_INDICES, CONSISTENT_INDICES, REPLICA_INDICES):
+        if index in group:
+            return group
+    return []
+
+
+def _release_connection(index):
+    with LOAD_LOCK:
+        LOADS[index] -= 1
+    CONNECTION_LOCKS[index].release()
+
+
+# Gives back the connection if a Stream is holding it, so whoever's about to wait on it won't have to wait on the stream's reader
+def _drain_stream(index):
+    with STREAMS_LOCK:
+        ref = STREAMS[index]
+    stream = ref() if ref is not None else None
+    if stream is not None:
+        stream.drain()
+
+
+class Stream():
+    """
+    Iterator over the rows of an unbuffered query on a connection whose lock is held until they're all read, or the Stream is closed or dropped.
+    Batches are read as the caller iterates, so a big result isn't all in memory at once.
+    Since the caller may be slow (or send other commands on the same DirectConn before it's done), anything else needing the connection calls drain() first,
+    which reads what's left into memory and gives the connection back.
+    """
+    def __init__(self, index, curr, batch_size) -> None:
+        self.index = index
+        self.curr = curr
+        self.batch_size = batch_size
+        self.buffer = deque()
+        self.error = None  # from drain(), raised to the reader once it gets there
+        self.done = False
+        self.lock = Lock()  # for everything above
+        self.ref = weakref.ref(self)
+        with STREAMS_LOCK:
+            STREAMS[index] = self.ref
+
+    # Should be called with self.lock
+    def _fetch(self):
+        batch = self.curr.fetchmany(self.batch_size)
+        self.buffer.extend(make_json_serializable(batch))
+        return len(batch) > 0
+
+    # Should be called with self.lock
+    def _finish(self):
+        if self.done:
+            return
+        self.done = True
+        with STREAMS_LOCK:
+            if STREAMS[self.index] is self.ref:
+                STREAMS[self.index] = None
+        try:
+            self.curr.close()
+        except Exception:
+            pass  # the connection is reopened on next use if it's gone
+        finally:
+            _release_connection(self.index)
+
+    def drain(self):
+        with self.lock:
+            if self.done:
+                return
+            try:
+                while self._fetch():
+                    pass
+            except Exception as e:
+                self.error = e
+            finally:
+                self._finish()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            if not len(self.buffer):
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    raise StopIteration
+                try:
+                    fetched = self._fetch()
+                except BaseException:
+                    self._finish()
+                    raise
+                if not fetched:
+                    self._finish()
+                    raise StopIteration
+            return self.buffer.popleft()
+
+    # Gives back the connection without reading the rest
+    def close(self):
+        with self.lock:
+            self._finish()
+
+    # Including when it's never iterated at all
+    def __del__(self):
+        self.close()
+
+
+class DirectConn():
+    id: str
+    def __init__(self, consistent_conn=False, exclusive_conn=False, read_only=False) -> None:
+        self.id = get_unique_id()
+        self.consistent = consistent_conn
+        self.exclusive = exclusive_conn
+        self.read_only = read_only
+        self.dirty = False  # whether a write has actually run since the last commit (which a reconnect would lose)
+        self.index = None  # chosen on first use, like the pooler's deferred new_connection
+        self.cursors = {}  # curr_id -> pymysql cursor
+        self.lock = Lock()  # for index and cursors
+        self.lock_wait = 0  # for query_metrics; goes to the next statement
+        self.last_statement = None  # (endpoint, fingerprint), to which serialization is attributed
+
+    def _get_index(self):
+        with self.lock:
+            if self.index is None:
+                if self.exclusive:
+                    try:
+                        self.index = AVAILABLE_EXCL_CONNS.get(timeout=LOCK_TIMEOUT)
+                    except Empty:
+                        raise Exception("No available exclusive connections within the timeout period")
+                    Timer(LOCK_TIMEOUT, self._release, args=[self.index]).start()
+                    return self.index
+                with LOAD_LOCK:
+                    if self.consistent:
+                        # Sticky: the same id always hashes to the same one
+                        self.index = CONSISTENT_INDICES[zlib.crc32(self.id.encode('utf-8')) % N_CONSISTENT]
+                    elif self.read_only and N_REPLICA:
+                        self.index = least_loaded_index(REPLICA_INDICES)
+                    else:
+                        self.index = least_loaded_index(SHARED_INDICES)
+                    ASSIGNED_COUNTS[self.index] += 1
+            return self.index
+
+    # Moves to the least loaded other connection in the group if nothing ties this to its own; returns the index to wait on
+    def _move(self, index):
+        others = [i for i in _group(index) if i != index]
+        with self.lock:
+            if self.index != index or not len(others) or self.dirty or len(self.cursors):
+                return self.index
+            with LOAD_LOCK:
+                self.index = least_loaded_index(others)
+                ASSIGNED_COUNTS[index] -= 1
+                ASSIGNED_COUNTS[self.index] += 1
+            print(f"Connection {index} busy for over {BLOCKED_AFTER} seconds; moved {self.id} to connection {self.index}.", file=sys.stderr)
+            return self.index
+
+    # Waits for the lock of this one's connection; returns the index, which is to be given back with _release_connection
+    def _acquire(self):
+        index = self._get_index()
+        start = time.time()
+        try:
+            while True:
+                _drain_stream(index)
+                with LOAD_LOCK:
+                    LOADS[index] += 1
+                if CONNECTION_LOCKS[index].acquire(timeout=BLOCKED_AFTER):
+                    return index
+                with LOAD_LOCK:
+                    LOADS[index] -= 1
+                if time.time() - start > BUSY_TIMEOUT:
+                    raise Exception(f"Connection {index} was busy for over {BUSY_TIMEOUT} seconds, and {self.id} couldn't move off of it (it has open cursors or uncommitted writes).")
+                index = self._move(index)
+        finally:
+            self.lock_wait += time.time() - start
+
+    # With only_index, only gives back that index (if this still has it)
+    def _release(self, only_index=None):
+        with self.lock:
+            if only_index is not None and self.index != only_index:
+                return
+            index = self.index
+            self.index = None
+        if index is not None and N_POOL <= index < N_POOL + N_EXCL:
+            AVAILABLE_EXCL_CONNS.put_nowait(index)
+        elif index is not None:
+            with LOAD_LOCK:
+                ASSIGNED_COUNTS[index] -= 1
+
+    def _run_on(self, index, db: pymysql.Connection, options):
+        op_type = options['type']
+        name = options.get('name', '')
+        args = options.get('args', [])
+        kwargs = options.get('kwargs', {})
+        curr_id = options.get('curr_id')
+        if op_type == 'new_cursor':
+            with self.lock:
+                self.cursors[curr_id] = db.cursor()
+            return True
+        elif op_type == 'commit':
+            db.commit()
+            self.dirty = False
+            return True
+        elif op_type == 'escape_string':
+            return db.escape_string(*args)
+        elif op_type == 'cursor_function' or op_type == 'cursor_attribute':
+            with self.lock:
+                curr = self.cursors[curr_id]
+            attr = getattr(curr, name)
+            if op_type == 'cursor_function':
+                start = time.time()
+                result = attr(*args, **kwargs)
+                if is_write(name, args):
+                    self.dirty = True
+                if name in ('execute', 'executemany') and len(args):
+                    self.last_statement = (options.get('endpoint'), fingerprint(args[0]))
+                    QUERY_STATS.record(*self.last_statement, sql=args[0], execution=time.time() - start, lock_wait=self.lock_wait)
+                    self.lock_wait = 0
+            else:
+                result = attr
+            if name == 'close':
+                with self.lock:
+                    del self.cursors[curr_id]
+            return result
+        elif op_type == 'stream':
+            # Only runs the query; the rows are read by the Stream
+            query, query_args = args
+            curr = db.cursor(pymysql.cursors.SSDictCursor)
+            try:
+                start = time.time()
+                curr.execute(query, query_args)
+                self.last_statement = (options.get('endpoint'), fingerprint(query))
+                QUERY_STATS.record(*self.last_statement, sql=query, execution=time.time() - start, lock_wait=self.lock_wait)
+                self.lock_wait = 0
+                return Stream(index, curr, kwargs['batch_size'])
+            except Exception:
+                curr.close()
+                raise
+        raise Exception(f"Unknown command type {op_type}")
+
+    def _run(self, options):
+        if options['type'] == 'new_connection':
+            return True
+        elif options['type'] == 'close_connection':
+            self._release()
+            return True
+
+        index = self._acquire()
+        try:
+            db = _get_connection(index)
+            try:
+                result = self._run_on(index, db, options)
+            except (pymysql.OperationalError, pymysql.InterfaceError) as e:
+                # Run again on a new connection only if nothing uncommitted went with the old one
+                if not is_connection_lost(e) or self.dirty:
+                    raise
+                db.ping(reconnect=True)
+                result = self._run_on(index, db, options)
+        except BaseException:
+            _release_connection(index)
+            raise
+        if isinstance(result, Stream):
+            return result  # which gives back the connection once it's read, closed or dropped
+        _release_connection(index)
+        start = time.time()
+        result = make_json_serializable(result)
+        if self.last_statement:
+            QUERY_STATS.record(*self.last_statement, count=0, serialization=time.time() - start)
+        return result
+
+    # Nothing is held back in process; errors surface on the call that causes them
+    def defer(self, options):
+        self._run(options)
+
+    def send(self, options):
+        return self._run(options)
+
+    def stream(self, options):
+        return self._run(options)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._release()
+
+    def commit(self, defer=False):
+        self._run({'type': 'commit', 'name': '', 'db_id': self.id, 'curr_id': None, 'kwargs': {}, 'args': []})
+
+    def escape_string(self, text):
+        return self._run({'type': 'escape_string', 'name': '', 'db_id': self.id, 'curr_id': None, 'kwargs': {}, 'args': [text]})
@@ -1,17 +1,19 @@
-from .configs.conn_config import DB_ENDPOINT, DB_NAME, DB_PASSWORD, DB_PORT, DB_USERNAME, POOLER_CONNECTION_PARAMS
+from .configs.conn_config import DB_ENDPOINT, DB_NAME, DB_PASSWORD, DB_PORT, DB_USERNAME, DB_REPLICA_ENDPOINTS, POOLER_CONNECTION_PARAMS
 import redis
 import pymysql
-from pymysql.constants import CLIENT
+from pymysql.constants import CLIENT, CR
 import sys
-import json
 from concurrent.futures import ThreadPoolExecutor
 import random
-from threading import Lock, Timer
-from .utils import make_json_serializable
+from threading import Lock, Timer, Thread, Condition, local
+from .pooler_codec import encode_message, decode_message
+from .query_metrics import QUERY_STATS, fingerprint, is_write
 import atexit
 from functools import wraps
 from queue import Queue, Empty
 import time
+import zlib
+from collections import deque, OrderedDict
 
 """
 
@@ -36,21 +38,32 @@ db_params = {
 }
 N_POOL = 10
 N_EXCL = 2
+N_CONSISTENT = 3  # the last N_CONSISTENT of the pool are for consistent connections
 
-def get_new_conn():
+N_PER_REPLICA = 3  # connections to each read replica, which come after the exclusive ones
+
+SHARED_INDICES = list(range(0, N_POOL - N_CONSISTENT))
+CONSISTENT_INDICES = list(range(N_POOL - N_CONSISTENT, N_POOL))
+REPLICA_INDICES = list(range(N_POOL + N_EXCL, N_POOL + N_EXCL + N_PER_REPLICA * len(DB_REPLICA_ENDPOINTS)))
+N_CONNECTIONS = N_POOL + N_EXCL + len(REPLICA_INDICES)
+
+def get_new_conn(index=0):
+    if index in REPLICA_INDICES:
+        host = DB_REPLICA_ENDPOINTS[(index - REPLICA_INDICES[0]) // N_PER_REPLICA]
+        return pymysql.connect(**{**db_params, 'host': host})
     return pymysql.connect(**db_params)
 
 # We're gonna try to get out of using a lock on this list...
-CONNECTIONS = [None] * (N_POOL + N_EXCL)
-CONNECTION_LOCKS = [Lock() for _ in range(N_POOL + N_EXCL)]
+CONNECTIONS = [None] * N_CONNECTIONS
+CONNECTION_LOCKS = [Lock() for _ in range(N_CONNECTIONS)]
 
 # Connection factory with retry mechanism
 def initialize_connections(max_retries=10, retry_delay=1):
     for attempt in range(max_retries):
         try:
-            for i in range(N_POOL + N_EXCL):
+            for i in range(N_CONNECTIONS):
                 if CONNECTIONS[i] is None or not CONNECTIONS[i].open:
-                    CONNECTIONS[i] = get_new_conn()
+                    CONNECTIONS[i] = get_new_conn(i)
             break
         except (pymysql.OperationalError, pymysql.InterfaceError) as e:
             if attempt == max_retries - 1:
@@ -63,14 +76,53 @@ for i in range(N_EXCL):
     AVAILABLE_EXCL_CONNS.put(N_POOL + i)
 
 def is_exclusive_lock(db_index):
-    return db_index >= N_POOL
+    return N_POOL <= db_index < N_POOL + N_EXCL
 
 ID_TO_CONN_LOCK = Lock()
-ID_TO_CONN_INDEX = {}  # btw, this might be a small memory leak, since stuff isn't being taken out.
+ID_TO_CONN_INDEX = {}  # ids that are never closed (crashed callers, etc.) are reaped once they've been idle for IDLE_TTL
+ID_LAST_USED = {}  # db id -> time of its last command (under ID_TO_CONN_LOCK)
+ASSIGNED_COUNTS = [0] * N_CONNECTIONS  # number of db ids on each connection (under ID_TO_CONN_LOCK)
+DIRTY_IDS = set()  # db ids that have written something since their last commit (under ID_TO_CONN_LOCK)
+ID_KWARGS = {}  # db id -> the new_connection kwargs it was assigned with (under ID_TO_CONN_LOCK)
+REAPED_KWARGS = OrderedDict()  # the same for ids reaped while idle, so one that comes back gets the same kind of connection (under ID_TO_CONN_LOCK)
+MAX_REAPED_KWARGS = 10_000  # oldest are dropped past this, so it can't grow forever either
 
 # Note that every id here has a unique cursor, unlike with connections.
 ID_TO_CURR_LOCK = Lock()
 ID_TO_CURR = {}  # this is directly to the object and not the cursor because cursors are not provisioned.
+ID_TO_CURSORS = {}  # db id -> set of its open curr ids (under ID_TO_CURR_LOCK)
+CURR_OWNERS = {}  # curr id -> (db id, connection index) it was made with (under ID_TO_CURR_LOCK)
+CURR_LAST_USED = {}  # curr id -> time of its last use (under ID_TO_CURR_LOCK)
+
+CURR_FINGERPRINTS = {}  # curr id -> (endpoint, fingerprint) of its last statement, to which fetches' serialization is attributed (under ID_TO_CURR_LOCK)
+
+# Timings for the command a thread is running (see query_metrics.py); queue and lock waits go to the next statement recorded
+TIMING = local()
+
+def _timing(name):
+    return getattr(TIMING, name, 0)
+
+def _take_waits():
+    waits = {'queue_wait': _timing('queue_wait'), 'lock_wait': _timing('lock_wait')}
+    TIMING.queue_wait = 0
+    TIMING.lock_wait = 0
+    return waits
+
+IDLE_TTL = 30 * 60  # in seconds; ids and cursors unused for this long are reaped
+REAP_INTERVAL = 60  # in seconds
+
+
+# Should be called with ID_TO_CURR_LOCK
+def _forget_cursor(curr_id):
+    ID_TO_CURR.pop(curr_id, None)
+    CURR_LAST_USED.pop(curr_id, None)
+    CURR_FINGERPRINTS.pop(curr_id, None)
+    owner = CURR_OWNERS.pop(curr_id, None)
+    if owner is not None:
+        open_cursors = ID_TO_CURSORS.get(owner[0], set())
+        open_cursors.discard(curr_id)
+        if not len(open_cursors):
+            ID_TO_CURSORS.pop(owner[0], None)
 
 
 # ----------------------------------------------------
@@ -88,7 +140,17 @@ class DB():
         self.lock = CONNECTION_LOCKS[self.index]
 
     def __enter__(self) -> pymysql.Connection:
-        if self.lock.acquire(timeout=LOCK_TIMEOUT):
+        start = time.time()
+        acquired = self.lock.acquire(timeout=LOCK_TIMEOUT)
+        TIMING.lock_wait = _timing('lock_wait') + time.time() - start
+        if acquired:
+            if CONNECTIONS[self.index] is None or not CONNECTIONS[self.index].open:
+                # Died (or was never made); replaced before anyone gets an error from it
+                try:
+                    self.reconnect()
+                except:
+                    self.lock.release()
+                    raise
             self.db = CONNECTIONS[self.index]
             return self.db
         else:
@@ -99,7 +161,7 @@ class DB():
 
     # This should be done with the lock
     def reconnect(self):
-        CONNECTIONS[self.index] = get_new_conn()
+        CONNECTIONS[self.index] = get_new_conn(self.index)
 
     
 # Something slightly different: since the database locks can be pre-provisioned, it can use ready-made locks.
@@ -117,6 +179,18 @@ class CursorLocks():
             return self.locks[cursor_id]
     def lock(self, id):
         return self.get_lock(id)
+
+    def remove(self, cursor_id):
+        with self.global_lock:
+            self.locks.pop(cursor_id, None)
+
+    # Drops the locks of cursors that aren't in keep (e.g., ones that were asked for with a bad cursor id); returns how many
+    def retain(self, keep):
+        with self.global_lock:
+            gone = [x for x in self.locks if x not in keep]
+            for x in gone:
+                del self.locks[x]
+            return len(gone)
     
 cursor_locks = CursorLocks()
 
@@ -124,101 +198,392 @@ cursor_locks = CursorLocks()
 # ----------------------------------------------------
 
 
+"""
+
+Each connection has its own worker thread and queue; commands for a db id run in order on its connection's worker.
+So a slow query only holds up the ids on its own connection, and new ids go to the least loaded one.
+
+If a connection's worker has been stuck on one command for more than BLOCKED_AFTER seconds, the ids waiting behind it
+that can safely change connections (no open cursors, nothing uncommitted) are moved to another connection, along with their queued commands.
+
+"""
+
+BLOCKED_AFTER = LOCK_TIMEOUT  # in seconds
+MONITOR_INTERVAL = 1  # in seconds
+STATS_KEY = 'pooler_stats'  # where the monitor puts queue depths, etc. (JSON)
+QUERY_STATS_KEY = 'pooler_query_stats'  # and the QUERY_STATS snapshot (JSON), every QUERY_STATS_INTERVAL
+QUERY_STATS_INTERVAL = 10  # in seconds
+
+class ConnectionWorker():
+    index: int
+    items: deque
+    def __init__(self, index) -> None:
+        self.index = index
+        self.items = deque()  # (db_id, func, args, kwargs, time queued)
+        self.cond = Condition()
+        self.running_db_id = None
+        self.busy_since = None
+        Thread(target=self._work, daemon=True).start()
+
+    def submit(self, db_id, func, *args, **kwargs):
+        self.submit_item((db_id, func, args, kwargs, time.time()))
+
+    def submit_item(self, item):
+        with self.cond:
+            self.items.append(item)
+            self.cond.notify()
+
+    # Whether anything is waiting behind the command that's running
+    def has_queued(self):
+        with self.cond:
+            return len(self.items) > 0
+
+    # Queued + running
+    def depth(self):
+        with self.cond:
+            return len(self.items) + (1 if self.busy_since is not None else 0)
+
+    def blocked_for(self):
+        with self.cond:
+            return time.time() - self.busy_since if self.busy_since is not None and len(self.items) else 0
+
+    # Removes and returns the queued commands of the ids for which can_move(db_id) (besides the one running), in order
+    def take_movable(self, can_move):
+        with self.cond:
+            movable = {}
+            for item in self.items:
+                db_id = item[0]
+                if db_id not in movable:
+                    movable[db_id] = db_id != self.running_db_id and can_move(db_id)
+            taken = [x for x in self.items if movable[x[0]]]
+            self.items = deque(x for x in self.items if not movable[x[0]])
+            return taken
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not len(self.items):
+                    self.cond.wait()
+                db_id, func, args, kwargs, queued = self.items.popleft()
+                self.running_db_id = db_id
+                self.busy_since = time.time()
+            TIMING.queue_wait = self.busy_since - queued
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                print(f"Exception in worker for connection {self.index}: {e}", file=sys.stderr)
+            finally:
+                with self.cond:
+                    self.running_db_id = None
+                    self.busy_since = None
+
+WORKERS = [ConnectionWorker(i) for i in range(N_CONNECTIONS)]
+
+
+def least_loaded_index(indices):
+    return min(indices, key=lambda i: (WORKERS[i].depth(), ASSIGNED_COUNTS[i], random.random()))
+
+
+# Sticky: a db id always hashes to the same one
+def consistent_index(db_id):
+    return CONSISTENT_INDICES[zlib.crc32(db_id.encode('utf-8')) % N_CONSISTENT]
+
+
+# Should be called with ID_TO_CONN_LOCK
+def _can_move(db_id):
+    if db_id in DIRTY_IDS:
+        return False
+    with ID_TO_CURR_LOCK:
+        return not len(ID_TO_CURSORS.get(db_id, ()))
+
+
+def move_off_blocked_connections():
+    moved = 0
+    for worker in WORKERS:
+        if is_exclusive_lock(worker.index) or worker.blocked_for() < BLOCKED_AFTER:
+            continue  # exclusive connections only have one id anyway
+        group = [x for x in (SHARED_INDICES, CONSISTENT_INDICES, REPLICA_INDICES) if worker.index in x][0]
+        others = [i for i in group if i != worker.index]
+        if not len(others):
+            continue
+        with ID_TO_CONN_LOCK:  # so nothing new for these ids gets routed in the meantime
+            taken = worker.take_movable(_can_move)
+            new_indices = {}
+            for item in taken:
+                db_id = item[0]
+                if db_id not in new_indices:
+                    new_index = least_loaded_index(others)
+                    new_indices[db_id] = new_index
+                    if ID_TO_CONN_INDEX.get(db_id) == worker.index:
+                        ID_TO_CONN_INDEX[db_id] = new_index
+                        ASSIGNED_COUNTS[worker.index] -= 1
+                        ASSIGNED_COUNTS[new_index] += 1
+                WORKERS[new_indices[db_id]].submit_item(item)
+            moved += len(new_indices)
+        if len(new_indices):
+            print(f"Connection {worker.index} blocked for over {BLOCKED_AFTER} seconds; moved {len(new_indices)} ids off of it.", file=sys.stderr)
+    return moved
+
+
+# Runs on the worker for the cursor's connection, so it doesn't get in the way of anything using the connection
+def reap_cursor(curr_id, index):
+    with ID_TO_CURR_LOCK:
+        curr = ID_TO_CURR.get(curr_id)
+        if curr is None or time.time() - CURR_LAST_USED.get(curr_id, 0) <= IDLE_TTL:
+            return  # closed or used in the meantime
+        _forget_cursor(curr_id)
+    cursor_locks.remove(curr_id)
+    try:
+        with DB(index):
+            curr.close()
+    except Exception as e:
+        print(f"Couldn't close reaped cursor {curr_id}: {e}", file=sys.stderr)
+
+
+# Returns (number of cursors, number of ids) reaped
+def reap_idle():
+    now = time.time()
+    with ID_TO_CURR_LOCK:
+        idle_cursors = [(x, CURR_OWNERS[x]) for x, t in CURR_LAST_USED.items() if now - t > IDLE_TTL and x in CURR_OWNERS]
+    for curr_id, (db_id, index) in idle_cursors:
+        WORKERS[index].submit(db_id, reap_cursor, curr_id, index)
+
+    with ID_TO_CONN_LOCK:
+        idle_ids = [x for x, t in ID_LAST_USED.items() if now - t > IDLE_TTL]
+    n_ids = 0
+    for db_id in idle_ids:
+        with ID_TO_CURR_LOCK:
+            if len(ID_TO_CURSORS.get(db_id, ())):
+                continue  # after its cursors are gone (next time)
+        index = unassign_connection(db_id, idle_for=IDLE_TTL)
+        if index is not None:
+            n_ids += 1
+            if is_exclusive_lock(index):
+                AVAILABLE_EXCL_CONNS.put_nowait(index)
+
+    with ID_TO_CURR_LOCK:
+        live_cursors = set(ID_TO_CURR.keys())
+    cursor_locks.retain(live_cursors)
+
+    return len(idle_cursors), n_ids
+
+
+def monitor_connections():
+    total_moved = 0
+    total_reaped_cursors = 0
+    total_reaped_ids = 0
+    last_reap = time.time()
+    last_query_stats = 0
+    while True:
+        time.sleep(MONITOR_INTERVAL)
+        try:
+            total_moved += move_off_blocked_connections()
+            if time.time() - last_reap > REAP_INTERVAL:
+                last_reap = time.time()
+                n_cursors, n_ids = reap_idle()
+                total_reaped_cursors += n_cursors
+                total_reaped_ids += n_ids
+            stats = {
+                'queue_depths': [w.depth() for w in WORKERS],
+                'assigned_ids': list(ASSIGNED_COUNTS),
+                'blocked': [w.index for w in WORKERS if w.blocked_for() >= BLOCKED_AFTER],
+                'moved_ids': total_moved,
+                'live_ids': len(ID_TO_CONN_INDEX),
+                'live_cursors': len(ID_TO_CURR),
+                'cursor_locks': len(cursor_locks.locks),
+                'reaped_ids': total_reaped_ids,
+                'reaped_cursors': total_reaped_cursors,
+                'time': time.time()
+            }
+            r.set(STATS_KEY, encode_message(stats, codec='json'), ex=MONITOR_INTERVAL * 10)
+            if time.time() - last_query_stats > QUERY_STATS_INTERVAL:
+                last_query_stats = time.time()
+                r.set(QUERY_STATS_KEY, encode_message(QUERY_STATS.snapshot(), codec='json'), ex=QUERY_STATS_INTERVAL * 10)
+        except Exception as e:
+            print(f"Exception in db pooler monitor: {e}", file=sys.stderr)
+
+
+# ----------------------------------------------------
+
+
+LOST_CONNECTION_ERRORS = (CR.CR_CONN_HOST_ERROR, CR.CR_SERVER_GONE_ERROR, CR.CR_SERVER_LOST)
+STATEMENT_OPS = ('cursor_function', 'commit')  # ops that talk to MySQL (the rest only touch the pooler's own state)
+
+
+# Whether e means the connection went away, as opposed to something like a lock wait timeout or a deadlock (which are OperationalErrors too)
+def is_connection_lost(e):
+    if isinstance(e, pymysql.InterfaceError):
+        return True
+    return isinstance(e, pymysql.OperationalError) and len(e.args) > 0 and e.args[0] in LOST_CONNECTION_ERRORS
+
+
+# A command can be run again on a new connection only if the old one was lost and nothing was lost with it:
+# no statement of its own has run yet (ran_ops are the ones that have), and the id had nothing uncommitted
+def can_retry(db_id, e, ran_ops=[]):
+    if not is_connection_lost(e) or any(x['type'] in STATEMENT_OPS for x in ran_ops):
+        return False
+    with ID_TO_CONN_LOCK:
+        return db_id not in DIRTY_IDS
+
+
+def reconnect_id(db_id):
+    db_index = index_of(db_id)
+    with DB(db_index) as db:
+        db.ping(reconnect=True)
+
+
 def command_wrapper(func):
     @wraps(func)
-    def wrapper(response_key, db_id, *args, **kwargs):
+    def wrapper(response_key, db_id, *args, codec='json', **kwargs):
         error_status = False
         error_text = ""
         data = None
+        TIMING.lock_wait = 0
+        TIMING.last_statement = None
         try:
-            data = func(db_id, *args, **kwargs)
-        except (pymysql.OperationalError, pymysql.InterfaceError) as e:
+            touch_id(db_id)
             try:
-                db_index = None
-                with ID_TO_CONN_LOCK:
-                    db_index = ID_TO_CONN_INDEX[db_id]
-                with DB(db_index) as db:
-                    db.ping(reconnect=True)
-                data = func(db_id, *args, **kwargs) # and then retry the thing
-            except Exception as e:
-                error_status = True
-                error_text = f"Error trying to reconnect: {e}"
+                data = func(db_id, *args, **kwargs)
+            except (pymysql.OperationalError, pymysql.InterfaceError) as e:
+                if not can_retry(db_id, e):
+                    raise
+                try:
+                    reconnect_id(db_id)
+                    data = func(db_id, *args, **kwargs) # and then retry the thing
+                except Exception as e:
+                    error_status = True
+                    error_text = f"Error trying to reconnect: {e}"
         except Exception as e:
             error_status = True
             error_text = f"Exception in db pool ({func}): {repr(e)}. DB ID was: {db_id}. Args were: {args}. Kwargs were: {kwargs}."
         finally:
-            r.rpush(response_key, json.dumps({
+            start = time.time()
+            message = encode_message({
                 'error_status': error_status,
                 'error_text': error_text,
-                'data': make_json_serializable(data)
-            }))  # apparently thread safe
+                'data': data
+            }, codec=codec)
+            last_statement = _timing('last_statement')
+            if last_statement:
+                QUERY_STATS.record(*last_statement, count=0, serialization=time.time() - start)
+            TIMING.queue_wait = 0
+            r.rpush(response_key, message)  # apparently thread safe; answered in the codec the command came in
 
     return wrapper
 
 
-def release_exclusive_connection(db_id):
+def touch_id(db_id):
     with ID_TO_CONN_LOCK:
+        if db_id in ID_TO_CONN_INDEX:
+            ID_LAST_USED[db_id] = time.time()
+
+
+# With idle_for (reaping), only if db_id hasn't been used in that many seconds and has nothing uncommitted:
+# reaping a dirty id would leave its writes on the connection for whichever id commits next, so it waits for them to be committed (see commit_db).
+# Returns the index it had (None if it wasn't unassigned)
+def unassign_connection(db_id, idle_for=None):
+    with ID_TO_CONN_LOCK:
+        if idle_for is not None:
+            if time.time() - ID_LAST_USED.get(db_id, 0) <= idle_for or db_id in DIRTY_IDS:
+                return None
         index = ID_TO_CONN_INDEX.pop(db_id, None)
+        if index is not None:
+            ASSIGNED_COUNTS[index] -= 1
+        kwargs = ID_KWARGS.pop(db_id, None)
+        if idle_for is not None and kwargs is not None:
+            REAPED_KWARGS[db_id] = kwargs
+            while len(REAPED_KWARGS) > MAX_REAPED_KWARGS:
+                REAPED_KWARGS.popitem(last=False)
+        ID_LAST_USED.pop(db_id, None)
+        DIRTY_IDS.discard(db_id)
+    return index
+
+
+def release_exclusive_connection(db_id):
+    index = unassign_connection(db_id)
     if index is not None and is_exclusive_lock(index):
         AVAILABLE_EXCL_CONNS.put_nowait(index)
 
 
 # Not really making a "new" connection, rather just assigning a db_id to something in the pool.
-@command_wrapper
-def make_new_connection(db_id, kwargs):
-    index = random.randrange(0, N_POOL)
-    
-    if 'read_only' in kwargs:
-        # TODO
-        pass
+# Does nothing if db_id already has one.
+def assign_connection(db_id, kwargs):
+    with ID_TO_CONN_LOCK:
+        if db_id in ID_TO_CONN_INDEX:
+            return
+
     if 'exclusive' in kwargs and kwargs['exclusive']:
         try:
             index = AVAILABLE_EXCL_CONNS.get(timeout=LOCK_TIMEOUT)
         except Empty:
             raise Exception("No available exclusive connections within the timeout period")
         Timer(LOCK_TIMEOUT, release_exclusive_connection, args=[db_id]).start()
-    # A consistent new connection always gives the same connection across ProxyDB connections
+    # Consistent connections are spread over a few connections, always the same one for a db id
     elif 'consistent' in kwargs and kwargs['consistent']:
-        index = N_POOL - 1
+        index = consistent_index(db_id)
+    # Without any replicas, read-only connections are just like the others
+    elif 'read_only' in kwargs and kwargs['read_only'] and len(REPLICA_INDICES):
+        index = least_loaded_index(REPLICA_INDICES)
+    else:
+        index = least_loaded_index(SHARED_INDICES)
 
-    # give a random connection
     with ID_TO_CONN_LOCK:
         ID_TO_CONN_INDEX[db_id] = index
+        ID_KWARGS[db_id] = kwargs
+        ID_LAST_USED[db_id] = time.time()
+        ASSIGNED_COUNTS[index] += 1
 
+
+# The connection index of db_id. An id without one (reaped for being idle, e.g. a long-lived ProxyDB in a worker) is assigned one again,
+# of the same kind it had; only exclusivity isn't given back, since exclusive connections are only lent out briefly anyway.
+def index_of(db_id):
+    with ID_TO_CONN_LOCK:
+        index = ID_TO_CONN_INDEX.get(db_id)
+        kwargs = REAPED_KWARGS.pop(db_id, {}) if index is None else None
+    if index is not None:
+        return index
+    assign_connection(db_id, {**kwargs, 'exclusive': False})
+    with ID_TO_CONN_LOCK:
+        return ID_TO_CONN_INDEX[db_id]
+
+
+@command_wrapper
+def make_new_connection(db_id, kwargs):
+    assign_connection(db_id, kwargs)
     return True
 
 
+# An id that's already gone (e.g., reaped) counts as closed
 @command_wrapper
 def close_connection(db_id):
     with ID_TO_CONN_LOCK:
-        index = ID_TO_CONN_INDEX[db_id]
+        index = ID_TO_CONN_INDEX.get(db_id)
+        REAPED_KWARGS.pop(db_id, None)
     if index is not None:
         if is_exclusive_lock(index):
             release_exclusive_connection(db_id)  # does the popping here
         else:
-            with ID_TO_CONN_LOCK:
-                ID_TO_CONN_INDEX.pop(db_id)
+            unassign_connection(db_id)
     return True
 
 
 @command_wrapper
 def make_new_cursor(db_id, curr_id):
-    db_index = None
-    with ID_TO_CONN_LOCK:
-        db_index = ID_TO_CONN_INDEX[db_id]  # Find the appropriate index, so we can get the lock
+    db_index = index_of(db_id)  # Find the appropriate index, so we can get the lock
     
     with DB(db_index) as db:
         curr = db.cursor()
         with ID_TO_CURR_LOCK:
             ID_TO_CURR[curr_id] = curr
+            ID_TO_CURSORS.setdefault(db_id, set()).add(curr_id)
+            CURR_OWNERS[curr_id] = (db_id, db_index)
+            CURR_LAST_USED[curr_id] = time.time()
     return True
 
 
 @command_wrapper
 def escape_string(db_id, args) -> None:
-    db_index = None
-    with ID_TO_CONN_LOCK:
-        db_index = ID_TO_CONN_INDEX[db_id]  # Find the appropriate index, so we can get the lock
+    db_index = index_of(db_id)  # Find the appropriate index, so we can get the lock
     
     with DB(db_index) as db:
         escaped = db.escape_string(*args)
@@ -228,21 +593,22 @@ def escape_string(db_id, args) -> None:
 
 @command_wrapper
 def commit_db(db_id) -> None:
-    db_index = None
-    with ID_TO_CONN_LOCK:
-        db_index = ID_TO_CONN_INDEX[db_id]
+    db_index = index_of(db_id)
     with DB(db_index) as db:
         db.commit()
+    # The commit is for the whole connection, so it took any other id's writes on it along too
+    with ID_TO_CONN_LOCK:
+        DIRTY_IDS.difference_update([x for x in DIRTY_IDS if ID_TO_CONN_INDEX.get(x) == db_index])
+        DIRTY_IDS.discard(db_id)
     return True
 
 
 # 'do_call' arg = this is a function, push the result of the function call to Redis.
 @command_wrapper
-def use_cursor(db_id, do_call: bool, curr_id, name, args, kwargs) -> None:
+# endpoint is the server endpoint that sent it (for query_metrics)
+def use_cursor(db_id, do_call: bool, curr_id, name, args, kwargs, endpoint=None) -> None:
     
-    db_index = None
-    with ID_TO_CONN_LOCK:
-        db_index = ID_TO_CONN_INDEX[db_id]  # Find the appropriate index, so we can get the lock
+    db_index = index_of(db_id)  # Find the appropriate index, so we can get the lock
     
     result = None
     with DB(db_index):  # We have the lock for the connection
@@ -251,19 +617,196 @@ def use_cursor(db_id, do_call: bool, curr_id, name, args, kwargs) -> None:
             curr = None
             with ID_TO_CURR_LOCK:
                 curr = ID_TO_CURR[curr_id]
+                CURR_LAST_USED[curr_id] = time.time()
             attr = getattr(curr, name)
             if do_call:
+                start = time.time()
                 result = attr(*args, **kwargs)
+                if name in ('execute', 'executemany') and len(args):
+                    fp = fingerprint(args[0])
+                    QUERY_STATS.record(endpoint, fp, sql=args[0], execution=time.time() - start, **_take_waits())
+                    with ID_TO_CURR_LOCK:
+                        CURR_FINGERPRINTS[curr_id] = (endpoint, fp)
+                with ID_TO_CURR_LOCK:
+                    TIMING.last_statement = CURR_FINGERPRINTS.get(curr_id)
             else:
                 result = attr
             # If we're closing the cursor, also remove it from ID_TO_CURR
             if name == 'close':
                 with ID_TO_CURR_LOCK:
-                    del ID_TO_CURR[curr_id]
+                    _forget_cursor(curr_id)
+    if name == 'close':
+        cursor_locks.remove(curr_id)
+
+    # Anything but a plain read could leave something uncommitted on this connection
+    if is_write(name, args):
+        with ID_TO_CONN_LOCK:
+            DIRTY_IDS.add(db_id)
 
             
     return result
 
+class BatchError(Exception):
+    def __init__(self, index, op, cause) -> None:
+        self.index = index  # of the op that failed
+        self.cause = cause
+        super().__init__(f"Command {index} ({op['type']} {op.get('name', '')}) of batch failed: {repr(cause)}. Args were: {op.get('args', [])}.")
+
+
+# Runs a sequence of commands (in the same format as the messages) in order, in one go; returns the list of their results.
+# Stops at the first error, which becomes the error for the whole batch; ops before it aren't run again.
+# The only retry is on a new connection, when the old one was lost before any statement ran (see can_retry), and it picks up at the op that failed.
+@command_wrapper
+def run_batch(db_id, ops) -> list:
+    results = []
+    retried = False
+    while True:
+        try:
+            _run_ops(db_id, ops, results)
+            return results
+        except BatchError as e:
+            if retried or not can_retry(db_id, e.cause, ops[:e.index]):
+                _run_closes(db_id, ops[e.index + 1:])
+                raise
+            retried = True
+            reconnect_id(db_id)
+
+
+# Runs the ops after the ones already in results, appending their results; raises BatchError for the first that fails
+def _run_ops(db_id, ops, results) -> list:
+    for i in range(len(results), len(ops)):
+        op = ops[i]
+        try:
+            results.append(_run_op(db_id, op))
+        except Exception as e:
+            raise BatchError(i, op, e)
+    return results
+
+
+def _run_op(db_id, op):
+    op_type = op['type']
+    name = op.get('name', '')
+    args = op.get('args', [])
+    kwargs = op.get('kwargs', {})
+    curr_id = op.get('curr_id')
+    # __wrapped__ = without command_wrapper (which would push a response of its own)
+    if op_type == 'new_connection':
+        return make_new_connection.__wrapped__(db_id, kwargs)
+    elif op_type == 'close_connection':
+        return close_connection.__wrapped__(db_id)
+    elif op_type == 'new_cursor':
+        return make_new_cursor.__wrapped__(db_id, curr_id)
+    elif op_type == 'commit':
+        return commit_db.__wrapped__(db_id)
+    elif op_type == 'escape_string':
+        return escape_string.__wrapped__(db_id, args)
+    elif op_type == 'cursor_function':
+        return use_cursor.__wrapped__(db_id, True, curr_id, name, args, kwargs, endpoint=op.get('endpoint'))
+    elif op_type == 'cursor_attribute':
+        return use_cursor.__wrapped__(db_id, False, curr_id, name, args, kwargs, endpoint=op.get('endpoint'))
+    raise Exception(f"Unknown command type {op_type}")
+
+
+# After a batch fails, the cursor and connection closes queued behind the failing op still run, so nothing is left open (statements and commits don't)
+def _run_closes(db_id, ops):
+    for op in ops:
+        if op['type'] == 'close_connection' or (op['type'] == 'cursor_function' and op.get('name') == 'close'):
+            try:
+                _run_op(db_id, op)
+            except Exception as e:
+                print(f"Couldn't run {op['type']} {op.get('name', '')} after a failed batch for {db_id}: {e}", file=sys.stderr)
+
+
+STREAM_KEY_TTL = 5 * 60  # in seconds; rows nobody reads don't stay in Redis forever
+STREAM_MAX_QUEUED = 4  # batches waiting in Redis for the client; past this, the pooler waits for it to read some
+STREAM_MAX_PAUSE = 30  # in seconds; how long one wait for the client can be before backpressure is given up on
+STREAM_POLL_INTERVAL = .05  # in seconds
+
+# Runs query with a server-side (unbuffered) cursor and pushes the rows onto response_key as they're read, batch_size at a time.
+# Each batch is a message like the usual response, with 'more': True; the last message has 'more': False and the row count as data.
+# Any deferred ops that came with it run first. The client can stop it early by setting f"{response_key}:stop".
+# Backpressure: once STREAM_MAX_QUEUED batches are waiting, no more are read until the client takes one,
+# so at most about (STREAM_MAX_QUEUED + 1) * batch_size rows are in Redis and this process at a time.
+# The connection is held while paused, though, so as soon as any other command is queued for it (which may be the client's own, on the same db id),
+# or the client hasn't read anything for STREAM_MAX_PAUSE, the rest of the rows are pushed without waiting, as if there were no backpressure.
+def stream_query(response_key, db_id, query, query_args, batch_size, ops, codec='json', endpoint=None):
+    error_status = False
+    error_text = ""
+    n_rows = 0
+    fp = fingerprint(query)
+    TIMING.lock_wait = 0
+
+    backpressure = True
+
+    # Returns whether the client asked to stop; with worker (the one running this), waits for the client as described above
+    def push(message, worker: ConnectionWorker=None):
+        nonlocal backpressure
+        start = time.time()
+        encoded = encode_message(message, codec=codec)
+        QUERY_STATS.record(endpoint, fp, count=0, serialization=time.time() - start)
+        pipe = r.pipeline()
+        pipe.rpush(response_key, encoded)
+        pipe.expire(response_key, STREAM_KEY_TTL)
+        pipe.exists(f"{response_key}:stop")
+        queued, _, stopped = pipe.execute()
+        paused_since = time.time()
+        while worker is not None and backpressure and not stopped and queued > STREAM_MAX_QUEUED:
+            if worker.has_queued() or time.time() - paused_since > STREAM_MAX_PAUSE:
+                backpressure = False
+                break
+            time.sleep(STREAM_POLL_INTERVAL)
+            pipe = r.pipeline()
+            pipe.llen(response_key)
+            pipe.exists(f"{response_key}:stop")
+            queued, stopped = pipe.execute()
+        return stopped
+
+    results = []  # of ops; a retry picks up after the ones that ran
+
+    def run():
+        nonlocal n_rows
+        _run_ops(db_id, ops, results)
+        touch_id(db_id)
+        db_index = index_of(db_id)
+        with DB(db_index) as db:
+            curr = db.cursor(pymysql.cursors.SSDictCursor)
+            try:
+                start = time.time()
+                curr.execute(query, query_args)
+                QUERY_STATS.record(endpoint, fp, sql=query, execution=time.time() - start, **_take_waits())
+                while True:
+                    rows = curr.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    n_rows += len(rows)
+                    stopped = push({'error_status': False, 'error_text': "", 'data': rows, 'more': True}, worker=WORKERS[db_index])
+                    if stopped:
+                        break
+            finally:
+                curr.close()  # reads (and drops) whatever's left of the result, freeing the connection
+
+    try:
+        retried = False
+        while True:
+            try:
+                run()
+                break
+            except BatchError as e:
+                if retried or not can_retry(db_id, e.cause, ops[:e.index]):
+                    _run_closes(db_id, ops[e.index + 1:])
+                    raise
+            except (pymysql.OperationalError, pymysql.InterfaceError) as e:
+                # Same as for a batch, and rows that were already pushed can't be taken back
+                if retried or n_rows or not can_retry(db_id, e, ops):
+                    raise
+            retried = True
+            reconnect_id(db_id)
+    except Exception as e:
+        error_status = True
+        error_text = f"Exception in db pool (stream_query): {repr(e)}. DB ID was: {db_id}. Query was: {query}. Args were: {query_args}."
+    finally:
+        push({'error_status': error_status, 'error_text': error_text, 'data': n_rows, 'more': False})
+
 # ----------------------------------------------------
 
 def clean_up():
@@ -289,11 +832,23 @@ atexit.register(clean_up)
 def listen_for_commands():
     print("The db pooler is listening...")
     MAX_THREADS = 10
+    Thread(target=monitor_connections, daemon=True).start()
     with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
+
+        # Commands run on the worker for their id's connection, in order; ones for ids without a connection (an error, or an exclusive one that's still being assigned) go to the executor
+        def submit(db_id, func, *args, **kwargs):
+            with ID_TO_CONN_LOCK:
+                index = ID_TO_CONN_INDEX.get(db_id)
+                if index is not None:
+                    ID_LAST_USED[db_id] = time.time()  # so it isn't reaped while its command waits in the queue
+                    WORKERS[index].submit(db_id, func, *args, **kwargs)
+                    return
+            executor.submit(func, *args, **kwargs)
+
         while True:
             try:
                 _, message = r.blpop('sql_queue')  # blocking
-                command = json.loads(message)
+                command, codec = decode_message(message)
                 command_type = command['type']
                 command_name = command['name']
                 args = command.get('args', [])
@@ -302,20 +857,33 @@ def listen_for_commands():
                 curr_id = command['curr_id']
                 response_key = command['response_key']
 
+                # Non-exclusive connections are assigned right away (it's quick), so that the command can go straight to its worker
+                new_conn_kwargs = None
+                if command_type == 'new_connection':
+                    new_conn_kwargs = kwargs
+                elif command_type in ('batch', 'stream') and len(command.get('ops', [])) and command['ops'][0]['type'] == 'new_connection':
+                    new_conn_kwargs = command['ops'][0].get('kwargs', {})
+                if new_conn_kwargs is not None and not new_conn_kwargs.get('exclusive'):
+                    assign_connection(db_id, new_conn_kwargs)
+
                 if command_type == 'new_connection':
-                    executor.submit(make_new_connection, response_key, db_id, kwargs)
+                    submit(db_id, make_new_connection, response_key, db_id, kwargs, codec=codec)
                 elif command_type == 'close_connection':
-                    executor.submit(close_connection, response_key, db_id)
+                    submit(db_id, close_connection, response_key, db_id, codec=codec)
                 elif command_type == 'new_cursor':
-                    executor.submit(make_new_cursor, response_key, db_id, curr_id)
+                    submit(db_id, make_new_cursor, response_key, db_id, curr_id, codec=codec)
                 elif command_type == 'commit':
-                    executor.submit(commit_db, response_key, db_id)
+                    submit(db_id, commit_db, response_key, db_id, codec=codec)
                 elif command_type == 'escape_string':
-                    executor.submit(escape_string, response_key, db_id, args)
+                    submit(db_id, escape_string, response_key, db_id, args, codec=codec)
                 elif command_type == 'cursor_function':
-                    executor.submit(use_cursor, response_key, db_id, True, curr_id, command_name, args, kwargs)
+                    submit(db_id, use_cursor, response_key, db_id, True, curr_id, command_name, args, kwargs, endpoint=command.get('endpoint'), codec=codec)
                 elif command_type == 'cursor_attribute':
-                    executor.submit(use_cursor, response_key, db_id, False, curr_id, command_name, args, kwargs)
+                    submit(db_id, use_cursor, response_key, db_id, False, curr_id, command_name, args, kwargs, endpoint=command.get('endpoint'), codec=codec)
+                elif command_type == 'batch':
+                    submit(db_id, run_batch, response_key, db_id, command['ops'], codec=codec)
+                elif command_type == 'stream':
+                    submit(db_id, stream_query, response_key, db_id, args[0], args[1], kwargs['batch_size'], command.get('ops', []), codec=codec, endpoint=command.get('endpoint'))
             except Exception as e:
                 print(f"Exception occurred in DB pooler main loop: {e}", file=sys.stderr)
 
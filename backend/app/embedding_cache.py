@@ -0,0 +1,124 @@
+import numpy as np
+import hashlib
+import base64
+import sys
+from .db import needs_db, ProxyDB
+from .locks import acquire_lock, release_lock
+from .configs.user_config import EMBEDDING_CACHE_RETENTION_DAYS
+
+"""
+
+Content-addressed store of chunk embeddings, in the embedding_cache table.
+
+Entries are keyed by (embedding_fn_code, sha256 of the text), so they're shared by every resource/asset:
+when a retriever is remade because a document changed (e.g., a paragraph was added to a text editor doc),
+only the chunks whose text is new need to go to the embedding provider.
+
+Embeddings are stored as base64'd float32 bytes (a MEDIUMTEXT column, which both pooler codecs and the direct pool carry as is), exactly as the provider gave them (not normalized).
+
+Lookups keep time_last_used current (at most once a day per entry), and prune_embedding_cache (run on a schedule, see create_app)
+deletes entries nobody has used in EMBEDDING_CACHE_RETENTION_DAYS, which includes those of deleted documents.
+
+"""
+
+LOOKUP_BATCH_SIZE = 500
+PRUNE_BATCH_SIZE = 5000
+PRUNE_LOCK = 'embedding_cache_prune'
+
+
+def text_hash(txt):
+    return hashlib.sha256(txt.encode('utf-8')).hexdigest()
+
+
+# Returns {text hash: np.array} for the hashes that are stored
+@needs_db
+def get_cached_embeddings(embedding_fn_code, hashes, db: ProxyDB=None):
+    found = {}
+    hashes = list(set(hashes))
+    curr = db.cursor()
+    for start in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+        sql = """
+            SELECT `text_hash`, `embedding` FROM embedding_cache
+            WHERE `embedding_fn_code`=%s AND `text_hash` IN %s
+        """
+        curr.execute(sql, (embedding_fn_code, tuple(hashes[start:start+LOOKUP_BATCH_SIZE])))
+        hits = []
+        for row in curr.fetchall():
+            found[row['text_hash']] = np.frombuffer(base64.b64decode(row['embedding']), dtype=np.float32)
+            hits.append(row['text_hash'])
+        if len(hits):
+            sql = """
+                UPDATE embedding_cache SET `time_last_used`=CURRENT_TIMESTAMP
+                WHERE `embedding_fn_code`=%s AND `text_hash` IN %s AND `time_last_used` < (NOW() - INTERVAL 1 DAY)
+            """
+            curr.execute(sql, (embedding_fn_code, tuple(hits)))
+    return found
+
+
+# Deletes entries unused for retention_days, a batch at a time; returns how many.
+# Only one process does it at once (the others skip it).
+@needs_db
+def prune_embedding_cache(retention_days=EMBEDDING_CACHE_RETENTION_DAYS, db: ProxyDB=None):
+    if acquire_lock(PRUNE_LOCK, timeout=0) is None:
+        return 0
+    try:
+        total = 0
+        curr = db.cursor()
+        while True:
+            sql = """
+                DELETE FROM embedding_cache
+                WHERE `time_last_used` < (NOW() - INTERVAL %s DAY)
+                LIMIT %s
+            """
+            curr.execute(sql, (int(retention_days), PRUNE_BATCH_SIZE))
+            n = curr.rowcount
+            db.commit(close_cursors=False)
+            total += n
+            if n < PRUNE_BATCH_SIZE:
+                return total
+    finally:
+        release_lock(PRUNE_LOCK)
+
+
+# hashes and embeddings are matched
+@needs_db
+def put_cached_embeddings(embedding_fn_code, hashes, embeddings, db: ProxyDB=None):
+    if not len(hashes):
+        return
+    curr = db.cursor()
+    sql = """
+        INSERT IGNORE INTO embedding_cache (`embedding_fn_code`, `text_hash`, `embedding`)
+        VALUES (%s, %s, %s)
+    """
+    rows = [(embedding_fn_code, h, base64.b64encode(np.asarray(emb, dtype=np.float32).tobytes()).decode('ascii')) for h, emb in zip(hashes, embeddings)]
+    curr.executemany(sql, rows)
+    db.commit()
+
+
+# Embeds texts, only calling embed_fn (texts -> 2D array) on the ones that aren't already stored.
+# If the table can't be reached, everything is just embedded.
+def embed_with_cache(embedding_fn_code, texts, embed_fn):
+    hashes = [text_hash(x) for x in texts]
+    try:
+        found = get_cached_embeddings(embedding_fn_code, hashes, new_conn=True)
+    except Exception as e:
+        print(f"Couldn't read embedding cache: {e}", file=sys.stderr)
+        found = {}
+
+    # Each new text is embedded once, even if it appears more than once
+    to_embed = {}
+    for h, txt in zip(hashes, texts):
+        if h not in found and h not in to_embed:
+            to_embed[h] = txt
+
+    if len(to_embed):
+        new_hashes = list(to_embed.keys())
+        new_embeddings = np.asarray(embed_fn([to_embed[h] for h in new_hashes]), dtype=np.float32)
+        for h, emb in zip(new_hashes, new_embeddings):
+            found[h] = emb
+        try:
+            put_cached_embeddings(embedding_fn_code, new_hashes, new_embeddings, new_conn=True)
+        except Exception as e:
+            print(f"Couldn't write to embedding cache: {e}", file=sys.stderr)
+
+    return np.array([found[h] for h in hashes], dtype=np.float32)
@@ -16,6 +16,10 @@ class ZipFileRetrieverError(Exception):
     def __init__(self, message="Zip files are not allowed to be retrieved from."):
         super().__init__(message)
 
+class JobMismatchError(Exception):
+    def __init__(self, message="The asset's content or the job's options changed since the job started, so its stored results can't be reused."):
+        super().__init__(message)
+
 class UserIsNoneError(Exception):
     def __init__(self, message="User must not be None for this action."):
         super().__init__(message)
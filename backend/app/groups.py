@@ -3,7 +3,7 @@ from flask import (
     request
 )
 from flask_cors import cross_origin
-from .db import get_db, needs_db, ProxyDB
+from .db import get_db, needs_db, ProxyDB, fetch_page_with_total
 from .template_response import MyResponse
 from .auth import token_optional, User, get_permissioning_string, token_required
 from .configs.str_constants import PREVIEW_FILE
@@ -98,13 +98,20 @@ def search_groups(user: User, search, offset, limit, ids=None, get_total=True, i
     if not include_hidden:
         permissioning_clause += " AND (a.hidden IS NULL OR a.hidden != 1)"
 
-    sql = f"""
+    body = f"""
         WITH a as (
             {search_clause}
         )
-        SELECT SQL_CALC_FOUND_ROWS DISTINCT a.*
+        SELECT DISTINCT a.*
         FROM a
         {permissioning_clause}
+        """
+    if get_total:
+        # Counted in the same statement (see fetch_page_with_total), rather than with SQL_CALC_FOUND_ROWS + FOUND_ROWS() (which needs an exclusive connection, and so the primary)
+        return fetch_page_with_total(curr, body, order_by_clause, limit, offset)
+
+    sql = f"""
+        {body}
         ORDER BY {order_by_clause}
         LIMIT {limit}
         OFFSET {offset}
@@ -113,12 +120,7 @@ def search_groups(user: User, search, offset, limit, ids=None, get_total=True, i
     curr.execute(sql)
     results = curr.fetchall()
 
-    total = 0
-    if get_total:
-        curr.execute("SELECT FOUND_ROWS()")
-        total = curr.fetchone()['FOUND_ROWS()']
-
-    return results, total
+    return results, 0
 
 
 # Adds a "needs_purchase" column to the group stating whether the user doesn't have access and thus needs to purchase (can only be 1 if include_products=True)
@@ -201,16 +203,16 @@ def manifest(user: User):
     else:
         get_total = True
 
-    results, total = search_groups(user, search, offset, limit, get_total=get_total, exclusive_conn=get_total)
+    results, total = search_groups(user, search, offset, limit, get_total=get_total, read_only=True)
     resp = {'results': results}
     if get_total:
         resp['total'] = total
 
     prepend_products_limit = request.args.get('prepend_products_limit', 0, type=int)
     if prepend_products_limit:
-        inclusive, _ = search_groups(user, search, 0, prepend_products_limit, get_total=False, iff_for_sale=True)
+        inclusive, _ = search_groups(user, search, 0, prepend_products_limit, get_total=False, iff_for_sale=True, read_only=True)
         if inclusive and len(inclusive):
-            exclusive, _ = search_groups(user, search, 0, prepend_products_limit, ids=[x['id'] for x in inclusive], get_total=False, include_for_sale=True)
+            exclusive, _ = search_groups(user, search, 0, prepend_products_limit, ids=[x['id'] for x in inclusive], get_total=False, include_for_sale=True, read_only=True)
             for_sale = [x for x in inclusive if x['id'] not in [y['id'] for y in exclusive]]  # could make this better with sets?
             for i in range(len(for_sale)):
                 for_sale[i]['needs_purchase'] = True
@@ -3,15 +3,26 @@ from ..configs.secrets import OPENAI_API_KEY, OPENAI_COMPATIBLE_KEY
 from ..configs.settings import SETTINGS
 import requests
 from ..utils import fix_openai_compatible_url
+from ..configs.user_config import EMBED_CACHE_MAX_ENTRIES, EMBED_CACHE_TTL, EMBED_CACHE_USE_REDIS
+from ..configs.conn_config import EMBED_CACHE_CONNECTION_PARAMS
 os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY if OPENAI_API_KEY else ""
 from openai import OpenAI
 openai_client = OpenAI() if OPENAI_API_KEY else None
 import sys
+import time
+import hashlib
+import redis
+import numpy as np
+from collections import OrderedDict
+from threading import Lock
 
 class Embed():
-    def __init__(self, model, code) -> None:
+    def __init__(self, model, code, max_concurrency=4, max_batch_size=500, max_batch_tokens=None) -> None:
         self.model = model
         self.code = code
+        self.max_concurrency = max_concurrency  # requests to have in flight at once when embedding many texts
+        self.max_batch_size = max_batch_size  # texts per request
+        self.max_batch_tokens = max_batch_tokens  # (estimated) tokens per request; None = no limit
 
     # Takes list of texts (strings) and returns an array of embeddings (i.e., list of lists)
     def embed(self, texts):
@@ -58,6 +69,138 @@ class OpenAICompatibleEmbed(Embed):
         return [y['embedding'] for y in my_json['data']]
 
 
+"""
+
+Embedding cache, wrapped around every Embed in EMBED_PROVIDERS.
+
+Queries, suggested questions, web search context, etc. are often embedded again seconds after the first time.
+Cached embeddings are looked up by model code + sha256 of the text: first in an in-process LRU, then (optionally) in redis, shared by all processes.
+Entries expire after EMBED_CACHE_TTL either way.
+
+It's only meant for those small embeds. Documents' chunks go through BULK_EMBED_PROVIDERS, which skip it
+(a big upload would push every query out of the LRU and fill redis); they have their own cache in MySQL (see embedding_cache.py).
+
+"""
+class EmbedCache():
+    def __init__(self, max_entries, ttl, use_redis=False) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = OrderedDict()  # key -> (expires at, embedding), least recently used first
+        self.redis = redis.Redis(**EMBED_CACHE_CONNECTION_PARAMS) if use_redis else None
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(code, text):
+        return f"embed:{code}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    # Returns a list matching keys, with None for misses
+    def get_many(self, keys):
+        found = [None] * len(keys)
+        now = time.time()
+        with self.lock:
+            for i, key in enumerate(keys):
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                if entry[0] < now:
+                    del self.entries[key]
+                    continue
+                self.entries.move_to_end(key)
+                found[i] = entry[1]
+
+        missing = [i for i, x in enumerate(found) if x is None]
+        if self.redis is not None and len(missing):
+            try:
+                values = self.redis.mget([keys[i] for i in missing])
+                from_redis = []
+                for i, val in zip(missing, values):
+                    if val is not None:
+                        found[i] = np.frombuffer(val, dtype=np.float32).tolist()
+                        from_redis.append(i)
+                self._put_local([keys[i] for i in from_redis], [found[i] for i in from_redis])
+                with self.lock:
+                    self.redis_hits += len(from_redis)
+            except redis.RedisError as e:
+                print(f"Embedding cache couldn't reach redis: {e}", file=sys.stderr)
+
+        n_found = sum(x is not None for x in found)
+        with self.lock:
+            self.hits += n_found
+            self.misses += len(keys) - n_found
+        return found
+
+    def put_many(self, keys, embeddings):
+        self._put_local(keys, embeddings)
+        if self.redis is not None and len(keys):
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for key, emb in zip(keys, embeddings):
+                    pipe.set(key, np.asarray(emb, dtype=np.float32).tobytes(), ex=self.ttl)
+                pipe.execute()
+            except redis.RedisError as e:
+                print(f"Embedding cache couldn't reach redis: {e}", file=sys.stderr)
+
+    def _put_local(self, keys, embeddings):
+        if self.max_entries <= 0:
+            return
+        expires = time.time() + self.ttl
+        with self.lock:
+            for key, emb in zip(keys, embeddings):
+                self.entries[key] = (expires, emb)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'redis_hits': self.redis_hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0
+            }
+
+
+EMBED_CACHE = EmbedCache(EMBED_CACHE_MAX_ENTRIES, EMBED_CACHE_TTL, use_redis=EMBED_CACHE_USE_REDIS)
+
+
+# Goes in front of an Embed, so that only texts missing from the cache get sent to the provider
+class CachedEmbed(Embed):
+    def __init__(self, inner: Embed, cache: EmbedCache) -> None:
+        super().__init__(inner.model, inner.code, max_concurrency=inner.max_concurrency, max_batch_size=inner.max_batch_size, max_batch_tokens=inner.max_batch_tokens)
+        self.inner = inner
+        self.cache = cache
+
+    def embed(self, texts):
+        keys = [self.cache.make_key(self.code, x) for x in texts]
+        embeddings = self.cache.get_many(keys)
+
+        # Repeated texts only get embedded once
+        missing = {}
+        for i, key in enumerate(keys):
+            if embeddings[i] is None:
+                missing.setdefault(key, []).append(i)
+
+        if len(missing):
+            missing_keys = list(missing.keys())
+            new_embeddings = self.inner.embed([texts[missing[key][0]] for key in missing_keys])
+            if len(new_embeddings) != len(missing_keys):
+                raise Exception(f"Embedding model {self.code} returned {len(new_embeddings)} embeddings for {len(missing_keys)} texts")
+            for key, emb in zip(missing_keys, new_embeddings):
+                for i in missing[key]:
+                    embeddings[i] = emb
+            # A bad (e.g., empty) embedding shouldn't get stuck in the cache
+            good = [(key, emb) for key, emb in zip(missing_keys, new_embeddings) if emb is not None and len(emb)]
+            self.cache.put_many([x[0] for x in good], [x[1] for x in good])
+
+        return embeddings
+
+
 PROVIDER_TO_EMBED = {
     'ollama': OllamaEmbed,
     'openai': OpenAIEmbed,
@@ -81,6 +224,9 @@ embeds:
     - provider: openai  # required
       model: "text-embedding-ada-002"  # required
       code: "ada-2"  # optional
+      max_concurrency: 4  # optional - parallel requests when embedding a document
+      max_batch_size: 500  # optional - texts per request
+      max_batch_tokens: 250000  # optional - estimated tokens per request
 
 """
 def generate_embeds():
@@ -96,12 +242,16 @@ def generate_embeds():
         obj = provider_class(
             model=model,
             code=code,
+            max_concurrency=embed.get('max_concurrency', 4),
+            max_batch_size=embed.get('max_batch_size', 500),
+            max_batch_tokens=embed.get('max_batch_tokens', None)
         )
-        to_return[code] = obj
+        to_return[code] = CachedEmbed(obj, EMBED_CACHE)
     return to_return
 
 
 EMBED_PROVIDERS = generate_embeds()
+BULK_EMBED_PROVIDERS = {code: embed.inner for code, embed in EMBED_PROVIDERS.items()}  # without the query cache, for documents' chunks
 
 def generate_default():
     default = SETTINGS['embeds']['default'] if 'default' in SETTINGS['embeds'] else ""
@@ -2,18 +2,372 @@ from ..configs.secrets import OPENAI_API_KEY, ANTHROPIC_API_KEY, OPENAI_COMPATIB
 from ..configs.settings import SETTINGS
 from ..utils import extract_from_base64_url
 from ..utils import fix_openai_compatible_url
+from ..configs.conn_config import LM_CACHE_CONNECTION_PARAMS
 import os
 import requests
+import httpx
+import redis
+import asyncio
+import concurrent.futures
+import functools
+import inspect
+import hashlib
+import threading
+import time
+import weakref
+import collections
 import json
 import sys
+import queue
+import selectors
+import _thread
 
 os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY if OPENAI_API_KEY else ""
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 openai_client = OpenAI() if OPENAI_API_KEY else None
 import anthropic
 client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY) if ANTHROPIC_API_KEY else None
 
 
+"""
+
+Connections to LM APIs are pooled and kept alive, rather than opened for every call.
+
+Sync calls (run, stream) use one requests.Session per API url.
+Async calls (arun, astream) use one async client per API and event loop (they can't be shared across loops).
+Usually, that's the LM loop: one event loop per process, running in a background thread, on which the batch helpers in batch_and_stream_lm.py make their calls.
+
+Under gevent (the server's worker class monkey patches everything), a threading.Thread is really a greenlet, so the loop would share the hub with the requests,
+and any blocking or CPU-bound work on it would hold all of them up. So the loop gets a real OS thread, with the selector and threads from before patching
+(its run_in_executor calls go to real threads too; patched ones would never be scheduled there). Sync code waiting on its futures is still cooperative,
+since gevent's patched locks can be released from another thread, but gevent's queues can't be put to from one (see LMLoopQueue).
+
+"""
+
+HTTP_TIMEOUT = 600  # in seconds
+HTTP_POOL_SIZE = 50  # connections kept alive per API
+
+_SESSIONS = {}  # url -> requests.Session
+_ASYNC_CLIENTS = weakref.WeakKeyDictionary()  # event loop -> {key: client}
+_CLIENTS_LOCK = threading.Lock()
+
+_LM_LOOP = None
+_LM_LOOP_LOCK = threading.Lock()
+LM_LOOP_EXECUTOR_THREADS = 32  # for the LM loop's run_in_executor calls (sync LMs, redis, ...)
+
+
+# Connections (and the LM loop's thread) don't survive a fork (e.g., into a celery worker)
+def _reset_after_fork():
+    global _SESSIONS, _ASYNC_CLIENTS, _CLIENTS_LOCK, _LM_LOOP, _LM_LOOP_LOCK
+    _SESSIONS = {}
+    _ASYNC_CLIENTS = weakref.WeakKeyDictionary()
+    _CLIENTS_LOCK = threading.Lock()
+    _LM_LOOP = None
+    _LM_LOOP_LOCK = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_http_session(url) -> requests.Session:
+    with _CLIENTS_LOCK:
+        if url not in _SESSIONS:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _SESSIONS[url] = session
+        return _SESSIONS[url]
+
+
+# Needs to be called from a coroutine, since the client belongs to the running loop
+def get_async_client(key, make_client):
+    loop = asyncio.get_running_loop()
+    with _CLIENTS_LOCK:
+        if loop not in _ASYNC_CLIENTS:
+            _ASYNC_CLIENTS[loop] = {}
+        clients = _ASYNC_CLIENTS[loop]
+        if key not in clients:
+            clients[key] = make_client()
+        return clients[key]
+
+
+def get_async_http_client(url) -> httpx.AsyncClient:
+    limits = httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+    return get_async_client(('http', url), lambda: httpx.AsyncClient(timeout=HTTP_TIMEOUT, limits=limits))
+
+
+# (module, name) -> what it was before gevent patched it, if it did
+def _unpatched(module, name):
+    try:
+        from gevent import monkey
+    except ImportError:
+        return None
+    if not monkey.is_module_patched(module):
+        return None
+    return monkey.get_original(module, name)
+
+
+# A minimal executor on real OS threads (started with the unpatched _thread), so that it works from the LM loop's thread under gevent
+# It's only a ThreadPoolExecutor because loop.set_default_executor wants one; none of that class's workings are used.
+class NativeThreadExecutor(concurrent.futures.ThreadPoolExecutor):
+    def __init__(self, max_workers) -> None:
+        super().__init__(max_workers)
+        self.max_workers = max_workers
+        self.n_workers = 0
+        self.lock = (_unpatched('_thread', 'allocate_lock') or _thread.allocate_lock)()
+        self.start_new_thread = _unpatched('_thread', 'start_new_thread') or _thread.start_new_thread
+        self.work = (_unpatched('queue', 'SimpleQueue') or queue.SimpleQueue)()
+        self.shut_down = False
+
+    def _work(self):
+        while True:
+            item = self.work.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self.lock:
+            if self.shut_down:
+                raise RuntimeError("Can't submit to an executor that's shut down")
+            future = concurrent.futures.Future()
+            self.work.put((future, fn, args, kwargs))
+            # A worker per submit until there are max_workers; they're kept for the life of the process
+            if self.n_workers < self.max_workers:
+                self.start_new_thread(self._work, ())
+                self.n_workers += 1
+            return future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self.lock:
+            self.shut_down = True
+            for _ in range(self.n_workers):
+                self.work.put(None)
+
+
+def get_lm_loop() -> asyncio.AbstractEventLoop:
+    global _LM_LOOP
+    with _LM_LOOP_LOCK:
+        if _LM_LOOP is None:
+            start_new_thread = _unpatched('_thread', 'start_new_thread')
+            if start_new_thread is None:
+                _LM_LOOP = asyncio.new_event_loop()
+                threading.Thread(target=_LM_LOOP.run_forever, daemon=True).start()
+            else:
+                # Under gevent (see above)
+                selector = _unpatched('selectors', 'DefaultSelector') or selectors.DefaultSelector
+                _LM_LOOP = asyncio.SelectorEventLoop(selector())
+                _LM_LOOP.set_default_executor(NativeThreadExecutor(LM_LOOP_EXECUTOR_THREADS))
+                start_new_thread(_LM_LOOP.run_forever, ())
+        return _LM_LOOP
+
+
+# For sync code: runs the coroutine on the LM loop and returns a concurrent.futures.Future for its result
+def run_on_lm_loop(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_lm_loop())
+
+
+# For handing things from the LM loop to sync code, one at a time (e.g., a stream's tokens)
+# Under gevent, queue.Queue is patched into gevent's queue, which can't be put to from another thread;
+# so this wakes the waiting greenlet with an async watcher on its hub instead (which also keeps the hub from thinking there's nothing left to wait for).
+# Make it in the thread that gets from it, and close it when done.
+class LMLoopQueue():
+    def __init__(self) -> None:
+        self.watcher = None
+        if _unpatched('_thread', 'start_new_thread') is None:
+            self.q = queue.Queue()
+            return
+        from gevent import get_hub
+        from gevent.event import Event
+        self.items = collections.deque()
+        self.ready = Event()
+        self.watcher = get_hub().loop.async_()
+        self.watcher.start(self.ready.set)
+
+    def put(self, x):
+        if self.watcher is None:
+            self.q.put(x)
+            return
+        self.items.append(x)
+        self.watcher.send()
+
+    # Raises queue.Empty after timeout seconds, like queue.Queue
+    def get(self, timeout=None):
+        if self.watcher is None:
+            return self.q.get(timeout=timeout)
+        while not self.items:
+            self.ready.clear()
+            if self.items:
+                break
+            if not self.ready.wait(timeout):
+                raise queue.Empty
+        return self.items.popleft()
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.close()
+
+
+# Waits for a future from run_on_lm_loop and returns its result, letting other greenlets run meanwhile under gevent (see LMLoopQueue)
+def wait_for_lm_loop(future: concurrent.futures.Future):
+    q = LMLoopQueue()
+    try:
+        future.add_done_callback(q.put)
+        q.get()
+    finally:
+        q.close()
+    return future.result()
+
+
+"""
+
+Response cache for run / arun, for background work that gets redone with the same prompts (jobs retried after errors, descriptions remade, etc.).
+
+It's opt in: a call with cache=True gets the stored response for the same (model code, system prompt, prompt, context, temperature, make_json, images) if there is one,
+and stores the new response otherwise. refresh_cache=True skips the lookup (the new response is still stored), for when a fresh answer is wanted.
+Entries live in redis (shared by all processes) for LM_CACHE_TTL; past LM_CACHE_MAX_BYTES in total, the oldest go first.
+
+"""
+
+LM_CACHE_TTL = 7 * 24 * 60 * 60  # in seconds
+LM_CACHE_MAX_BYTES = 512 * 1024 ** 2
+LM_CACHE_MAX_ENTRY_BYTES = 1024 ** 2  # bigger responses aren't stored
+
+class LMCache():
+    def __init__(self, ttl, max_bytes, max_entry_bytes) -> None:
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.redis = redis.Redis(**LM_CACHE_CONNECTION_PARAMS)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.index_key = "lm_cache_index"  # sorted set of entry keys by time stored
+        self.sizes_key = "lm_cache_sizes"  # hash of entry key -> bytes
+        self.total_key = "lm_cache_bytes"
+        # KEYS: entry, index, sizes, total; ARGV: value, ttl (s), now (s), max bytes
+        self._put = self.redis.register_script("""
+        local function forget(key)
+            local size = tonumber(redis.call('hget', KEYS[3], key) or 0)
+            redis.call('hdel', KEYS[3], key)
+            redis.call('zrem', KEYS[2], key)
+            return redis.call('decrby', KEYS[4], size)
+        end
+        forget(KEYS[1])
+        for _, key in ipairs(redis.call('zrangebyscore', KEYS[2], '-inf', tonumber(ARGV[3]) - tonumber(ARGV[2]))) do
+            forget(key)  -- expired
+        end
+        redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+        redis.call('zadd', KEYS[2], ARGV[3], KEYS[1])
+        redis.call('hset', KEYS[3], KEYS[1], string.len(ARGV[1]))
+        local total = redis.call('incrby', KEYS[4], string.len(ARGV[1]))
+        while total > tonumber(ARGV[4]) do
+            local oldest = redis.call('zrange', KEYS[2], 0, 0)
+            if #oldest == 0 then
+                break
+            end
+            redis.call('del', oldest[1])
+            total = forget(oldest[1])
+        end
+        return total
+        """)
+
+    @staticmethod
+    def make_key(code, txt, system_prompt, context, temperature, make_json, images):
+        image_hashes = [hashlib.sha256(x.encode('utf-8')).hexdigest() for x in (images or [])]
+        parts = json.dumps([code, system_prompt, txt, context, temperature, make_json, image_hashes], sort_keys=True, default=str)
+        return f"lm:{code}:{hashlib.sha256(parts.encode('utf-8')).hexdigest()}"
+
+    def get(self, key):
+        val = None
+        try:
+            val = self.redis.get(key)
+        except redis.RedisError as e:
+            print(f"LM cache couldn't reach redis: {e}", file=sys.stderr)
+        with self.lock:
+            if val is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return val.decode('utf-8') if val is not None else None
+
+    def put(self, key, response):
+        if not isinstance(response, str) or not response:
+            return
+        val = response.encode('utf-8')
+        if len(val) > self.max_entry_bytes:
+            return
+        try:
+            self._put(keys=[key, self.index_key, self.sizes_key, self.total_key], args=[val, self.ttl, time.time(), self.max_bytes])
+        except redis.RedisError as e:
+            print(f"LM cache couldn't reach redis: {e}", file=sys.stderr)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0
+            }
+
+
+LM_CACHE = LMCache(LM_CACHE_TTL, LM_CACHE_MAX_BYTES, LM_CACHE_MAX_ENTRY_BYTES)
+
+
+# The cache key for a call to run / arun (func) with these arguments
+def _cache_key(lm, func, args, kwargs):
+    bound = inspect.signature(func).bind(lm, *args, **kwargs)
+    bound.apply_defaults()
+    x = bound.arguments
+    return LM_CACHE.make_key(lm.code, x['txt'], x['system_prompt'], x['context'], x['temperature'], x['make_json'], x['images'])
+
+
+# Goes on each provider's run and arun; adds the cache and refresh_cache arguments (see above)
+def cached_run(func):
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(self, *args, cache=False, refresh_cache=False, **kwargs):
+            if not cache:
+                return await func(self, *args, **kwargs)
+            loop = asyncio.get_running_loop()
+            key = _cache_key(self, func, args, kwargs)
+            if not refresh_cache:
+                hit = await loop.run_in_executor(None, LM_CACHE.get, key)
+                if hit is not None:
+                    return hit
+            resp = await func(self, *args, **kwargs)
+            await loop.run_in_executor(None, LM_CACHE.put, key, resp)
+            return resp
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(self, *args, cache=False, refresh_cache=False, **kwargs):
+        if not cache:
+            return func(self, *args, **kwargs)
+        key = _cache_key(self, func, args, kwargs)
+        if not refresh_cache:
+            hit = LM_CACHE.get(key)
+            if hit is not None:
+                return hit
+        resp = func(self, *args, **kwargs)
+        LM_CACHE.put(key, resp)
+        return resp
+    return wrapper
+
+
+# For looking before calling arun (e.g., to skip waiting on rate limits); None if it's not there
+def get_cached_response(lm, txt, **kwargs):
+    run = type(lm).run
+    return LM_CACHE.get(_cache_key(lm, getattr(run, '__wrapped__', run), [txt], kwargs))
+
+
 class LMStreamResponse():
     def __init__(self, reasoning="", text=""):
         self.reasoning = reasoning
@@ -29,6 +383,8 @@ class LM():
     context_length: int  # in tokens
     accepts_images: bool  # can run and stream use images?
     supports_json: bool  # Does inference give a guarantee of correct JSON if requested?
+    requests_per_minute: int = None  # Rate limits shared by all processes (see lm_governor.py); None = no limit
+    tokens_per_minute: int = None
     def __init__(self, model, code, name, desc, traits, context_length, accepts_images=False, supports_json=False) -> None:
         self.model = model
         self.code = code
@@ -40,12 +396,29 @@ class LM():
         self.supports_json = supports_json
 
     # Note that images is a list of base64 strings like data:image/png;base64,BLAHBLAHBLAH...
+    # Providers' run and arun also take cache and refresh_cache (see cached_run)
     def run(self, txt, system_prompt=None, context=[], make_json=False, temperature=None, images=[]):
         raise NotImplementedError(f"Run not impelemented for language model {self.code}")
 
     def stream(self, txt, system_prompt=None, context=[], temperature=None, show_reasoning=False, images=[]):
         raise NotImplementedError(f"Stream not impelemented for language model {self.code}")
 
+    # Async run and stream take the same arguments as run and stream.
+    # By default, they call run and stream in a thread; providers with async clients override them.
+    async def arun(self, txt, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.run, txt, **kwargs))
+
+    async def astream(self, txt, **kwargs):
+        loop = asyncio.get_running_loop()
+        it = iter(self.stream(txt, **kwargs))
+        done = object()
+        while True:
+            x = await loop.run_in_executor(None, next, it, done)
+            if x is done:
+                break
+            yield x
+
     def to_json_obj(self):
         return {
             'code': self.code,
@@ -79,9 +452,8 @@ class OpenAILM(LM):
 
         return messages
 
-
-    def run(self, txt, system_prompt=None, context=[], temperature=.7, make_json=False, images=[]):
-
+    # Keyword arguments for chat.completions.create
+    def _completion_kwargs(self, txt, system_prompt=None, context=[], temperature=None, make_json=False, images=[], stream=False):
         messages = self._make_messages(
             txt=txt,
             system_prompt=system_prompt,
@@ -95,29 +467,38 @@ class OpenAILM(LM):
 
         if make_json and self.supports_json:
             extra_kwargs['response_format'] = {'type': 'json_object'}
-        
-        completion = openai_client.chat.completions.create(model=self.model, messages=messages, stream=False, **extra_kwargs)
-        return completion.choices[0].message.content
 
+        return {'model': self.model, 'messages': messages, 'stream': stream, **extra_kwargs}
 
-    def stream(self, txt, system_prompt=None, context=[], temperature=None, show_reasoning=False, images=[]):
-       
-        messages = self._make_messages(
-            txt=txt,
-            system_prompt=system_prompt,
-            context=context,
-            images=images
-        )
+    def _get_async_client(self):
+        return get_async_client('openai', AsyncOpenAI)
 
-        extra_kwargs = {}
-        if temperature is not None:
-            extra_kwargs['temperature'] = temperature
+    @cached_run
+    def run(self, txt, system_prompt=None, context=[], temperature=.7, make_json=False, images=[]):
+        kwargs = self._completion_kwargs(txt, system_prompt=system_prompt, context=context, temperature=temperature, make_json=make_json, images=images)
+        completion = openai_client.chat.completions.create(**kwargs)
+        return completion.choices[0].message.content
 
-        completion = openai_client.chat.completions.create(model=self.model, messages=messages, stream=True, **extra_kwargs)
+    def stream(self, txt, system_prompt=None, context=[], temperature=None, show_reasoning=False, images=[]):
+        kwargs = self._completion_kwargs(txt, system_prompt=system_prompt, context=context, temperature=temperature, images=images, stream=True)
+        completion = openai_client.chat.completions.create(**kwargs)
         for chunk in completion:
             if chunk.choices[0].delta.content is not None:
                 yield LMStreamResponse(text=chunk.choices[0].delta.content)
 
+    @cached_run
+    async def arun(self, txt, system_prompt=None, context=[], temperature=.7, make_json=False, images=[]):
+        kwargs = self._completion_kwargs(txt, system_prompt=system_prompt, context=context, temperature=temperature, make_json=make_json, images=images)
+        completion = await self._get_async_client().chat.completions.create(**kwargs)
+        return completion.choices[0].message.content
+
+    async def astream(self, txt, system_prompt=None, context=[], temperature=None, show_reasoning=False, images=[]):
+        kwargs = self._completion_kwargs(txt, system_prompt=system_prompt, context=context, temperature=temperature, images=images, stream=True)
+        completion = await self._get_async_client().chat.completions.create(**kwargs)
+        async for chunk in completion:
+            if chunk.choices[0].delta.content is not None:
+                yield LMStreamResponse(text=chunk.choices[0].delta.content)
+
 
 class Anthropic(LM):
 
@@ -161,9 +542,8 @@ class Anthropic(LM):
 
         return messages
 
-
-    def run(self, txt, system_prompt=None, context=[], temperature=.7, make_json=False, images=[]):
-        
+    # Keyword arguments for messages.create / messages.stream
+    def _message_kwargs(self, txt, system_prompt=None, context=[], temperature=None, make_json=False, images=[]):
         messages = self._make_messages(
             txt=txt,
             system_prompt=system_prompt,
@@ -178,16 +558,23 @@ class Anthropic(LM):
             system_prompt = ""
 
         if make_json:
-            messages.append({'role': 'assistant', 'content': '{"'})  # best we can do - just starting the thing off with {" (NOTE: inverse at bottom!)
+            messages.append({'role': 'assistant', 'content': '{"'})  # best we can do - just starting the thing off with {" (NOTE: inverse in run!)
 
         # Max content window is 200k for claude 3
-        message = client.messages.create(
-            max_tokens=4096,  # max output tokens?
-            messages=messages,
-            model=self.model,
-            temperature=temperature,
-            system=system_prompt
-        )
+        return {
+            'max_tokens': 4096,  # max output tokens?
+            'messages': messages,
+            'model': self.model,
+            'temperature': temperature,
+            'system': system_prompt
+        }
+
+    def _get_async_client(self):
+        return get_async_client('anthropic', lambda: anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY))
+
+    @cached_run
+    def run(self, txt, system_prompt=None, context=[], temperature=.7, make_json=False, images=[]):
+        message = client.messages.create(**self._message_kwargs(txt, system_prompt=system_prompt, context=context, temperature=temperature, make_json=make_json, images=images))
         
         resp = message.content[0].text
 
@@ -197,28 +584,24 @@ class Anthropic(LM):
         return resp
 
     def stream(self, txt, system_prompt=None, context=[], temperature=None, show_reasoning=False, images=[]):
-        messages = self._make_messages(
-            txt=txt,
-            system_prompt=system_prompt,
-            context=context,
-            images=images
-        )
+        with client.messages.stream(**self._message_kwargs(txt, system_prompt=system_prompt, context=context, temperature=temperature, images=images)) as stream:
+            for text in stream.text_stream:
+                yield LMStreamResponse(text=text)
 
-        if temperature is None:
-            temperature = .7
+    @cached_run
+    async def arun(self, txt, system_prompt=None, context=[], temperature=.7, make_json=False, images=[]):
+        message = await self._get_async_client().messages.create(**self._message_kwargs(txt, system_prompt=system_prompt, context=context, temperature=temperature, make_json=make_json, images=images))
 
-        if system_prompt is None:
-            system_prompt = ""
+        resp = message.content[0].text
 
-        # Max content window is 200k for claude 3
-        with client.messages.stream(
-            max_tokens=4096,  # max output tokens?
-            messages=messages,
-            model=self.model,
-            temperature=temperature,
-            system=system_prompt
-        ) as stream:
-            for text in stream.text_stream:
+        if make_json:
+            resp = '{"' + resp
+
+        return resp
+
+    async def astream(self, txt, system_prompt=None, context=[], temperature=None, show_reasoning=False, images=[]):
+        async with self._get_async_client().messages.stream(**self._message_kwargs(txt, system_prompt=system_prompt, context=context, temperature=temperature, images=images)) as stream:
+            async for text in stream.text_stream:
                 yield LMStreamResponse(text=text)
 
 
@@ -255,22 +638,22 @@ class Ollama(LM):
         })
         return messages
 
-    def run(self, txt, system_prompt=None, context=[], temperature=.7, make_json=False, images=[]):
-        messages = self._make_messages(txt, system_prompt=system_prompt, context=context, images=images)
+    # Returns the url and params for /api/chat
+    def _make_request(self, txt, system_prompt=None, context=[], temperature=None, images=[], stream=False):
         params = {
             'model': self.model,
-            'messages': messages,
+            'messages': self._make_messages(txt, system_prompt=system_prompt, context=context, images=images),
             'options': {
                 'temperature': temperature if temperature else .7,
                 'num_ctx': self.context_length
             },
-            'stream': False
+            'stream': stream
         }
         ollama_url = SETTINGS['ollama']['url']
         url = f'{ollama_url}/api/chat'
-        response = requests.post(url, json=params, stream=False)
-        response.raise_for_status()  # Raise an error for bad responses
-        my_json = response.json()
+        return url, params
+
+    def _finish_run(self, my_json, make_json=False):
         x = my_json['message']['content']
 
         # Right now, there is no great way to force JSON in the API (there is in new versions of Ollama - waiting for more usage)
@@ -280,20 +663,17 @@ class Ollama(LM):
 
         return x
 
+    @cached_run
+    def run(self, txt, system_prompt=None, context=[], temperature=.7, make_json=False, images=[]):
+        url, params = self._make_request(txt, system_prompt=system_prompt, context=context, temperature=temperature, images=images)
+        response = get_http_session(SETTINGS['ollama']['url']).post(url, json=params, stream=False)
+        response.raise_for_status()  # Raise an error for bad responses
+        return self._finish_run(response.json(), make_json=make_json)
+
     def stream(self, txt, system_prompt=None, context=[], temperature=None, show_reasoning=False, images=[]):
-        params = {
-            'model': self.model,
-            'messages': self._make_messages(txt, system_prompt=system_prompt, context=context, images=images),
-            'options': {
-                'temperature': temperature if temperature else .7,
-                'num_ctx': self.context_length
-            },
-            'stream': True
-        }
-        ollama_url = SETTINGS['ollama']['url']
-        url = f'{ollama_url}/api/chat'
+        url, params = self._make_request(txt, system_prompt=system_prompt, context=context, temperature=temperature, images=images, stream=True)
         try:
-            response = requests.post(url, json=params, stream=True)
+            response = get_http_session(SETTINGS['ollama']['url']).post(url, json=params, stream=True)
             response.raise_for_status()  # Raise an error for bad responses
 
             # Process the streaming response
@@ -308,6 +688,26 @@ class Ollama(LM):
         except requests.exceptions.RequestException as e:
             print(f"An error occurred: {e}")
 
+    @cached_run
+    async def arun(self, txt, system_prompt=None, context=[], temperature=.7, make_json=False, images=[]):
+        url, params = self._make_request(txt, system_prompt=system_prompt, context=context, temperature=temperature, images=images)
+        response = await get_async_http_client(SETTINGS['ollama']['url']).post(url, json=params)
+        response.raise_for_status()
+        return self._finish_run(response.json(), make_json=make_json)
+
+    async def astream(self, txt, system_prompt=None, context=[], temperature=None, show_reasoning=False, images=[]):
+        url, params = self._make_request(txt, system_prompt=system_prompt, context=context, temperature=temperature, images=images, stream=True)
+        try:
+            async with get_async_http_client(SETTINGS['ollama']['url']).stream('POST', url, json=params) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if line:
+                        my_json = json.loads(line)
+                        yield LMStreamResponse(text=my_json['message']['content'])
+
+        except httpx.HTTPError as e:
+            print(f"An error occurred: {e}")
+
 
 class OpenAICompatibleLM(LM):
 
@@ -343,9 +743,8 @@ class OpenAICompatibleLM(LM):
 
         return messages
 
-
-    def run(self, txt, system_prompt=None, context=[], temperature=.7, make_json=False, images=[]):
-
+    # Returns the url, headers, and params for /chat/completions
+    def _make_request(self, txt, system_prompt=None, context=[], temperature=None, images=[], stream=False):
         messages = self._make_messages(
             txt=txt,
             system_prompt=system_prompt,
@@ -353,71 +752,76 @@ class OpenAICompatibleLM(LM):
             images=images
         )
 
-        extra_kwargs = {}
-        if temperature is not None:
-            extra_kwargs['temperature'] = temperature
-
-        if make_json and self.supports_json:
-            extra_kwargs['response_format'] = {'type': 'json_object'}
-        
         params = {
             'model': self.model,
             'messages': messages,
             'temperature': temperature if temperature else .7,
-            'stream': False,
+            'stream': stream,
             **self.extra_params
         }
         oai_compatible_url = self.url
         url = f'{oai_compatible_url}/chat/completions'
-        response = requests.post(url, headers={'Authorization': f'Bearer {self.key}', **self.default_headers}, json=params, stream=False)
+        headers = {'Authorization': f'Bearer {self.key}', **self.default_headers}
+        return url, headers, params
+
+    # Returns the LMStreamResponses in one line of the event stream, or None once it's done
+    def _parse_stream_line(self, data, show_reasoning=True):
+        if data[:len('data: ')] != 'data: ':
+            return []
+        real_data = data[len('data: '):]
+        if real_data == '[DONE]':
+            return None
+        my_json = json.loads(real_data)
+        delta = my_json['choices'][0]['delta']
+        responses = []
+        for key in delta:
+            if key == 'content' and delta['content']:
+                responses.append(LMStreamResponse(text=delta[key]))
+            if show_reasoning:
+                if key.find('reasoning') > -1:  # Sometimes it goes by "reasoning_content" or "reasoning" or something
+                    if delta[key]:
+                        responses.append(LMStreamResponse(reasoning=delta[key]))
+        return responses
+
+    @cached_run
+    def run(self, txt, system_prompt=None, context=[], temperature=.7, make_json=False, images=[]):
+        url, headers, params = self._make_request(txt, system_prompt=system_prompt, context=context, temperature=temperature, images=images)
+        response = get_http_session(self.url).post(url, headers=headers, json=params, stream=False)
         response.raise_for_status()  # Raise an error for bad responses
         my_json = response.json()
         return my_json['choices'][0]['message']['content']
         
-
     def stream(self, txt, system_prompt=None, context=[], temperature=None, show_reasoning=True, images=[]):
-       
-        messages = self._make_messages(
-            txt=txt,
-            system_prompt=system_prompt,
-            context=context,
-            images=images
-        )
-
-        extra_kwargs = {}
-        if temperature is not None:
-            extra_kwargs['temperature'] = temperature
-
-        params = {
-            'model': self.model,
-            'messages': messages,
-            'temperature': temperature if temperature else .7,
-            'stream': True,
-            **self.extra_params
-        }
-
-        oai_compatible_url = self.url
-        url = f'{oai_compatible_url}/chat/completions'
-        response = requests.post(url, headers={'Authorization': f'Bearer {self.key}', **self.default_headers}, json=params, stream=True)
+        url, headers, params = self._make_request(txt, system_prompt=system_prompt, context=context, temperature=temperature, images=images, stream=True)
+        response = get_http_session(self.url).post(url, headers=headers, json=params, stream=True)
         response.raise_for_status()  # Raise an error for bad responses
         # Process the streaming response
         for line in response.iter_lines():
             if line:
-                data = line.decode('utf-8')
-                if data[:len('data: ')] != 'data: ':
-                    continue
-                real_data = data[len('data: '):]
-                if real_data == '[DONE]':
+                parsed = self._parse_stream_line(line.decode('utf-8'), show_reasoning=show_reasoning)
+                if parsed is None:
                     break
-                my_json = json.loads(real_data)
-                delta = my_json['choices'][0]['delta']
-                for key in delta:
-                    if key == 'content' and delta['content']:
-                        yield LMStreamResponse(text=delta[key])
-                    if show_reasoning:
-                        if key.find('reasoning') > -1:  # Sometimes it goes by "reasoning_content" or "reasoning" or something
-                            if delta[key]:
-                                yield LMStreamResponse(reasoning=delta[key])
+                yield from parsed
+
+    @cached_run
+    async def arun(self, txt, system_prompt=None, context=[], temperature=.7, make_json=False, images=[]):
+        url, headers, params = self._make_request(txt, system_prompt=system_prompt, context=context, temperature=temperature, images=images)
+        response = await get_async_http_client(self.url).post(url, headers=headers, json=params)
+        response.raise_for_status()
+        my_json = response.json()
+        return my_json['choices'][0]['message']['content']
+
+    async def astream(self, txt, system_prompt=None, context=[], temperature=None, show_reasoning=True, images=[]):
+        url, headers, params = self._make_request(txt, system_prompt=system_prompt, context=context, temperature=temperature, images=images, stream=True)
+        async with get_async_http_client(self.url).stream('POST', url, headers=headers, json=params) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line:
+                    parsed = self._parse_stream_line(line, show_reasoning=show_reasoning)
+                    if parsed is None:
+                        break
+                    for x in parsed:
+                        yield x
 
 
 # In the future, may want to change so that it adds open router specific headers and such
@@ -465,6 +869,8 @@ lms:
       desc: "One of the best models ever!"  # optional
       code: "gpt-4o"  # optional
       disabled: false  # optional
+      requests_per_minute: 500  # optional (see lm_governor.py)
+      tokens_per_minute: 30000  # optional
 
 """
 def generate_lms():
@@ -495,6 +901,8 @@ def generate_lms():
             accepts_images=accepts_images,
             **({'args': lm['args']} if 'args' in lm else {})
         )
+        obj.requests_per_minute = lm['requests_per_minute'] if 'requests_per_minute' in lm else None
+        obj.tokens_per_minute = lm['tokens_per_minute'] if 'tokens_per_minute' in lm else None
         to_return[code] = obj
     return to_return
 
@@ -4,9 +4,9 @@ import numpy as np
 import tempfile
 from .storage_interface import download_file, upload_inter_asset_retriever, delete_resources_from_storage
 import sys
-from .integrations.embed import EMBED_PROVIDERS, Embed
+from .integrations.embed import EMBED_PROVIDERS, BULK_EMBED_PROVIDERS, Embed
 import os
-from sklearn.metrics import pairwise
+from .utils import normalize_embeddings
 import hashlib
 import json
 import random
@@ -22,13 +22,15 @@ class PickledAssets():
     embedding_fn_code: str
     group_hases: list  # hashes of groups of 100 assets (we only check one for consistency)
     group_hash_limit: int
-    def __init__(self, assets, embeddings, embedi_to_asseti, group_hashes, group_hash_limit, embedding_fn_code) -> None:
+    normalized: bool  # are the embeddings unit length float32 rows? (older pickles don't have this attribute)
+    def __init__(self, assets, embeddings, embedi_to_asseti, group_hashes, group_hash_limit, embedding_fn_code, normalized=False) -> None:
         self.assets = assets
         self.embeddings = embeddings
         self.embedi_to_asseti = embedi_to_asseti
         self.embedding_fn_code = embedding_fn_code
         self.group_hash_limit = group_hash_limit
         self.group_hases = group_hashes
+        self.normalized = normalized
 
 
 
@@ -157,7 +159,7 @@ class InterAssetRetriever():
         embedi_to_asseti = {}
 
         def _do_embedding(lst):
-            embed_obj: Embed = EMBED_PROVIDERS[self.embedding_fn_code]
+            embed_obj: Embed = BULK_EMBED_PROVIDERS[self.embedding_fn_code]
             embeddings = embed_obj.embed(lst)
             try:
                 embeddings = np.array(embeddings)
@@ -202,15 +204,16 @@ class InterAssetRetriever():
                     group_hashes.append(self._assets_to_hash(hash_batch))
                     hash_batch = []
             
-            embeddings = _do_embedding(to_embed)
-            total_embeddings.extend(embeddings)
+            embeddings = normalize_embeddings(_do_embedding(to_embed))
+            total_embeddings.append(embeddings)
 
             offset += EMBED_BATCH_SIZE
 
         if len(hash_batch):
             group_hashes.append(self._assets_to_hash(hash_batch))
 
-        self.pickled_assets = PickledAssets(total_assets, total_embeddings, embedi_to_asseti, group_hashes, GROUP_HASH_SIZE, embedding_fn_code=self.embedding_fn_code)
+        total_embeddings = np.concatenate(total_embeddings) if len(total_embeddings) else np.zeros((0, 0), dtype=np.float32)
+        self.pickled_assets = PickledAssets(total_assets, total_embeddings, embedi_to_asseti, group_hashes, GROUP_HASH_SIZE, embedding_fn_code=self.embedding_fn_code, normalized=True)
 
         temp = tempfile.NamedTemporaryFile(mode='w+', delete=False)
         with open(temp.name, 'wb') as fhand:
@@ -222,17 +225,21 @@ class InterAssetRetriever():
             raise Exception("Pickled assets is empty")
         
         embed_obj: Embed = EMBED_PROVIDERS[self.embedding_fn_code]
-        query_embeddings = embed_obj.embed([text])
+        query_vec = normalize_embeddings(embed_obj.embed([text]))[0]
 
         embeddings = self.pickled_assets.embeddings
+        if not getattr(self.pickled_assets, 'normalized', False):
+            embeddings = normalize_embeddings(embeddings)
+
+        if len(embeddings) == 0:
+            return []
 
         try:
-            sims = pairwise.cosine_similarity(query_embeddings, embeddings, dense_output=True)
-        except:
+            points = embeddings @ query_vec  # cosine similarity, since both are unit length
+        except ValueError:
             raise Exception("Value error trying to compare embeddings in interasset; something went wrong with embeddings.")
 
         # Assign points for each chunk (for now, just similarity scores)
-        points = np.array(sims[0])  # first one is only one, for now
         ranking = points.argsort()[::-1]
 
         best_asset_ids = []
@@ -1,18 +1,29 @@
 from .db import get_db, needs_special_db
+from .locks import is_locked
 import json
 import sys
 
 
+STALE_JOB_SECONDS = 10 * 60  # a running job with no progress for this long is taken to have died with its worker
+
+
+# Name of the lock (see locks.py) held by whatever is running a job, so that a job that's resumed never has two runners
+def job_runner_lock(job_id):
+    return f"job_runner:{job_id}"
+
+
+# keep_storage leaves what the job stored so far, so that it can be resumed (see resume_job)
 @needs_special_db(consistent_conn=True)
-def mark_job_error(job_id, db=None):
+def mark_job_error(job_id, keep_storage=False, db=None):
     curr = db.cursor()
 
     # Remove the temporary data
-    sql = """
-    DELETE FROM jobs_storage
-    WHERE `job_id`=%s
-    """
-    curr.execute(sql, (job_id,))
+    if not keep_storage:
+        sql = """
+        DELETE FROM jobs_storage
+        WHERE `job_id`=%s
+        """
+        curr.execute(sql, (job_id,))
 
     error_json = {'text': "An error occurred."}
 
@@ -64,6 +75,18 @@ def start_job(title: str, metadata: dict, asset_id: int, kind: str, user_id: str
     return job_id
 
 
+# For a job that stopped partway (error, or worker died); whatever restarts its work should skip what's in its storage
+@needs_special_db(consistent_conn=True)
+def resume_job(job_id, db=None):
+    curr = db.cursor()
+    sql = """
+    UPDATE jobs
+    SET `is_running`=1, `error`=NULL, `time_last_update`=CURRENT_TIMESTAMP
+    WHERE `id`=%s AND `is_complete`=0
+    """
+    curr.execute(sql, (job_id,))
+
+
 # clean_up dictates whether job storage should be removed
 @needs_special_db(consistent_conn=True)
 def complete_job(job_id, clean_up=False, resource_id=None, db=None):
@@ -87,10 +110,10 @@ def update_job_progress(job_id, progress, db=None):
     curr = db.cursor()
     sql = """
     UPDATE jobs
-    SET `progress`=%s
+    SET `progress`=%s, `time_last_update`=CURRENT_TIMESTAMP
     WHERE `id`=%s
     """
-    curr.execute(sql, (progress, job_id))
+    curr.execute(sql, (progress, job_id))  # time_last_update is set explicitly, since the rounded progress often doesn't change
 
 
 @needs_special_db(consistent_conn=True)
@@ -172,30 +195,74 @@ def get_job_storage(job_id, name="%", order_by=[], db=None):
     WHERE js.job_id = %s AND IFNULL(js.name, '') LIKE %s
     {order_by_str}
     """
-    curr.execute(sql, (job_id, name, job_id, name))
+    # Streamed from the pooler in batches, so long results don't cost a round trip per row (or all sit in memory)
+    rows = curr.stream(sql, (job_id, name, job_id, name))
 
-    first_res = curr.fetchone()
+    first_res = next(rows, None)
     
     def row_gen():
         if first_res:
             yield first_res
-            while True:
-                res = curr.fetchone()
-                if not res:
-                    break
-                yield res
+            yield from rows
 
     total = first_res['_count'] if first_res else 0
 
     return total, row_gen()
 
 
+# A job's metadata as a dict (some were stored as a JSON string inside the JSON)
+def get_job_metadata(job):
+    metadata = json.loads(job['metadata']) if job['metadata'] else {}
+    if isinstance(metadata, str):
+        metadata = json.loads(metadata)
+    return metadata
+
+
+# Values of one metadata key across a job's storage items (e.g., which chunk indices are already done)
+@needs_special_db(consistent_conn=True)
+def get_job_storage_values(job_id, key, name="%", db=None):
+    sql = """
+    SELECT JSON_EXTRACT(`metadata`, %s) AS val
+    FROM jobs_storage
+    WHERE job_id = %s AND IFNULL(name, '') LIKE %s
+    """
+    curr = db.cursor()
+    curr.execute(sql, (f"$.{key}", job_id, name))
+    results = curr.fetchall()
+    return [json.loads(x['val']) for x in results if x['val'] is not None]
+
+
+# Deletes what's stored for the unfinished jobs of some kind on an asset (other than except_job_id)
+# For when a new job replaces them; finished jobs are left alone, since their storage may feed a later step (like a summary's reduce job)
+@needs_special_db(consistent_conn=True)
+def clear_superseded_job_storage(asset_id, kind, except_job_id=None, db=None):
+    sql = """
+    DELETE js FROM jobs_storage js
+    JOIN jobs j ON js.job_id = j.id
+    WHERE j.asset_id = %s AND j.kind = %s AND j.is_complete = 0 AND j.id != %s
+    """
+    curr = db.cursor()
+    curr.execute(sql, (asset_id, kind, except_job_id if except_job_id is not None else -1))
+
+
+# Whether a job stopped partway, either with an error or by going stale while running (see STALE_JOB_SECONDS)
+# A job whose runner still holds job_runner_lock is running, however long it's been; job should come from search_for_jobs
+def can_resume_job(job):
+    if job['is_complete'] or is_locked(job_runner_lock(job['id'])):
+        return False
+    if job['error'] or not job['is_running']:
+        return True
+    idle = job.get('_idle_seconds')
+    return idle is not None and idle > STALE_JOB_SECONDS
+
+
 # order by uses same rules as above function
+# Rows have an extra _idle_seconds, the time since time_last_update according to the DB's clock
 @needs_special_db(consistent_conn=True)
 def search_for_jobs(kind="%", title="%", asset_id=None, order_by=[], is_running=None, job_id=None, limit=100, offset=0, db=None):
     order_by_str = _get_order_by_str(order_by)
     sql = f"""
-    SELECT * FROM jobs
+    SELECT *, TIMESTAMPDIFF(SECOND, `time_last_update`, CURRENT_TIMESTAMP) AS _idle_seconds FROM jobs
     WHERE IFNULL(`kind`, '') LIKE %s
       AND IFNULL(`title`, '') LIKE %s
       {"AND `asset_id`=%s" if asset_id else ""}
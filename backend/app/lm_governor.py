@@ -0,0 +1,252 @@
+import redis
+import sys
+import asyncio
+import functools
+import heapq
+import itertools
+import time
+import email.utils
+from .configs.conn_config import POOLER_CONNECTION_PARAMS
+from .integrations.lm import LM, get_cached_response, run_on_lm_loop, wait_for_lm_loop, LMLoopQueue
+from .utils import get_token_estimate
+
+"""
+
+Rate limiting for LM calls, shared by every process (server, celery, ...), so that chat and background jobs together stay under the provider's limits.
+
+Each LM (by code) can have requests_per_minute and/or tokens_per_minute in its settings (see generate_lms in integrations/lm.py).
+Those are token buckets in Redis: a call takes one request and its estimated tokens, and waits until they're there.
+BACKGROUND calls leave RESERVE of each bucket for INTERACTIVE ones, and within a process, waiting calls go in order of priority.
+
+When a provider answers 429, nobody calls that LM again until its Retry-After has passed (and the call is retried).
+
+LMs without limits in their settings only get the Retry-After handling.
+Meant to be used from the LM loop (see batch_and_stream_lm.py); sync code (routes, templates, jobs) calls run_governed and stream_governed
+instead of lm.run and lm.stream, which run the same thing there and wait for it.
+
+"""
+
+INTERACTIVE = 0  # chat, quiz grading, ...
+BACKGROUND = 1  # summary jobs, apply, ...
+
+RESERVE = .2  # fraction of each bucket that only INTERACTIVE calls can use
+OUTPUT_TOKEN_ESTIMATE = 500  # added to the prompt's tokens, since we don't know the output length ahead of time
+MAX_WAIT_STEP = 1  # in seconds; waiting calls check again at least this often (in case something with higher priority shows up)
+MAX_RATE_LIMIT_RETRIES = 3
+DEFAULT_RETRY_AFTER = 10  # in seconds, for a 429 that doesn't say
+
+r = redis.Redis(**POOLER_CONNECTION_PARAMS)
+
+# KEYS: requests bucket, tokens bucket, blocked; ARGV: requests/min, tokens/min (0 = no limit), tokens wanted, reserve
+# Returns 0 if they were taken, or else how long to wait (ms)
+_TAKE = r.register_script("""
+local blocked = redis.call('pttl', KEYS[3])
+if blocked > 0 then
+    return blocked
+end
+local t = redis.call('time')
+local now = tonumber(t[1]) * 1000 + tonumber(t[2]) / 1000
+local caps = {tonumber(ARGV[1]), tonumber(ARGV[2])}
+local wants = {1, tonumber(ARGV[3])}
+local reserve = tonumber(ARGV[4])
+local levels = {}
+local wait = 0
+for i = 1, 2 do
+    if caps[i] > 0 then
+        local state = redis.call('hmget', KEYS[i], 'level', 'ts')
+        local level = tonumber(state[1]) or caps[i]
+        local ts = tonumber(state[2]) or now
+        level = math.min(caps[i], level + (now - ts) * caps[i] / 60000)
+        levels[i] = level
+        wants[i] = math.min(wants[i], caps[i])
+        local need = math.min(wants[i] + caps[i] * reserve, caps[i])
+        if level < need then
+            wait = math.max(wait, math.ceil((need - level) * 60000 / caps[i]))
+        end
+    end
+end
+if wait > 0 then
+    return wait
+end
+for i = 1, 2 do
+    if caps[i] > 0 then
+        redis.call('hset', KEYS[i], 'level', tostring(levels[i] - wants[i]), 'ts', tostring(now))
+        redis.call('pexpire', KEYS[i], 120000)
+    end
+end
+return 0
+""")
+
+
+def _keys(code):
+    return f"lm_rate:{code}:requests", f"lm_rate:{code}:tokens", f"lm_rate:{code}:blocked"
+
+
+def has_limits(lm: LM):
+    return bool(lm.requests_per_minute or lm.tokens_per_minute)
+
+
+# In seconds, or None if e isn't a 429
+def get_retry_after(e: Exception):
+    response = getattr(e, 'response', None)
+    if response is None or getattr(response, 'status_code', None) != 429:
+        return None
+    headers = getattr(response, 'headers', {}) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers.get('retry-after-ms')) / 1000
+        header = headers.get('retry-after')
+        if not header:
+            return DEFAULT_RETRY_AFTER
+        try:
+            return float(header)
+        except ValueError:
+            return max(email.utils.parsedate_to_datetime(header).timestamp() - time.time(), 0)
+    except Exception:
+        return DEFAULT_RETRY_AFTER
+
+
+class Governor():
+    def __init__(self) -> None:
+        self.waiting = {}  # LM code -> heap of [priority, seq, event] for calls waiting in this process
+        self.seq = itertools.count()
+        self.blocked_until = {}  # LM code -> time; for LMs without limits, which aren't in Redis
+
+    # Returns 0 if the call can go now, else how long to wait (seconds)
+    def _take(self, lm: LM, tokens, priority):
+        blocked = self.blocked_until.get(lm.code, 0) - time.time()
+        if blocked > 0:
+            return blocked
+        if not has_limits(lm):
+            return 0
+        reserve = RESERVE if priority > INTERACTIVE else 0
+        try:
+            wait = _TAKE(keys=list(_keys(lm.code)), args=[lm.requests_per_minute or 0, lm.tokens_per_minute or 0, tokens, reserve])
+        except redis.RedisError as e:
+            print(f"Couldn't check rate limit for {lm.code}; going ahead: {e}", file=sys.stderr)
+            return 0
+        return int(wait) / 1000
+
+    async def acquire(self, lm: LM, tokens, priority=INTERACTIVE):
+        loop = asyncio.get_running_loop()
+        waiting = self.waiting.setdefault(lm.code, [])
+        entry = [priority, next(self.seq), asyncio.Event()]
+        heapq.heappush(waiting, entry)
+        try:
+            while True:
+                if waiting[0] is not entry:
+                    await entry[2].wait()
+                    entry[2].clear()
+                    continue
+                if has_limits(lm):
+                    wait = await loop.run_in_executor(None, self._take, lm, tokens, priority)
+                else:
+                    wait = self._take(lm, tokens, priority)
+                if wait <= 0:
+                    return
+                await asyncio.sleep(min(wait, MAX_WAIT_STEP))
+        finally:
+            waiting.remove(entry)
+            heapq.heapify(waiting)
+            if len(waiting):
+                waiting[0][2].set()
+
+    async def back_off(self, lm: LM, seconds):
+        self.blocked_until[lm.code] = max(self.blocked_until.get(lm.code, 0), time.time() + seconds)
+        if not has_limits(lm):
+            return
+        key = _keys(lm.code)[2]
+        ms = max(int(seconds * 1000), 1)
+
+        def block():
+            try:
+                if r.pttl(key) < ms:
+                    r.set(key, 1, px=ms)
+            except redis.RedisError as e:
+                print(f"Couldn't record rate limit for {lm.code}: {e}", file=sys.stderr)
+
+        await asyncio.get_running_loop().run_in_executor(None, block)
+
+
+GOVERNOR = Governor()
+
+
+def _estimate_tokens(txt, system_prompt=None):
+    return get_token_estimate(txt or "") + get_token_estimate(system_prompt or "") + OUTPUT_TOKEN_ESTIMATE
+
+
+# lm.arun, once the governor allows it (and again after a 429, up to MAX_RATE_LIMIT_RETRIES times)
+# With cache=True, a cached response comes back without waiting.
+async def governed_run(lm: LM, txt, priority=INTERACTIVE, **kwargs):
+    if kwargs.get('cache') and not kwargs.get('refresh_cache'):
+        call_kwargs = {k: v for k, v in kwargs.items() if k not in ('cache', 'refresh_cache')}
+        hit = await asyncio.get_running_loop().run_in_executor(None, functools.partial(get_cached_response, lm, txt, **call_kwargs))
+        if hit is not None:
+            return hit
+        kwargs = {**kwargs, 'refresh_cache': True}  # already looked
+
+    tokens = _estimate_tokens(txt, kwargs.get('system_prompt'))
+    attempt = 0
+    while True:
+        await GOVERNOR.acquire(lm, tokens, priority)
+        try:
+            return await lm.arun(txt, **kwargs)
+        except Exception as e:
+            retry_after = get_retry_after(e)
+            if retry_after is None or attempt >= MAX_RATE_LIMIT_RETRIES:
+                raise
+            attempt += 1
+            await GOVERNOR.back_off(lm, retry_after)
+
+
+# Like governed_run, for lm.astream; only retried if nothing has come back yet
+async def governed_stream(lm: LM, txt, priority=INTERACTIVE, **kwargs):
+    tokens = _estimate_tokens(txt, kwargs.get('system_prompt'))
+    attempt = 0
+    while True:
+        await GOVERNOR.acquire(lm, tokens, priority)
+        started = False
+        try:
+            async for x in lm.astream(txt, **kwargs):
+                started = True
+                yield x
+            return
+        except Exception as e:
+            retry_after = get_retry_after(e)
+            if started or retry_after is None or attempt >= MAX_RATE_LIMIT_RETRIES:
+                raise
+            attempt += 1
+            await GOVERNOR.back_off(lm, retry_after)
+
+
+# For sync code: governed_run on the LM loop, waiting for its result
+def run_governed(lm: LM, txt, priority=INTERACTIVE, **kwargs):
+    return wait_for_lm_loop(run_on_lm_loop(governed_run(lm, txt, priority=priority, **kwargs)))
+
+
+# For sync code: yields what governed_stream does, as it comes back from the LM loop; stopping early cancels the call
+def stream_governed(lm: LM, txt, priority=INTERACTIVE, **kwargs):
+    q = LMLoopQueue()
+    done = object()
+
+    async def pump():
+        try:
+            async for x in governed_stream(lm, txt, priority=priority, **kwargs):
+                q.put((x, None))
+        except Exception as e:
+            q.put((done, e))
+            return
+        q.put((done, None))
+
+    future = run_on_lm_loop(pump())
+    try:
+        while True:
+            x, e = q.get()
+            if e is not None:
+                raise e
+            if x is done:
+                return
+            yield x
+    finally:
+        future.cancel()
+        q.close()
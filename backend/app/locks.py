@@ -0,0 +1,160 @@
+import redis
+import sys
+import time
+from threading import Lock, Thread, Event, get_ident
+from .configs.conn_config import POOLER_CONNECTION_PARAMS
+
+"""
+
+Named locks in Redis, shared by every process (server, celery, ...). They replace MySQL's GET_LOCK, which had to be polled through the pooler.
+
+A lock is the key lock:{name}, set (only if it doesn't exist) to a fencing token with a lease.
+Fencing tokens go up by one every time a lock with that name is given out, so anything the holder writes can be tagged with it
+and stale writes (from a holder whose lease ran out) told apart.
+
+Waiters don't poll: they block on the list lock_wake:{name}, which gets an item whenever the lock is released.
+They only block for as long as the holder's lease has left, so a holder that died without releasing holds nobody up for longer than that.
+While a lock is held, a background thread keeps renewing its lease.
+Like GET_LOCK, a holder can take the same lock again (it's released after as many releases).
+
+"""
+
+LOCK_LEASE = 30  # in seconds
+LOCK_TIMEOUT = 30  # in seconds; default for how long to wait for a lock
+MIN_WAIT = .01  # in seconds; a blpop timeout of 0 would mean forever
+
+r = redis.Redis(**POOLER_CONNECTION_PARAMS)
+
+# KEYS: lock, fence; ARGV: lease (ms). Returns the fencing token, or 0 if the lock is taken
+_ACQUIRE = r.register_script("""
+if redis.call('exists', KEYS[1]) == 0 then
+    local token = redis.call('incr', KEYS[2])
+    redis.call('set', KEYS[1], token, 'PX', ARGV[1])
+    return token
+end
+return 0
+""")
+
+# KEYS: lock, wake; ARGV: token, wake ttl (ms)
+_RELEASE = r.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('del', KEYS[1])
+    redis.call('rpush', KEYS[2], 1)
+    redis.call('pexpire', KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+""")
+
+# KEYS: lock; ARGV: token, lease (ms)
+_EXTEND = r.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+
+def _keys(name):
+    return f"lock:{name}", f"lock_wake:{name}", f"lock_fence:{name}"
+
+
+# Locks held by this process: name -> [token, event that stops its lease renewal, holder's thread/greenlet id, times taken]
+HELD_LOCK = Lock()
+HELD = {}
+
+STATS_LOCK = Lock()
+LOCK_STATS = {
+    'acquired': 0,
+    'contended': 0,  # acquisitions that had to wait
+    'timed_out': 0,
+    'wait_seconds': 0.,
+    'max_wait_seconds': 0.
+}
+
+def _record(acquired, contended, waited):
+    with STATS_LOCK:
+        LOCK_STATS['acquired' if acquired else 'timed_out'] += 1
+        if contended:
+            LOCK_STATS['contended'] += 1
+        LOCK_STATS['wait_seconds'] += waited
+        LOCK_STATS['max_wait_seconds'] = max(LOCK_STATS['max_wait_seconds'], waited)
+
+
+def lock_stats():
+    with STATS_LOCK:
+        return dict(LOCK_STATS)
+
+
+def _keep_alive(name, token, lease, stop: Event):
+    key = _keys(name)[0]
+    while not stop.wait(lease / 3):
+        try:
+            if not _EXTEND(keys=[key], args=[token, int(lease * 1000)]):
+                print(f"Lost the lease on lock {name} (token {token}).", file=sys.stderr)
+                return
+        except Exception as e:
+            print(f"Couldn't renew lease on lock {name}: {e}", file=sys.stderr)
+
+
+# Returns the fencing token, or None if the lock couldn't be had within timeout seconds
+def acquire_lock(name, timeout=LOCK_TIMEOUT, lease=LOCK_LEASE):
+    with HELD_LOCK:
+        held = HELD.get(name)
+        if held and held[2] == get_ident():
+            held[3] += 1
+            return held[0]
+
+    key, wake_key, fence_key = _keys(name)
+    start = time.time()
+    contended = False
+    while True:
+        token = _ACQUIRE(keys=[key, fence_key], args=[int(lease * 1000)])
+        if token:
+            break
+        contended = True
+        remaining = timeout - (time.time() - start)
+        if remaining <= 0:
+            _record(False, contended, time.time() - start)
+            return None
+        pttl = r.pttl(key)  # negative if it's gone (or has no lease)
+        if pttl == -2:
+            continue  # just released
+        wait = remaining if pttl < 0 else min(remaining, pttl / 1000)
+        r.blpop(wake_key, timeout=max(wait, MIN_WAIT))
+
+    token = int(token)
+    stop = Event()
+    with HELD_LOCK:
+        HELD[name] = [token, stop, get_ident(), 1]
+    Thread(target=_keep_alive, args=(name, token, lease, stop), daemon=True).start()
+    _record(True, contended, time.time() - start)
+    return token
+
+
+# Whether anyone (in any process) holds the lock right now
+def is_locked(name):
+    return bool(r.exists(_keys(name)[0]))
+
+
+# The fencing token of a lock held by this process (or None)
+def held_lock_token(name):
+    with HELD_LOCK:
+        held = HELD.get(name)
+    return held[0] if held else None
+
+
+# Releases a lock held by this process; returns whether it was still held
+def release_lock(name):
+    with HELD_LOCK:
+        held = HELD.get(name)
+        if held is None:
+            return False
+        held[3] -= 1
+        if held[3] > 0:
+            return True
+        del HELD[name]
+    token, stop, _, _ = held
+    stop.set()
+    key, wake_key, _ = _keys(name)
+    return bool(_RELEASE(keys=[key, wake_key], args=[token, int(LOCK_LEASE * 1000)]))
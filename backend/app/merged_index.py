@@ -0,0 +1,223 @@
+import numpy as np
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from .chunk_store import ChunkStore, ChunkStoreWriter
+from .ann_index import IVF_SECTIONS, build_ivf_index
+from .db import needs_db, ProxyDB
+from .storage_interface import download_file, upload_merged_retriever, delete_resources_from_storage
+from .retriever_cache import RETRIEVER_CACHE, RetrieverCacheEntry, CACHE_KEY_RETRIEVER_OPTIONS
+from .configs.user_config import ANN_INDEX_MIN_CHUNKS
+
+"""
+
+Merged index for retrievers over many resources (folders, notebooks, ...).
+
+Instead of loading every member's chunk store to answer a query, the members' chunks are copied into one chunk store
+(with an extra 'member_indices' section saying which member each chunk came from, and an ANN index if it's big enough).
+That file is stored in merged_retrieval_storage, keyed by a hash of the members (id + time_uploaded) and the retriever options,
+so a query over a 200 document folder is one download and one matrix product instead of 200.
+
+When the members change, the new merged index is built from the asset's previous one:
+only new or re-uploaded members need their own chunk stores.
+
+"""
+
+MEMBER_SECTION = 'member_indices'  # int64 per chunk: position in the member list of the resource it came from
+COPY_BATCH_SIZE = 1000
+
+
+def _member_signature(resources):
+    return [[res['id'], str(res['time_uploaded'])] for res in resources]
+
+
+def _options_signature(retriever_type_name, retriever_options):
+    return [retriever_type_name, *[retriever_options.get(k) for k in CACHE_KEY_RETRIEVER_OPTIONS]]
+
+
+def make_merged_index_key(resources, retriever_type_name, retriever_options):
+    ser = json.dumps({
+        'members': _member_signature(resources),
+        'options': _options_signature(retriever_type_name, retriever_options)
+    }, default=str)
+    return hashlib.sha256(ser.encode('utf-8')).hexdigest()
+
+
+class MergedIndex():
+    # store, if given, is chunk_filename already opened (from the cache)
+    def __init__(self, key, chunk_filename, members, options, store: ChunkStore=None) -> None:
+        self.key = key
+        self.chunk_filename = chunk_filename
+        self.members = members  # _member_signature of the resources, in order
+        self.options = options  # _options_signature
+        self._store = store
+        store = self.get_store()
+        self.size = len(store)
+        self.chunk_lengths = store.lengths
+        self.chunk_names = store.names
+
+    def get_store(self) -> ChunkStore:
+        # Open = memory-mapped, so it keeps working if the cache deletes the file
+        if self._store is not None and self._store.path == self.chunk_filename and self._store.is_open:
+            return self._store
+        if not os.path.exists(self.chunk_filename):
+            # Evicted from the cache while in use; get it again
+            reloaded = load_merged_index(self.key, new_conn=True)
+            if reloaded is None:
+                raise Exception(f"Merged index {self.key} disappeared.")
+            self.chunk_filename = reloaded.chunk_filename
+            self._store = reloaded._store
+        if self._store is None or self._store.path != self.chunk_filename:
+            self._store = ChunkStore(self.chunk_filename)
+            self._store._load_sections()
+        return self._store
+
+    # Position in the member list for every chunk
+    @property
+    def member_indices(self):
+        return self.get_store()._load_sections()[MEMBER_SECTION]
+
+    def delete(self):
+        self._store = None
+        try:
+            if self.chunk_filename and not RETRIEVER_CACHE.owns(self.chunk_filename):
+                os.remove(self.chunk_filename)
+        except FileNotFoundError:
+            pass
+
+    def cache(self):
+        try:
+            entry = RetrieverCacheEntry(self.chunk_filename, self.size, self.chunk_lengths, self.chunk_names)
+            RETRIEVER_CACHE.put(('merged', self.key), entry)
+        except Exception as e:
+            print(f"Couldn't cache merged index {self.key}: {e}", file=sys.stderr)
+
+
+def _from_row(row, chunk_filename, store=None):
+    meta = json.loads(row['metadata'])
+    return MergedIndex(row['key'], chunk_filename, meta['members'], meta['options'], store=store)
+
+
+# Returns the MergedIndex for key, or None if there isn't one stored
+@needs_db
+def load_merged_index(key, no_cache=False, db: ProxyDB=None):
+    sql = """
+    SELECT * FROM merged_retrieval_storage
+    WHERE `key`=%s
+    ORDER BY `time_uploaded` DESC
+    LIMIT 1
+    """
+    curr = db.cursor()
+    curr.execute(sql, (key,))
+    row = curr.fetchone()
+    if not row:
+        return None
+
+    if not no_cache:
+        entry, store = RETRIEVER_CACHE.get(('merged', key))
+        if entry:
+            return _from_row(row, entry.chunk_filename, store=store)
+
+    return _download(row, no_cache=no_cache)
+
+
+def _download(row, no_cache=False):
+    tmp = tempfile.NamedTemporaryFile(delete=False)
+    try:
+        download_file(tmp.name, row)
+        merged = _from_row(row, tmp.name)
+    except Exception as e:
+        print(f"Couldn't load merged index with id {row['id']}: {e}", file=sys.stderr)
+        os.remove(tmp.name)
+        return None
+    if not no_cache:
+        merged.cache()
+    return merged
+
+
+# resources are the members, in order; get_resource_stores(needed) returns {i: ChunkStore for resources[i]} for the list of member indices needed.
+# asset_id is the asset the retriever belongs to; its last merged index is reused where its members haven't changed (if reuse_previous).
+@needs_db
+def build_merged_index(resources, retriever_type_name, retriever_options, get_resource_stores, asset_id=None, reuse_previous=True, no_cache=False, db: ProxyDB=None):
+    key = make_merged_index_key(resources, retriever_type_name, retriever_options)
+    members = _member_signature(resources)
+    options = _options_signature(retriever_type_name, retriever_options)
+    curr = db.cursor()
+
+    prev_rows = []
+    prev: MergedIndex = None
+    if asset_id is not None:
+        sql = """
+        SELECT * FROM merged_retrieval_storage
+        WHERE `asset_id`=%s
+        ORDER BY `time_uploaded` DESC
+        """
+        curr.execute(sql, (asset_id,))
+        prev_rows = curr.fetchall()
+        if len(prev_rows):
+            prev_meta = json.loads(prev_rows[0]['metadata'])
+            prev_members = set(tuple(x) for x in prev_meta['members'])
+            # Only worth the download if something can be reused
+            if reuse_previous and prev_meta['options'] == options and any(tuple(x) in prev_members for x in members):
+                prev = _download(prev_rows[0], no_cache=True)
+
+    reuse = {}  # member index -> positions in prev
+    if prev is not None:
+        prev_member_indices = np.asarray(prev.member_indices)
+        prev_lookup = {tuple(x): i for i, x in enumerate(prev.members)}
+        for i, member in enumerate(members):
+            if tuple(member) in prev_lookup:
+                reuse[i] = np.flatnonzero(prev_member_indices == prev_lookup[tuple(member)])
+
+    new_file = tempfile.NamedTemporaryFile(delete=False)
+    try:
+        stores = get_resource_stores([i for i in range(len(resources)) if i not in reuse])
+        with ChunkStoreWriter(new_file.name, normalized=True) as writer:
+            member_indices = []
+            for i in range(len(resources)):
+                if i in reuse:
+                    store, positions = prev.get_store(), reuse[i]
+                else:
+                    store = stores[i]
+                    positions = np.arange(len(store))
+                    if len(store) and not (store.has_embeddings and store.normalized):
+                        raise ValueError(f"Resource with id {resources[i]['id']} doesn't have normalized embeddings to merge.")
+                for start in range(0, len(positions), COPY_BATCH_SIZE):
+                    batch = positions[start:start+COPY_BATCH_SIZE]
+                    writer.add_many(store.get_chunks(batch, with_embedding=False), store.embeddings[batch])
+                member_indices.append(np.full(len(positions), i, dtype=np.int64))
+            writer.add_section(MEMBER_SECTION, np.concatenate(member_indices) if len(member_indices) else np.zeros((0,), dtype=np.int64))
+            if writer.n >= ANN_INDEX_MIN_CHUNKS:
+                for name, array in zip(IVF_SECTIONS, build_ivf_index(writer.pending_embeddings())):
+                    writer.add_section(name, array)
+    except:
+        os.remove(new_file.name)
+        raise
+    finally:
+        if prev is not None:
+            prev.delete()
+
+    merged = MergedIndex(key, new_file.name, members, options)
+
+    try:
+        path, res_from = upload_merged_retriever(new_file.name)
+        sql = """
+        INSERT INTO merged_retrieval_storage (`asset_id`, `key`, `from`, `path`, `metadata`)
+        VALUES (%s, %s, %s, %s, %s)
+        """
+        curr.execute(sql, (asset_id, key, res_from, path, json.dumps({'members': members, 'options': options})))
+
+        # Only the latest one for an asset is kept
+        if len(prev_rows):
+            delete_resources_from_storage(prev_rows)
+            sql = f"DELETE FROM merged_retrieval_storage WHERE `id` IN ({','.join([str(int(x['id'])) for x in prev_rows])})"
+            curr.execute(sql)
+        db.commit(close_cursors=False, close=False)
+    except Exception as e:
+        print(f"Couldn't store merged index {key}: {e}", file=sys.stderr)
+
+    if not no_cache:
+        merged.cache()
+    return merged
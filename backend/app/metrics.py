@@ -0,0 +1,90 @@
+from flask import (
+    Blueprint,
+    request,
+    Response
+)
+import hmac
+import redis
+from .configs.secrets import METRICS_TOKEN
+from .configs.conn_config import POOLER_CONNECTION_PARAMS
+from .pooler_codec import decode_message
+from .query_metrics import QUERY_STATS, render_query_metrics, render_gauges
+from .locks import lock_stats
+from .retriever_cache import RETRIEVER_CACHE
+from .template_response import MyResponse
+
+"""
+
+Prometheus-style metrics for scraping, plus the slow query log.
+
+Query stats come from the db pooler (which puts them in Redis every so often) and from this process (queries run here in 'direct' mode).
+Since both are per process, they're counters since that process started.
+Off unless METRICS_TOKEN is set, in which case it's needed as a bearer token.
+
+"""
+
+bp = Blueprint('metrics', __name__, url_prefix="/metrics")
+
+POOLER_STATS_KEY = 'pooler_stats'  # see db_pooler.py
+POOLER_QUERY_STATS_KEY = 'pooler_query_stats'
+
+r = redis.Redis(**POOLER_CONNECTION_PARAMS)
+
+
+def _authorized():
+    if not METRICS_TOKEN:
+        return False
+    header = request.headers.get('Authorization', '')
+    return hmac.compare_digest(header, f"Bearer {METRICS_TOKEN}")
+
+
+def _get_from_redis(key):
+    try:
+        payload = r.get(key)
+    except redis.RedisError:
+        return None
+    if payload is None:
+        return None
+    return decode_message(payload)[0]
+
+
+def _query_snapshots():
+    snapshots = {'server': QUERY_STATS.snapshot()}
+    pooler = _get_from_redis(POOLER_QUERY_STATS_KEY)
+    if pooler:
+        snapshots['pooler'] = pooler
+    return snapshots
+
+
+@bp.route('', methods=('GET',))
+def metrics():
+    if not _authorized():
+        return MyResponse(False, reason="Not authorized", status=403).to_json()
+
+    lines = []
+    for source, snapshot in _query_snapshots().items():
+        lines.extend(render_query_metrics(snapshot, prefix=f"{source}_db"))
+
+    pooler_stats = _get_from_redis(POOLER_STATS_KEY)
+    if pooler_stats:
+        lines.extend(render_gauges(pooler_stats, prefix="pooler"))
+        for i, depth in enumerate(pooler_stats.get('queue_depths', [])):
+            lines.append(f'pooler_queue_depth{{connection="{i}"}} {depth}')
+
+    lines.extend(render_gauges(lock_stats(), prefix="locks"))
+    lines.extend(render_gauges(RETRIEVER_CACHE.stats(), prefix="retriever_cache"))
+
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+# Most recent first
+@bp.route('/slow-queries', methods=('GET',))
+def slow_queries():
+    if not _authorized():
+        return MyResponse(False, reason="Not authorized", status=403).to_json()
+
+    slow = []
+    for source, snapshot in _query_snapshots().items():
+        slow.extend({'source': source, **x} for x in snapshot['slow'])
+    slow.sort(key=lambda x: x['time'], reverse=True)
+    return MyResponse(True, {'results': slow}).to_json()
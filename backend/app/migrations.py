@@ -0,0 +1,108 @@
+import sys
+from .db import needs_special_db, ProxyDB
+from .locks import acquire_lock, release_lock
+
+"""
+
+Brings an existing database up to date with mysql-init/schema.sql, which only runs when the database is first made.
+
+Each change is checked against information_schema before it's made, so running them again (on every start, from every process) does nothing.
+A change to schema.sql that later code relies on goes here too.
+
+"""
+
+MIGRATIONS_LOCK = 'schema_migrations'
+
+# (kind, table, name, definition) in the order they're made:
+# 'table' creates the table with the definition (its CREATE TABLE body) if it doesn't exist; name is unused
+# 'column' adds the column with the definition if the table doesn't have it
+# 'index' adds the index with the definition (its columns) if the table doesn't have one by that name
+SCHEMA_CHANGES = [
+    ('column', 'jobs', 'time_last_update', "DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"),
+    ('table', 'merged_retrieval_storage', None, """
+        `id` INT PRIMARY KEY AUTO_INCREMENT,
+        `asset_id` INT,
+        `key` VARCHAR(64),
+        `from` TEXT,
+        `path` TEXT,
+        `metadata` JSON,
+        `time_uploaded` DATETIME DEFAULT CURRENT_TIMESTAMP
+    """),
+    ('index', 'merged_retrieval_storage', 'idx_asset_id', "(`asset_id`)"),
+    ('index', 'merged_retrieval_storage', 'idx_key', "(`key`)"),
+    ('table', 'embedding_cache', None, """
+        `embedding_fn_code` VARCHAR(255),
+        `text_hash` CHAR(64),
+        `embedding` MEDIUMTEXT,
+        `time_uploaded` DATETIME DEFAULT CURRENT_TIMESTAMP,
+        `time_last_used` DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (`embedding_fn_code`, `text_hash`),
+        INDEX (`time_last_used`)
+    """),
+    ('column', 'embedding_cache', 'time_last_used', "DATETIME DEFAULT CURRENT_TIMESTAMP"),  # for tables made before pruning
+    ('index', 'embedding_cache', 'time_last_used', "(`time_last_used`)"),
+]
+
+
+def _exists(curr, kind, table, name):
+    if kind == 'table':
+        sql = """
+        SELECT COUNT(*) AS n FROM information_schema.TABLES
+        WHERE `TABLE_SCHEMA`=DATABASE() AND `TABLE_NAME`=%s
+        """
+        curr.execute(sql, (table,))
+    elif kind == 'column':
+        sql = """
+        SELECT COUNT(*) AS n FROM information_schema.COLUMNS
+        WHERE `TABLE_SCHEMA`=DATABASE() AND `TABLE_NAME`=%s AND `COLUMN_NAME`=%s
+        """
+        curr.execute(sql, (table, name))
+    elif kind == 'index':
+        sql = """
+        SELECT COUNT(*) AS n FROM information_schema.STATISTICS
+        WHERE `TABLE_SCHEMA`=DATABASE() AND `TABLE_NAME`=%s AND `INDEX_NAME`=%s
+        """
+        curr.execute(sql, (table, name))
+    else:
+        raise Exception(f"Unknown schema change kind {kind}")
+    return curr.fetchone()['n'] > 0
+
+
+def _make(curr, kind, table, name, definition):
+    if kind == 'table':
+        curr.execute(f"CREATE TABLE IF NOT EXISTS `{table}` ({definition})")
+    elif kind == 'column':
+        curr.execute(f"ALTER TABLE `{table}` ADD COLUMN `{name}` {definition}")
+    elif kind == 'index':
+        curr.execute(f"ALTER TABLE `{table}` ADD INDEX `{name}` {definition}")
+
+
+# Returns the number of changes made
+@needs_special_db(new_conn=True)
+def run_migrations(db: ProxyDB=None):
+    if acquire_lock(MIGRATIONS_LOCK) is None:
+        raise Exception("Couldn't get the schema migrations lock")
+    try:
+        n = 0
+        curr = db.cursor()
+        for kind, table, name, definition in SCHEMA_CHANGES:
+            if kind != 'table' and not _exists(curr, 'table', table, None):
+                continue  # nothing to change (a table this adds is made by its own 'table' change, before)
+            if _exists(curr, kind, table, name):
+                continue
+            print(f"Migrating schema: adding {kind} {name or table} to {table}.")
+            _make(curr, kind, table, name, definition)
+            n += 1
+        return n
+    finally:
+        release_lock(MIGRATIONS_LOCK)
+
+
+# For create_app: a failed migration is logged rather than keeping the server from starting
+def migrate():
+    try:
+        n = run_migrations()
+        if n:
+            print(f"Made {n} schema changes.")
+    except Exception as e:
+        print(f"Couldn't migrate the schema: {e}", file=sys.stderr)
@@ -0,0 +1,84 @@
+import json
+import msgpack
+from decimal import Decimal
+from .utils import make_json_serializable, make_json_scalar
+
+"""
+
+Wire codecs for the messages between the server and the db pooler (through Redis).
+
+JSON is the original format: data is walked to convert datetimes, dates and Decimals (see make_json_scalar in utils.py), then dumped.
+msgpack is smaller and much cheaper to encode/decode for big results (SELECT * over assets, jobs_storage, ...);
+it converts those same values as it comes across them, so nothing has to be walked beforehand.
+
+Every message says which codec it's in (JSON messages are untagged and start with '{', the others start with their tag byte).
+The pooler decodes whatever it's sent and answers in the same codec, so the server and pooler needn't be updated together.
+
+Either way, callers get the same Python values (as direct mode does): datetimes and dates as strings, Decimals as ints or floats, tuples as lists.
+The exceptions are what JSON can't carry at all: bytes (which msgpack keeps) and non-string dict keys (which JSON makes strings; DictCursor rows don't have any).
+Older senders put datetimes, dates and Decimals in msgpack extension types; those are still decoded, to the same values.
+
+"""
+
+# Extension types from older senders
+EXT_DATETIME = 1
+EXT_DATE = 2
+EXT_DECIMAL = 3
+
+
+# Called by msgpack for what it can't pack itself
+def _default(x):
+    converted = make_json_scalar(x)
+    if converted is x:
+        raise TypeError(f"Can't encode object of type {type(x)} for the db pooler")
+    return converted
+
+
+def _ext_hook(code, data):
+    if code == EXT_DATETIME or code == EXT_DATE:
+        return data.decode('ascii')
+    elif code == EXT_DECIMAL:
+        return make_json_scalar(Decimal(data.decode('ascii')))
+    return msgpack.ExtType(code, data)
+
+
+class JSONCodec():
+    name = 'json'
+    tag = b''
+
+    def encode(self, data) -> bytes:
+        return json.dumps(make_json_serializable(data)).encode('utf-8')
+
+    def decode(self, payload: bytes):
+        return json.loads(payload)
+
+
+class MsgpackCodec():
+    name = 'msgpack'
+    tag = b'\x01'
+
+    def encode(self, data) -> bytes:
+        return self.tag + msgpack.packb(data, default=_default, use_bin_type=True)
+
+    def decode(self, payload: bytes):
+        return msgpack.unpackb(payload[len(self.tag):], ext_hook=_ext_hook, raw=False, strict_map_key=False)
+
+
+CODECS = {
+    'json': JSONCodec(),
+    'msgpack': MsgpackCodec()
+}
+
+
+def encode_message(data, codec='json') -> bytes:
+    return CODECS[codec].encode(data)
+
+
+# Returns (data, name of the codec it was in)
+def decode_message(payload):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    for codec in CODECS.values():
+        if codec.tag and payload.startswith(codec.tag):
+            return codec.decode(payload), codec.name
+    return CODECS['json'].decode(payload), 'json'
@@ -0,0 +1,145 @@
+import re
+import time
+from collections import deque
+from threading import Lock
+
+"""
+
+Per-statement timings, recorded where queries actually run (the db pooler, or the direct pool in 'direct' mode).
+
+Statements are normalized into fingerprints (literals and placeholders become ?, lists of them become (?+), whitespace is squashed),
+and timings are added up per (calling endpoint, fingerprint), so that something like one permission query per child asset
+shows up as one fingerprint with a big count for one endpoint.
+
+Timings, in seconds:
+- queue_wait: waiting for the connection's worker
+- lock_wait: waiting for the connection's lock
+- execution: running the statement
+- serialization: encoding results to send back
+
+Statements that take longer than SLOW_QUERY_SECONDS to execute also go in a rolling slow query log.
+
+"""
+
+SLOW_QUERY_SECONDS = 1
+SLOW_LOG_SIZE = 200
+MAX_FINGERPRINTS = 2000  # (endpoint, fingerprint) pairs; past this, new ones are counted under OTHER_FINGERPRINT
+OTHER_FINGERPRINT = 'other'
+FINGERPRINT_MAX_LENGTH = 500
+TIMINGS = ['queue_wait', 'lock_wait', 'execution', 'serialization']
+
+_COMMENTS = re.compile(r"/\*.*?\*/|--[^\n]*", re.S)
+_STRINGS = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"")
+_PLACEHOLDERS = re.compile(r"%s|%\(\w+\)s")
+_NUMBERS = re.compile(r"\b\d+(?:\.\d+)?\b")
+_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE = re.compile(r"\s+")
+
+
+def fingerprint(sql):
+    sql = _COMMENTS.sub(" ", str(sql))
+    sql = _STRINGS.sub("?", sql)
+    sql = _PLACEHOLDERS.sub("?", sql)
+    sql = _NUMBERS.sub("?", sql)
+    sql = _LISTS.sub("(?+)", sql)
+    sql = _SPACE.sub(" ", sql).strip()
+    return sql[:FINGERPRINT_MAX_LENGTH]
+
+
+READ_STATEMENTS = ('SELECT', 'WITH', 'SHOW', 'DESCRIBE', 'EXPLAIN', '(')
+_LOCKING_READ = re.compile(r"\bFOR\s+(?:UPDATE|SHARE)\b|\bLOCK\s+IN\s+SHARE\s+MODE\b")
+
+
+# Whether a cursor call could write something, or take locks held until the next commit (anything executed that isn't a plain read)
+# The one check for db.py's read-your-writes and read-only connections, and for the pooler's and direct mode's dirty connections
+def is_write(name, args):
+    if name not in ('execute', 'executemany'):
+        return False
+    if not len(args):
+        return True
+    sql = _COMMENTS.sub(" ", str(args[0])).lstrip().upper()
+    if not sql.startswith(READ_STATEMENTS):
+        return True
+    return ('FOR' in sql or 'LOCK' in sql) and _LOCKING_READ.search(_STRINGS.sub("?", sql)) is not None
+
+
+class QueryStats():
+    def __init__(self, max_fingerprints=MAX_FINGERPRINTS, slow_query_seconds=SLOW_QUERY_SECONDS, slow_log_size=SLOW_LOG_SIZE) -> None:
+        self.max_fingerprints = max_fingerprints
+        self.slow_query_seconds = slow_query_seconds
+        self.lock = Lock()
+        self.stats = {}  # (endpoint, fingerprint) -> {'count', each of TIMINGS, 'max_execution'}
+        self.slow = deque(maxlen=slow_log_size)
+
+    # count=0 adds timings (like serialization) to a statement that was already counted
+    def record(self, endpoint, fp, count=1, sql=None, **timings):
+        endpoint = endpoint or 'none'
+        with self.lock:
+            key = (endpoint, fp)
+            if key not in self.stats and len(self.stats) >= self.max_fingerprints:
+                key = (endpoint, OTHER_FINGERPRINT)
+            if key not in self.stats:
+                self.stats[key] = {'count': 0, 'max_execution': 0., **{x: 0. for x in TIMINGS}}
+            entry = self.stats[key]
+            entry['count'] += count
+            for name, val in timings.items():
+                entry[name] += val
+            execution = timings.get('execution', 0)
+            entry['max_execution'] = max(entry['max_execution'], execution)
+            if execution >= self.slow_query_seconds:
+                self.slow.append({
+                    'time': time.time(),
+                    'endpoint': endpoint,
+                    'fingerprint': fp,
+                    'sql': str(sql)[:FINGERPRINT_MAX_LENGTH] if sql is not None else fp,
+                    **timings
+                })
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'statements': [{'endpoint': k[0], 'fingerprint': k[1], **v} for k, v in self.stats.items()],
+                'slow': list(self.slow)
+            }
+
+
+QUERY_STATS = QueryStats()
+
+
+def _label(val):
+    return str(val).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Prometheus text format for a QueryStats snapshot
+def render_query_metrics(snapshot, prefix='db'):
+    lines = [
+        f"# HELP {prefix}_statements_total Statements executed, by calling endpoint and fingerprint.",
+        f"# TYPE {prefix}_statements_total counter"
+    ]
+    for x in snapshot['statements']:
+        lines.append(f'{prefix}_statements_total{{endpoint="{_label(x["endpoint"])}",fingerprint="{_label(x["fingerprint"])}"}} {x["count"]}')
+    lines.extend([
+        f"# HELP {prefix}_statement_seconds_total Time spent on statements, by phase.",
+        f"# TYPE {prefix}_statement_seconds_total counter"
+    ])
+    for x in snapshot['statements']:
+        for phase in TIMINGS:
+            lines.append(f'{prefix}_statement_seconds_total{{endpoint="{_label(x["endpoint"])}",fingerprint="{_label(x["fingerprint"])}",phase="{phase}"}} {x[phase]}')
+    lines.extend([
+        f"# HELP {prefix}_statement_max_execution_seconds Longest execution seen.",
+        f"# TYPE {prefix}_statement_max_execution_seconds gauge"
+    ])
+    for x in snapshot['statements']:
+        lines.append(f'{prefix}_statement_max_execution_seconds{{endpoint="{_label(x["endpoint"])}",fingerprint="{_label(x["fingerprint"])}"}} {x["max_execution"]}')
+    return lines
+
+
+# Prometheus text format for a flat dict of numbers (e.g., cache stats)
+def render_gauges(stats: dict, prefix):
+    lines = []
+    for k, v in stats.items():
+        if isinstance(v, bool) or not isinstance(v, (int, float)):
+            continue
+        lines.append(f"# TYPE {prefix}_{k} gauge")
+        lines.append(f"{prefix}_{k} {v}")
+    return lines
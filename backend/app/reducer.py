@@ -183,7 +183,7 @@ class Reducer():
                 
                 this_round_count = 0
 
-                for _ in stream_progress_batched_lm(get_data(), get_lm_part=get_lm_part, streamingCallback=stream_cb, lm=LM_PROVIDERS[FAST_CHAT_MODEL]):
+                for _ in stream_progress_batched_lm(get_data(), get_lm_part=get_lm_part, streamingCallback=stream_cb, lm=LM_PROVIDERS[FAST_CHAT_MODEL], cache=True):
                     this_round_count += 1
                     new_val = round(progress/total, 2)
                     update_job_progress(job_id, new_val, db=db)
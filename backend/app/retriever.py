@@ -1,31 +1,39 @@
-from sklearn.metrics import pairwise
 import numpy as np
 from .auth import User
-from .exceptions import NoCreateError, RetrieverEmbeddingsError, ZipFileRetrieverError
-from .jobs import complete_job, mark_job_error, update_job_progress, store_in_job
+from .exceptions import NoCreateError, RetrieverEmbeddingsError, ZipFileRetrieverError, JobMismatchError
+from .jobs import complete_job, mark_job_error, update_job_progress, store_in_job, get_job_storage_values, get_job, job_runner_lock
+from .locks import acquire_lock, release_lock
 from .batch_and_stream_lm import stream_batched_lm, stream_progress_batched_lm
 from .prompts.retrieval_prompts import guess_answer_prompt, guess_answer_prompt_backup
 import json
 import sys
 from .integrations.lm import LM, LM_PROVIDERS, get_safe_retrieval_context_length, FAST_CHAT_MODEL, DEFAULT_CHAT_MODEL
+from .lm_governor import run_governed, BACKGROUND
 from .integrations.file_loaders import get_loader, TextSplitter
-from .utils import make_json_serializable, ntokens_to_nchars, get_extension_from_path
+from .utils import make_json_serializable, ntokens_to_nchars, get_extension_from_path, normalize_embeddings
 import tempfile
 import warnings
-from .storage_interface import download_file, upload_retriever
+from .storage_interface import download_file, upload_retriever, delete_resources_from_storage
+from .chunk_store import ChunkStore, ChunkStoreWriter, is_chunk_store, convert_legacy_chunk_file, copy_with_ann_index
+from .ann_index import IVF_SECTIONS, build_ivf_index
+from .configs.user_config import ANN_INDEX_MIN_CHUNKS, ANN_NPROBE, MERGED_INDEX_MIN_RESOURCES
+from .embedding_cache import embed_with_cache
+from .merged_index import MergedIndex, make_merged_index_key, load_merged_index, build_merged_index
+from .retriever_cache import RETRIEVER_CACHE, RetrieverCacheEntry, make_retriever_cache_key
 import os
 import pickle
-from .db import needs_special_db, get_db
+from .db import needs_special_db, get_db, ProxyDB
 from .configs.str_constants import APPLIER_RESPONSE
 from .utils import remove_ext
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
 import math
-from difflib import SequenceMatcher
 import random
+import hashlib
 from .prompts.auto_label_prompts import get_auto_desc_system_prompt
 from .utils import get_token_estimate, convert_heic_to_jpg
 from .integrations.ocr import OCR_PROVIDERS, OCR
-from .integrations.embed import EMBED_PROVIDERS, Embed, DEFAULT_EMBEDDING_OPTION
+from .integrations.embed import EMBED_PROVIDERS, BULK_EMBED_PROVIDERS, Embed, DEFAULT_EMBEDDING_OPTION
 import time
 
 
@@ -110,6 +118,57 @@ def _dup_score(chunk1, chunk2, n=6):
     return score
 
 
+# Cosine similarity of each row of embeddings with query_vec (which should already be unit length)
+# If the embeddings are normalized (as they are when made by _embed_chunks), it's a single float32 matrix-vector product.
+# Rows with zero norm get a score of 0, as with sklearn's cosine_similarity
+def _cosine_scores(embeddings, query_vec, normalized=False):
+    if normalized:
+        return embeddings @ query_vec
+    norms = np.linalg.norm(embeddings, axis=1)
+    norms[norms == 0] = 1
+    return (embeddings @ query_vec) / norms
+
+
+# Indices of the k largest points, best first (ties go to the lower index)
+def _top_k(points, k):
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    if k < len(points):
+        candidates = np.sort(np.argpartition(-points, k-1)[:k])
+    else:
+        candidates = np.arange(len(points))
+    return candidates[np.argsort(-points[candidates], kind='stable')]
+
+
+# use_ann: None = only if the store is big enough to carry an index; True/False = always/never
+def _should_use_ann(store: ChunkStore, use_ann=None):
+    if not store.has_embeddings or len(store) == 0:
+        return False
+    if use_ann is None:
+        return len(store) >= ANN_INDEX_MIN_CHUNKS
+    return bool(use_ann)
+
+
+# Scores the chunks of a store against a (normalized) query vector.
+# Returns (scores, positions): with the ANN index, only the chunks in the probed lists are scored; otherwise every chunk is.
+def _score_store(store: ChunkStore, query_vec, use_ann=None):
+    if not store.has_embeddings or len(store) == 0:
+        return np.zeros((0,), dtype=np.float32), np.zeros((0,), dtype=np.int64)
+
+    embeddings = store.embeddings  # memory-mapped
+    if _should_use_ann(store, use_ann):
+        positions = store.ann_index.candidates(query_vec, nprobe=ANN_NPROBE)
+        embeddings = embeddings[positions]
+    else:
+        positions = np.arange(len(embeddings), dtype=np.int64)
+
+    try:
+        points = _cosine_scores(embeddings, query_vec, normalized=store.normalized)
+    except ValueError:
+        raise RetrieverEmbeddingsError("Value error trying to compare embeddings; something went wrong with embeddings.")
+    return points, positions
+
+
 # Asset level
 class Retriever():
     
@@ -117,9 +176,14 @@ class Retriever():
                 chunk_size_tokens=400, 
                 chunk_overlap_tokens=10, lm: LM=LM_PROVIDERS[DEFAULT_CHAT_MODEL],
                 embedding_fn_code=None,
-                skip_embedding=False, no_create=False, force_ocr=False, force_create=False):
+                skip_embedding=False, no_create=False, force_ocr=False, force_create=False, no_cache=False,
+                use_ann=None,  # None = use the ANN index for resources with >= ANN_INDEX_MIN_CHUNKS chunks; True/False = always/never
+                use_merged_index=None,  # None = query a merged index when there are >= MERGED_INDEX_MIN_RESOURCES resources; True/False = always/never
+                asset_id=None,  # the asset this retriever is for, if any, so that its merged index can be updated incrementally
+                job_id=None):  # if being made in a job, embedding progress is reported to it
 
         self.user = user
+        self.use_ann = use_ann
 
         self.chunk_size_tokens = chunk_size_tokens
         self.chunk_overlap_tokens = chunk_overlap_tokens
@@ -142,37 +206,78 @@ class Retriever():
             raise Warning("Custom embedding function provided without identifying embedding_fn_code argument")
         self.embedding_fn_code = embedding_fn_code
 
-        self.resource_retrievers = []
+        # Kept so that resource retrievers can be made later (see resource_retrievers)
+        self._resource_retriever_kwargs = {
+            'chunk_size_tokens': self.chunk_size_tokens,
+            'chunk_overlap_tokens': self.chunk_overlap_tokens,
+            'lm': self.lm,
+            'embedding_fn_code': self.embedding_fn_code,
+            'skip_embedding': skip_embedding,
+            'retriever_type_name': self.retriever_type_name,
+            'no_create': no_create,
+            'force_ocr': force_ocr,
+            'force_create': force_create,
+            'no_cache': no_cache,
+            'use_ann': use_ann
+        }
+
+        self._resource_retrievers = None
+        self.merged_index: MergedIndex = None
+
+        use_merged_index = self._should_merge(use_merged_index)
+        if use_merged_index and not (force_create or force_ocr):
+            self.merged_index = self._get_or_build_merged_index(asset_id=asset_id, no_cache=no_cache)
+
+        # Without a merged index, every resource is needed up front
+        if self.merged_index is None:
+            self._resource_retrievers = self._make_resource_retrievers(resources, job_id=job_id)
+            if use_merged_index:
+                # Forced (re)creation: the merged index is rebuilt from scratch
+                self.merged_index = self._get_or_build_merged_index(asset_id=asset_id, no_cache=no_cache, rebuild=True)
+
+
+    # Resource retrievers are made on first use when there's a merged index (which is enough to query)
+    @property
+    def resource_retrievers(self):
+        if self._resource_retrievers is None:
+            self._resource_retrievers = self._make_resource_retrievers(self.resources)
+        return self._resource_retrievers
+
+
+    # Returns ResourceRetrievers for resources, in the same order
+    # With a job_id, the job's progress is the average embedding progress of the resources
+    def _make_resource_retrievers(self, resources, job_id=None):
+
+        progress = [0.] * len(resources)
+        progress_lock = Lock()
+        def make_on_progress(i):
+            def on_progress(frac):
+                with progress_lock:
+                    progress[i] = frac
+                    total = sum(progress) / len(progress)
+                try:
+                    update_job_progress(job_id, round(total, 2))
+                except Exception as e:
+                    print(f"Couldn't update progress of job {job_id}: {e}", file=sys.stderr)
+            return on_progress if job_id is not None else None
 
         # Create resource retrievers in multi-threaded fashion.
-        def create_retriever(res):
-            return ResourceRetriever(
-                user,
-                res,
-                chunk_size_tokens=self.chunk_size_tokens,
-                chunk_overlap_tokens=self.chunk_overlap_tokens,
-                lm=self.lm,
-                embedding_fn_code=self.embedding_fn_code,
-                skip_embedding=skip_embedding,
-                retriever_type_name=self.retriever_type_name,
-                no_create=no_create,
-                force_ocr=force_ocr,
-                force_create=force_create
-            )
+        def create_retriever(i, res):
+            return ResourceRetriever(self.user, res, on_progress=make_on_progress(i), **self._resource_retriever_kwargs)
 
-        self.resource_retrievers = []
+        resource_retrievers = [None] * len(resources)
         futures = []
 
         # Initialize ThreadPoolExecutor
         with ThreadPoolExecutor(max_workers=10) as executor:
             try:
                 # Schedule retriever creation and get Future objects
-                futures = {executor.submit(create_retriever, res): res for res in resources}
+                futures = {executor.submit(create_retriever, i, res): i for i, res in enumerate(resources)}
 
                 # Collect results as they complete
                 for future in as_completed(futures):
                     ret = future.result()  # Will raise an exception if the retriever creation failed
-                    self.resource_retrievers.append(ret)
+                    resource_retrievers[futures[future]] = ret
 
             except:
                 """
@@ -184,26 +289,87 @@ class Retriever():
                 
                 """
                 # Clean up if any retriever creation fails
-                for ret in self.resource_retrievers:
-                    ret.delete()
+                for ret in resource_retrievers:
+                    if ret is not None:
+                        ret.delete()
                 raise
-        
+
+        return resource_retrievers
+
+
+    def _should_merge(self, use_merged_index):
+        if use_merged_index is False or self.skip_embedding:
+            return False
+        if any(res['id'] == -1 for res in self.resources):  # synthetic resources aren't stored, so can't be merged
+            return False
+        if use_merged_index is None:
+            return len(self.resources) >= MERGED_INDEX_MIN_RESOURCES
+        return True
+
+
+    # Returns None if the merged index can't be had; queries then go through the resource retrievers as usual.
+    def _get_or_build_merged_index(self, asset_id=None, no_cache=False, rebuild=False):
+        retriever_options = {
+            'chunk_size_tokens': self.chunk_size_tokens,
+            'chunk_overlap_tokens': self.chunk_overlap_tokens,
+            'skip_embedding': self.skip_embedding,
+            'embedding_fn_code': self.embedding_fn_code
+        }
+        if not rebuild:
+            key = make_merged_index_key(self.resources, self.retriever_type_name, retriever_options)
+            merged = load_merged_index(key, no_cache=no_cache, new_conn=True)
+            if merged is not None:
+                return merged
+
+        # Only the members that aren't in the asset's previous merged index need to be made/loaded
+        made = []
+        def get_resource_stores(needed):
+            if self._resource_retrievers is not None:
+                rets = [self._resource_retrievers[i] for i in needed]
+            else:
+                rets = self._make_resource_retrievers([self.resources[i] for i in needed])
+                made.extend(rets)
+            return {i: ret._get_store() for i, ret in zip(needed, rets)}
+
+        try:
+            return build_merged_index(
+                self.resources,
+                self.retriever_type_name,
+                retriever_options,
+                get_resource_stores,
+                asset_id=asset_id,
+                reuse_previous=not rebuild,
+                no_cache=no_cache,
+                new_conn=True
+            )
+        except NoCreateError:
+            raise
+        except Exception as e:
+            print(f"Couldn't build merged index: {e}", file=sys.stderr)
+            return None
+        finally:
+            for ret in made:
+                ret.delete()
+
+
     # Unfortunately __del__ wasn't getting called automatically at exit
     def delete_resource_retrievers(self):
-        for ret in self.resource_retrievers:
+        for ret in (self._resource_retrievers or []):
             ret.delete()
+        if self.merged_index is not None:
+            self.merged_index.delete()
 
 
     def _get_plausible_answers(self, txt):        
         # First, get plausible answers
         prompt = guess_answer_prompt(txt)
-        llm_answer_resp = self.lm.run(prompt)
+        llm_answer_resp = run_governed(self.lm, prompt)
 
         try:
             answers = json.loads(llm_answer_resp)
         except json.JSONDecodeError:
             prompt = guess_answer_prompt_backup(txt)
-            llm_answer_resp = self.lm.run(prompt)
+            llm_answer_resp = run_governed(self.lm, prompt)
         
         try:
             answers = json.loads(llm_answer_resp)
@@ -220,9 +386,6 @@ class Retriever():
             embeddings = ret.load_embeddings()
             yield embeddings
 
-    def _name_dup_score(self, name1, name2):
-        return SequenceMatcher(None, name1, name2).ratio()
-
 
     # Get as many chunks as possible given the size of the model
     def max_chunks(self, lm: LM, context="", safe_context_length=None, use_ends=False):
@@ -272,8 +435,8 @@ class Retriever():
                 max_results=5,
                 enable_plausible_answers_scheme=False,  # increases time to response by 1 request
                 context=[],
-                enable_dup_and_diversity_scheme=False,  # can cause major performance issues
-                dup_cutoff=.5,
+                enable_dup_and_diversity_scheme=False,
+                dup_cutoff=.5,  # n-gram overlap (see _dup_score) above which a chunk counts as a duplicate of a chosen one
                 diversity_reward=1.5):
 
         assert(len(additional_sources) == len(additional_source_names))
@@ -284,78 +447,96 @@ class Retriever():
 
         to_embed = [txt] + plausible_answers + context
         embed_obj: Embed = EMBED_PROVIDERS[self.embedding_fn_code]
-        query_embeddings = embed_obj.embed(to_embed)
+        query_embeddings = np.array(embed_obj.embed(to_embed), dtype=np.float32)
 
         extra_sources_chunks = [Chunk(-1, additional_source_names[i], additional_sources[i]) for i in range(len(additional_sources))]
-        extra_sources_scores = [float('inf') for _ in range(len(extra_sources_chunks))]
 
-        best_chunks = [*extra_sources_chunks]
-        best_scores = [*extra_sources_scores]
-
-        for ret in self.resource_retrievers:
-            ret: ResourceRetriever
-            # a lot of the architecture of the retriever is to avoid this;
-            # but unfortunately I think this is the best way, barring improvements to the chunk file.
-            # it would be better to rely on mysqlite here or something like that instead. TODO
-            chunks_in_memory = [chunk for chunk in ret.get_chunks()]
-            if len(chunks_in_memory) == 0:
-                continue
-            embeddings = [c.embedding for c in chunks_in_memory]
-            embeddings = np.array(embeddings)
-
-            try:
-                sims = pairwise.cosine_similarity(query_embeddings, embeddings, dense_output=True)
-            except:
-                raise RetrieverEmbeddingsError("Value error trying to compare embeddings; something went wrong with embeddings.")
-
-            # Assign points for each chunk (for now, just a sum of similarity scores)
-            points = np.array(sims[0])  # first one is original question
-            for i in range(1, len(sims)):
-                points += sims[i] / max(len(sims), 3)  # formula for weighting importance of queries/context
-
-            ranking = points.argsort()[::-1]
-            
-            # Get the deduplicated top k
-            for i, x in enumerate(ranking):
-                curr_source: Chunk = chunks_in_memory[x]
-
-                # Check similarity score for diversity
-                if enable_dup_and_diversity_scheme:
-                    is_duplicate_source = True
-                    for s in [x.source_name for x in best_chunks]:
-                        if self._name_dup_score(curr_source.source_name, s) > 0.90:
-                            is_duplicate_source = False
-                    
-                    if is_duplicate_source:
-                        points[x] *= diversity_reward
+        # The score of a chunk is its similarity to the original question plus a weighted sum of its similarities to plausible answers/context
+        # Since similarity is linear in the (normalized) query, that's one similarity with a combined query vector.
+        query_embeddings = normalize_embeddings(query_embeddings)
+        weights = np.full(len(query_embeddings), 1 / max(len(query_embeddings), 3), dtype=np.float32)  # formula for weighting importance of queries/context
+        weights[0] = 1  # first one is original question
+        query_vec = weights @ query_embeddings
+
+        scored = self._score_all(query_vec)
+        if scored is None:
+            return extra_sources_chunks
+        points, ret_indices, positions = scored
+
+        # Additional sources always come first
+        n_chunks = max_results - len(extra_sources_chunks)
+        if enable_dup_and_diversity_scheme:
+            best_chunks = self._diverse_top_k(points, ret_indices, positions, n_chunks, dup_cutoff=dup_cutoff, diversity_reward=diversity_reward,
+                                              chosen_txts=[x.txt for x in extra_sources_chunks])
+        else:
+            best_chunks = [self._chunk_at(ret_indices[i], positions[i]) for i in _top_k(points, n_chunks)]
 
-                # The 1.5 is thrown in to look out for potential dup score benefits
-                if len(best_scores) and (len(best_scores) >= (max_results * 1.5) and best_scores[-1] > points[x]):
-                    break
+        return [*extra_sources_chunks, *best_chunks][:max_results]
 
-                if enable_dup_and_diversity_scheme:
-                    # If it's already in best_chunks, forget it!
-                    if any(_dup_score(curr_source.txt, y.txt) > dup_cutoff for y in best_chunks):
-                        continue
 
-                # Otherwise, put it in its proper place
-                for i in range(len(best_chunks) + 1):
-                    if i >= len(best_chunks):  # if we're at the end
-                        best_scores.append(points[x])
-                        best_chunks.append(curr_source)
-                        break
-                    if best_scores[i] < points[x]:
-                        best_scores.insert(i, points[x])
-                        best_chunks.insert(i, curr_source)
-                        break
+    # Scores every chunk (or, with ANN, every candidate chunk) in every resource, keeping track of where each score came from.
+    # Returns (points, ret_indices, positions) - ret_indices being into self.resources - or None if there's nothing to score.
+    def _score_all(self, query_vec):
+        if self.merged_index is not None:
+            points, positions = _score_store(self.merged_index.get_store(), query_vec, use_ann=self.use_ann)
+            if not len(points):
+                return None
+            return points, np.asarray(self.merged_index.member_indices[positions]), positions
 
-                best_chunks = best_chunks[:max_results]
-                best_scores = best_scores[:max_results]
-        
-        return best_chunks
+        all_points = []
+        all_ret_indices = []
+        all_positions = []
+        for k, ret in enumerate(self.resource_retrievers):
+            ret: ResourceRetriever
+            points, positions = ret.score(query_vec)  # only the chosen chunks' text is ever read
+            if len(points) == 0:
+                continue
+            all_points.append(points)
+            all_ret_indices.append(np.full(len(points), k, dtype=np.int64))
+            all_positions.append(positions)
+
+        if not len(all_points):
+            return None
+
+        return np.concatenate(all_points), np.concatenate(all_ret_indices), np.concatenate(all_positions)
+
+
+    # pos is a position in the merged index if there is one, else in the ResourceRetriever at ret_index
+    def _chunk_at(self, ret_index, pos):
+        if self.merged_index is not None:
+            return self.merged_index.get_store().get_chunk(int(pos))
+        return self.resource_retrievers[ret_index].get_chunk_at(pos)
+
+
+    # MMR-style re-rank over the best few candidates:
+    # chunks from resources that aren't represented yet get their score multiplied by diversity_reward,
+    # and anything whose text overlaps an already-chosen chunk (or one of chosen_txts) by more than dup_cutoff (see _dup_score) is dropped as a duplicate.
+    # Only the candidates looked at are read. Returns the chosen chunks, best first.
+    def _diverse_top_k(self, points, ret_indices, positions, k, dup_cutoff=.5, diversity_reward=1.5, chosen_txts=[], pool_factor=4):
+        pool = _top_k(points, k * pool_factor)
+        relevance = points[pool]
+        pool_rets = ret_indices[pool]
+        available = np.ones(len(pool), dtype=bool)
+        represented = np.zeros(len(self.resources), dtype=bool)
+        chosen_txts = list(chosen_txts)
+        chosen = []
+        while len(chosen) < k and available.any():
+            adjusted = np.where(represented[pool_rets], relevance, relevance * diversity_reward)
+            adjusted = np.where(available, adjusted, -np.inf)
+            best = int(np.argmax(adjusted))
+            available[best] = False
+            chunk = self._chunk_at(pool_rets[best], positions[pool[best]])
+            if any(_dup_score(chunk.txt, x) > dup_cutoff for x in chosen_txts):
+                continue
+            chosen.append(chunk)
+            chosen_txts.append(chunk.txt)
+            represented[pool_rets[best]] = True
+        return chosen
 
     # In chunks
     def size(self):
+        if self.merged_index is not None:
+            return self.merged_index.size
         n = 0
         for ret in self.resource_retrievers:
             ret: ResourceRetriever
@@ -363,6 +544,8 @@ class Retriever():
         return n
 
     def chunk_names(self):
+        if self.merged_index is not None:
+            return list(self.merged_index.chunk_names)
         names = []
         for ret in self.resource_retrievers:
             ret: ResourceRetriever
@@ -370,6 +553,8 @@ class Retriever():
         return names
     
     def chunk_lengths(self):
+        if self.merged_index is not None:
+            return list(self.merged_index.chunk_lengths)
         lengths = []
         for ret in self.resource_retrievers:
             ret: ResourceRetriever
@@ -377,38 +562,57 @@ class Retriever():
         return lengths
     
     def get_chunks(self):
+        if self.merged_index is not None:
+            for chunk in self.merged_index.get_store():
+                yield chunk
+            return
         for ret in self.resource_retrievers:
             ret: ResourceRetriever
             for chunk in ret.get_chunks():
                 yield chunk
 
+    # chunk_indices are chunk.index's; returns the first chunk (across resources) with each, or None, in the order given
+    def get_chunks_by_indices(self, chunk_indices):
+        found = [None] * len(chunk_indices)
+        if self.merged_index is not None:
+            stores = [self.merged_index.get_store()]
+        else:
+            stores = (ret._get_store() for ret in self.resource_retrievers)
+        for store in stores:
+            missing = [i for i, x in enumerate(found) if x is None]
+            if not len(missing):
+                break
+            for i, chunk in zip(missing, store.get_chunks_by_indices([chunk_indices[i] for i in missing])):
+                found[i] = chunk
+        return found
+
     # This isn't used much and should be merged with .query
     def search(self, txt, max_results=5):
 
         embed_obj: Embed = EMBED_PROVIDERS[self.embedding_fn_code]
-        query_embeddings = embed_obj.embed([txt])
-        
-        embeddings = self._load_embeddings()
+        query_vec = normalize_embeddings(embed_obj.embed([txt]))[0]
 
         best_chunks = []
         best_scores = []
 
-        for i, ret_embed in enumerate(embeddings):
-            sims = pairwise.cosine_similarity(query_embeddings, ret_embed, dense_output=True)
-            points = np.array(sims[0])
+        for i, ret in enumerate(self.resource_retrievers):
+            ret: ResourceRetriever
+            points, positions = ret.score(query_vec)
+            if len(points) == 0:
+                continue
             ranking = points.argsort()[::-1]
 
-            chosen_indices = ranking[:max_results]
-            chunks = self.resource_retrievers[i].get_chunks_by_indices(chosen_indices)
+            chosen = ranking[:max_results]
+            chunks = ret.get_chunks_at(positions[chosen])
 
             for k, curr_source in enumerate(chunks):
                 for i in range(len(best_chunks) + 1):
                     if i >= len(best_chunks):
-                        best_scores.append(points[chosen_indices[k]])
+                        best_scores.append(points[chosen[k]])
                         best_chunks.append(curr_source)
                         break
-                    if best_scores[i] < points[chosen_indices[k]]:
-                        best_scores.insert(i, points[chosen_indices[k]])
+                    if best_scores[i] < points[chosen[k]]:
+                        best_scores.insert(i, points[chosen[k]])
                         best_chunks.insert(i, curr_source)
                         break
 
@@ -418,27 +622,52 @@ class Retriever():
         return best_chunks
 
 
+    # Identifies what apply works through, as batched for these options: the chunks of each resource, in order
+    # A job's stored responses only line up with a retriever and options that have the same fingerprint (e.g., not after a re-upload)
+    def apply_fingerprint(self, prompt, prompt_first=False, combine_chunks=1):
+        h = hashlib.sha256(json.dumps({'prompt': prompt, 'prompt_first': prompt_first, 'combine_chunks': combine_chunks}).encode('utf-8'))
+        for ret in self.resource_retrievers:
+            ret: ResourceRetriever
+            h.update(f"\0resource:{ret.resource_manifest['id']}:{ret.size}".encode('utf-8'))
+            for chunk in ret.get_chunks():
+                h.update(b"\0")
+                h.update(chunk.txt.encode('utf-8'))
+        return h.hexdigest()
+
+    # cache and refresh_cache are for the LM response cache (see integrations/lm.py)
+    # As a job, it picks up where it left off: batches with a response already in the job's storage are skipped (see resume_summary_apply_job),
+    # as long as they were stored under the same apply_fingerprint. Only one runner works on a job at a time (see job_runner_lock).
     @needs_special_db(consistent_conn=True)
-    def apply(self, prompt, prompt_first=False, excerpt_wrapper=lambda x:x, job_id=None, combine_chunks=1, model_code=None, db=None):        
+    def apply(self, prompt, prompt_first=False, excerpt_wrapper=lambda x:x, job_id=None, combine_chunks=1, model_code=None, cache=False, refresh_cache=False, db=None):        
         # Go over each chunk and give a response
         before_prompt = prompt+"\n" if prompt_first else ""
         after_prompt = "\n"+prompt if not prompt_first else ""
 
         system_prompt = f"Follow these instructions.\n\n{prompt}"
+        # Batches of up to combine_chunks chunks (never across resources), with where their chunks came from
         def get_data():
+            position = 0  # of the chunk across resources
             for ret in self.resource_retrievers:
                 ret: ResourceRetriever
-                prompts = []
+                batch = []
                 for chunk in ret.get_chunks():  # I hope this goes in order :|
-                    prompt = f"{before_prompt}{excerpt_wrapper(chunk.txt)}{after_prompt}"
-                    prompts.append(prompt)
-                    if len(prompts) >= combine_chunks:
-                        joined = "".join(prompts)
-                        yield {'text': f"{before_prompt}{joined}{after_prompt}", 'sys': system_prompt}
-                        prompts = []
-                if prompts:
-                    joined = "".join(prompts)
-                    yield {'text': f"{before_prompt}{joined}{after_prompt}", 'sys': system_prompt}
+                    batch.append((position, chunk))
+                    position += 1
+                    if len(batch) >= combine_chunks:
+                        yield make_batch(batch)
+                        batch = []
+                if batch:
+                    yield make_batch(batch)
+
+        def make_batch(batch):
+            joined = "".join([f"{before_prompt}{excerpt_wrapper(chunk.txt)}{after_prompt}" for _, chunk in batch])
+            return {
+                'text': f"{before_prompt}{joined}{after_prompt}",
+                'sys': system_prompt,
+                'chunk_indices': [i for i, _ in batch],
+                'chunk_names': [chunk.source_name for _, chunk in batch],
+                'chunk_texts': [chunk.txt for _, chunk in batch]
+            }
 
 
         # Behavior: if it's a job, yields progress updates.
@@ -447,32 +676,44 @@ class Retriever():
         # Make it a job if there's a job_id, otherwise not
 
         if job_id:
+            runner_lock = job_runner_lock(job_id)
+            if acquire_lock(runner_lock, timeout=0) is None:
+                print(f"Apply job {job_id} is already being run elsewhere; not running it again.", file=sys.stderr)
+                return
             db = get_db(consistent_conn=True)
             try:
+                job = get_job(job_id, db=db)
+                if not job or job['is_complete']:
+                    return
+
+                fingerprint = self.apply_fingerprint(prompt, prompt_first=prompt_first, combine_chunks=combine_chunks)
+                if any(x != fingerprint for x in get_job_storage_values(job_id, 'fingerprint', name=APPLIER_RESPONSE, db=db)):
+                    raise JobMismatchError()
+
                 size = math.ceil(self.size() / combine_chunks)
+                done = set(get_job_storage_values(job_id, 'chunk_index', name=APPLIER_RESPONSE, db=db))
 
-                chunk_texts = []
-                chunk_names = []
-                for chunk in self.get_chunks():
-                    chunk_names.append(chunk.source_name)
-                    chunk_texts.append(chunk.txt)
-                
-                def streamingCallback(result, index, _):  # the underscore because we don't use the input data here
+                # chunk_index is the batch's index, which is what's skipped on resume (and what the reducer orders by); chunk_indices are its chunks' positions
+                def streamingCallback(result, index, data):
                     val = {
-                        'chunk_name': chunk_names[index],
+                        'chunk_name': ", ".join(dict.fromkeys(data['chunk_names'])),
                         'instruction': prompt,
                         'chunk_index': index,
-                        'chunk_text': chunk_texts[index]
+                        'chunk_indices': data['chunk_indices'],
+                        'chunk_text': "\n\n".join(data['chunk_texts']),
+                        'fingerprint': fingerprint
                     }
                     store_in_job(job_id, name=APPLIER_RESPONSE, text_data=result, metadata=val, db=db)
 
-                progress = 0
+                progress = len(done)
+                if progress:
+                    update_job_progress(job_id, round(progress/size, 2), db=db)
 
                 real_lm = LM_PROVIDERS[FAST_CHAT_MODEL]
                 if model_code:
                     real_lm: LM = LM_PROVIDERS[model_code]
 
-                for i in stream_progress_batched_lm(get_data(), get_lm_part=lambda x: x['text'], get_sys_part=lambda x: x['sys'], streamingCallback=streamingCallback, lm=real_lm):
+                for i in stream_progress_batched_lm(get_data(), get_lm_part=lambda x: x['text'], get_sys_part=lambda x: x['sys'], streamingCallback=streamingCallback, lm=real_lm, cache=cache, refresh_cache=refresh_cache, skip=done):
                     yield i
                     progress += 1
                     update_job_progress(job_id, round(progress/size, 2), db=db)
@@ -481,12 +722,13 @@ class Retriever():
 
             except:
                 print(f"Error ocurred in apply; manually marking.", file=sys.stderr)
-                mark_job_error(job_id, db=db)
+                mark_job_error(job_id, keep_storage=True, db=db)  # so it can be resumed
             finally:
                 db.close()
+                release_lock(runner_lock)
                     
         else:
-            for result, _ in stream_batched_lm(get_data()):
+            for result, _ in stream_batched_lm(get_data(), cache=cache, refresh_cache=refresh_cache):
                 yield result
 
     # Get n random chunks
@@ -537,8 +779,10 @@ class Retriever():
 
 """
 
-NOTE: in the future, might make sense to give embeddings their own temp file within ResourceRetriever
-That file would be loaded all at once, and the index of an embedding would serve as an index into the more memory efficient chunk file
+Chunks are stored in a chunk store (see chunk_store.py): embeddings are a memory-mapped matrix,
+and the text of any chunk can be read by its position in the file without reading the others.
+
+Retrievers made before the chunk store existed are streams of pickled Chunks; they're converted when next loaded.
 
 """
 
@@ -550,9 +794,11 @@ class ResourceRetriever():
                 chunk_overlap_tokens=10, lm: LM=None,
                 embedding_fn_code=None,
                 skip_embedding=False, no_create=False,
-                force_ocr=False, force_create=False):
+                force_ocr=False, force_create=False, no_cache=False,
+                use_ann=None, on_progress=None):  # on_progress: called with the fraction embedded, if the chunks need embedding
         
         self.user = user
+        self.use_ann = use_ann
 
         self.retriever_type_name = retriever_type_name
         self.chunk_size_tokens = chunk_size_tokens
@@ -563,6 +809,7 @@ class ResourceRetriever():
         self.force_ocr = force_ocr
 
         self.chunk_filename = None
+        self._store = None
         self.size = 0
         self.chunk_lengths = []
         self.chunk_names = []
@@ -576,30 +823,44 @@ class ResourceRetriever():
         
         self.embedding_fn_code = embedding_fn_code
 
-        self._get_or_create_data(no_create=no_create, force_ocr=force_ocr, force_create=force_create)
+        self._get_or_create_data(no_create=no_create, force_ocr=force_ocr, force_create=force_create, no_cache=no_cache, on_progress=on_progress)
 
 
     # On clean up, get rid of the temporary chunk file
     # Would've been nice to use __del__, but it gets called too early with caching
     def delete(self):
+        self._store = None
         try:
-            if self.chunk_filename:
+            if self.chunk_filename and not RETRIEVER_CACHE.owns(self.chunk_filename):  # the cache cleans up its own files
                 os.remove(self.chunk_filename)
         except FileNotFoundError:
             pass
 
-    def _get_or_create_data(self, no_create=False, force_ocr=False, force_create=False):
-
-        # Just use a fresh connection here - this func could be run under different conditions inside the lifetime of the object
-        db = get_db(new_connection=True)
-        curr = db.cursor()
+    def _get_or_create_data(self, no_create=False, force_ocr=False, force_create=False, no_cache=False, on_progress=None):
 
         if self.chunk_filename:
             try:
-                os.remove(self.chunk_filename)
+                if not RETRIEVER_CACHE.owns(self.chunk_filename):
+                    os.remove(self.chunk_filename)
             except:
                 pass
             self.chunk_filename = None
+            self._store = None
+
+        is_synthetic = self.resource_manifest['id'] == -1
+
+        # A cache hit skips the database and the download entirely
+        cache_key = None
+        cache_version = None
+        if not is_synthetic:
+            cache_key = self._get_cache_key()
+            cache_version = RETRIEVER_CACHE.version_of(cache_key)  # before loading anything, so an invalidation in the meantime isn't missed
+            if not (force_create or force_ocr or no_cache) and self._load_from_cache(cache_key, cache_version):
+                return
+
+        # Just use a fresh connection here - this func could be run under different conditions inside the lifetime of the object
+        db = get_db(new_connection=True)
+        curr = db.cursor()
         
         res = None
         
@@ -612,7 +873,6 @@ class ResourceRetriever():
         ORDER BY `time_uploaded` DESC
         """
 
-        is_synthetic = self.resource_manifest['id'] == -1
         results = []
         if not is_synthetic:  # if it's synthetic, you're not going to find it!
             curr.execute(sql, (self.resource_manifest['id'], self.retriever_type_name))
@@ -678,17 +938,22 @@ class ResourceRetriever():
             tmp = tempfile.NamedTemporaryFile(delete=False)
             try:
                 download_file(tmp.name, res)
-                self.chunk_filename = tmp.name
-                size = 0
-                chunk_lengths = []
-                chunk_names = []
-                for chunk in self.get_chunks():
-                    chunk_lengths.append(len(chunk.txt))
-                    chunk_names.append(chunk.source_name)
-                    size += 1
-                self.size = size
-                self.chunk_lengths = chunk_lengths
-                self.chunk_names = chunk_names
+                chunk_filename = tmp.name
+                if not is_chunk_store(chunk_filename):
+                    chunk_filename = self._migrate_legacy_chunk_file(chunk_filename, res, db)
+                self.chunk_filename = chunk_filename
+                store = self._get_store()
+                if self._should_index(store) and not store.has_ann_index:
+                    try:
+                        store.close()
+                        self.chunk_filename = self._add_ann_index(chunk_filename, res, db)
+                    except Exception as e:
+                        print(f"Couldn't add ANN index to retriever for resource with id {self.resource_manifest['id']}: {e}", file=sys.stderr)
+                    store = self._get_store()
+                self.size = len(store)
+                self.chunk_lengths = store.lengths
+                self.chunk_names = store.names
+                self._put_in_cache(cache_key, cache_version)
             except Exception as e:
                 print(e, file=sys.stderr)
                 print(f"Couldn't load retriever for resource with id {self.resource_manifest['id']}; making instead.", file=sys.stderr)
@@ -701,7 +966,7 @@ class ResourceRetriever():
 
             self.chunk_filename = self._make_chunks(force_ocr=force_ocr, is_synthetic=is_synthetic)
             if not self.skip_embedding and not (is_synthetic and no_create):
-                self.chunk_filename = self._embed_chunks()      
+                self.chunk_filename = self._embed_chunks(on_progress=on_progress)      
 
             if not is_synthetic:
 
@@ -722,65 +987,158 @@ class ResourceRetriever():
                 curr.execute(sql, (self.resource_manifest['asset_id'], self.resource_manifest['id'], res_from, path, json.dumps(meta)))
             db.commit()
 
+            if not is_synthetic:
+                self._put_in_cache(cache_key, cache_version)
 
-    def get_chunks(self):
+
+    def _get_cache_key(self):
+        retriever_options = {
+            'chunk_size_tokens': self.chunk_size_tokens,
+            'chunk_overlap_tokens': self.chunk_overlap_tokens,
+            'skip_embedding': self.skip_embedding,
+            'embedding_fn_code': self.embedding_fn_code
+        }
+        return make_retriever_cache_key(self.resource_manifest, self.retriever_type_name, retriever_options)
+
+
+    # Returns True if the data was found in the cache
+    def _load_from_cache(self, cache_key, version=None):
+        entry, store = RETRIEVER_CACHE.get(cache_key, version)
+        if not entry:
+            return False
+        self.chunk_filename = entry.chunk_filename
+        self._store = store  # already open, so it keeps working if the cache deletes the file
+        self.size = entry.size
+        self.chunk_lengths = list(entry.chunk_lengths)
+        self.chunk_names = list(entry.chunk_names)
+        return True
+
+
+    def _put_in_cache(self, cache_key, version=None):
+        try:
+            self._get_store()  # opened before the cache can evict it
+            entry = RetrieverCacheEntry(self.chunk_filename, self.size, self.chunk_lengths, self.chunk_names)
+            RETRIEVER_CACHE.put(cache_key, entry, version)
+        except Exception as e:
+            print(f"Couldn't cache retriever for resource with id {self.resource_manifest['id']}: {e}", file=sys.stderr)
+
+
+    # Retrievers made before chunk stores were pickled Chunk streams; converts one, swaps it in for the old file in storage, and returns the new local path.
+    # If the upload fails, the converted file is still used locally, and the conversion is tried again next time.
+    def _migrate_legacy_chunk_file(self, legacy_path, ret_row, db: ProxyDB):
+        new_chunk_file = tempfile.NamedTemporaryFile(delete=False)
+        convert_legacy_chunk_file(legacy_path, new_chunk_file.name)
+        os.remove(legacy_path)
+        self._replace_stored_chunk_file(new_chunk_file.name, ret_row, db)
+        return new_chunk_file.name
+
+
+    # Chunk stores big enough to need an ANN index but made without one get it added, and the stored copy replaced, like a legacy migration.
+    def _add_ann_index(self, chunk_path, ret_row, db: ProxyDB):
+        new_chunk_file = tempfile.NamedTemporaryFile(delete=False)
+        copy_with_ann_index(chunk_path, new_chunk_file.name)
+        os.remove(chunk_path)
+        self._replace_stored_chunk_file(new_chunk_file.name, ret_row, db)
+        return new_chunk_file.name
+
+
+    def _replace_stored_chunk_file(self, new_path, ret_row, db: ProxyDB):
+        try:
+            path, res_from = upload_retriever(self.resource_manifest, new_path, self.retriever_type_name)
+            sql = """
+            UPDATE asset_retrieval_storage
+            SET `from`=%s, `path`=%s
+            WHERE `id`=%s
+            """
+            curr = db.cursor()
+            curr.execute(sql, (res_from, path, ret_row['id']))
+            db.commit(close_cursors=False, close=False)
+            delete_resources_from_storage([ret_row])
+        except Exception as e:
+            print(f"Couldn't replace stored retriever with id {ret_row['id']}: {e}", file=sys.stderr)
+
+
+    # Whether the store is big enough that it should carry an ANN index
+    def _should_index(self, store: ChunkStore):
+        return store.has_embeddings and len(store) >= ANN_INDEX_MIN_CHUNKS
+
+
+    def _get_store(self) -> ChunkStore:
         if not self.chunk_filename:
             raise Exception("Tried to use chunk file, but no chunk filename.")
 
+        # An open store is memory-mapped, so it doesn't matter if the file has been deleted (e.g., evicted from the cache) since
+        if self._store is not None and self._store.path == self.chunk_filename and self._store.is_open:
+            return self._store
+
         if not os.path.exists(self.chunk_filename):
             self._get_or_create_data()  # not the greatest... maybe raise an exception?
 
-        with open(self.chunk_filename, 'rb') as fhand:
-            i = 0
-            while True:
-                try:
-                    chunk: Chunk = pickle.load(fhand)
-                    yield chunk
-                    # This loop can be pretty dense in places, and looping over chunks can hog CPU time from the server/other threads, affecting new connections.
-                    # the time.sleep(0) gives the server an entry to process new requests before returning here.
-                    # If this is a bottleneck, it usually means there are issues in other places that should be fixed
-                    # – as of writing, **known related issues have been fixed, and this is probably superfluous.**
-                    if i % 20 == 0:
-                        time.sleep(0)
-                    i += 1
-                except EOFError:
-                    break
+        if self._store is None or self._store.path != self.chunk_filename:
+            self._store = ChunkStore(self.chunk_filename)
+            self._store._load_sections()
+        return self._store
+
+
+    def get_chunks(self):
+        store = self._get_store()
+        for i in range(len(store)):
+            yield store.get_chunk(i)
+            # This loop can be pretty dense in places, and looping over chunks can hog CPU time from the server/other threads, affecting new connections.
+            # the time.sleep(0) gives the server an entry to process new requests before returning here.
+            # If this is a bottleneck, it usually means there are issues in other places that should be fixed
+            # – as of writing, **known related issues have been fixed, and this is probably superfluous.**
+            if i % 20 == 0:
+                time.sleep(0)
+
+
+    # pos is the position of the chunk in the chunk file (= row in load_embeddings())
+    def get_chunk_at(self, pos):
+        return self._get_store().get_chunk(int(pos))
+
 
+    # Whether load_embeddings() rows are unit length
+    @property
+    def embeddings_normalized(self):
+        return self._get_store().normalized
 
-    # Loads embeddings into memory and returns np.array
-    # Uses the chunk temp file as serialized pickle file
+
+    # Returns the (memory-mapped) np.array of embeddings, one row per chunk
     def load_embeddings(self):
-        embeddings = []
+        store = self._get_store()
+        if not store.has_embeddings:
+            if len(store) == 0:
+                return np.zeros((0, 0), dtype=np.float32)
+            raise Exception(f"Trying to load un-embedded chunk in resource {self.resource_manifest['title']} with id {self.resource_manifest['id']}")
+        return store.embeddings
 
-        for chunk in self.get_chunks():
-            embedding = chunk.embedding
-            if embedding is None:
-                raise Exception(f"Trying to load un-embedded chunk in resource {self.resource_manifest['title']} with id {self.resource_manifest['id']}")
-            embeddings.append(embedding)
-        
-        return np.array(embeddings)
+
+    # Returns (scores, positions) for a (normalized) query vector; see _score_store
+    def score(self, query_vec):
+        self.load_embeddings()  # raises if the chunks aren't embedded
+        return _score_store(self._get_store(), query_vec, use_ann=self.use_ann)
 
 
     # Encourages batching, which is important performance-wise
-    # chunk_indices is a list of chunk_index's
-    # The performance here can be improved significantly in the future
+    # chunk_indices is a list of chunk_index's; chunks come back in the same order, leaving out any that don't exist
     def get_chunks_by_indices(self, chunk_indices):
-        # Could use an algorithmic improvement
-        chunks = []
-        for chunk in self.get_chunks():
-            if chunk.index in chunk_indices:
-                chunks.append(chunk)
-        return chunks
+        return [x for x in self._get_store().get_chunks_by_indices(chunk_indices) if x is not None]
+
+
+    # positions are positions in the chunk file (= rows in load_embeddings())
+    def get_chunks_at(self, positions):
+        return self._get_store().get_chunks(positions)
 
 
-    # Sets self.embeddings to embeddings, matched with chunks
     # Makes a new chunk file that contains the embeddings with each chunk
-    def _embed_chunks(self):
+    # Several batches are in flight at once (up to the provider's max_concurrency), and results go straight into the new file in order.
+    # on_progress, if given, is called with the fraction of chunks embedded so far.
+    def _embed_chunks(self, on_progress=None):
 
-        EMBEDDING_BATCH_SIZE = 500
+        MAX_RETRIES = 3
+        embed_obj: Embed = BULK_EMBED_PROVIDERS[self.embedding_fn_code]
 
         def _do_embedding(lst):
-            embed_obj: Embed = EMBED_PROVIDERS[self.embedding_fn_code]
             embeddings = embed_obj.embed(lst)
             try:
                 embeddings = np.array(embeddings)
@@ -807,33 +1165,64 @@ class ResourceRetriever():
 
             return embeddings
 
-        total = []  # We're storing embeddings all in memory
-        batch = []
-        for i, chunk in enumerate(self.get_chunks()):
-            batch.append(chunk.txt)
-
-            if len(batch) >= EMBEDDING_BATCH_SIZE:
-                total.extend(_do_embedding(batch))
-                batch = []
-
-        if len(batch) > 0:
-            total.extend(_do_embedding(batch))
-
-        # Now we put them in a new chunk file
-
+        # A failed batch is retried in halves, so that the parts that go through don't get redone
+        def _embed_batch(lst, tries=0):
+            try:
+                # Chunks whose text has been embedded before (in any resource) don't go to the provider again
+                return normalize_embeddings(embed_with_cache(self.embedding_fn_code, lst, _do_embedding))
+            except Exception as e:
+                if tries >= MAX_RETRIES:
+                    raise
+                print(f"Embedding batch of {len(lst)} failed ({e}); retrying", file=sys.stderr)
+                time.sleep(2 ** tries)
+                if len(lst) == 1:
+                    return _embed_batch(lst, tries=tries+1)
+                mid = len(lst) // 2
+                return np.concatenate([_embed_batch(lst[:mid], tries=tries+1), _embed_batch(lst[mid:], tries=tries+1)])
+
+        store = self._get_store()
+
+        # Batches are (start, end) ranges of positions, within the provider's limits
+        batches = []
+        start = 0
+        batch_tokens = 0
+        for i, length in enumerate(store.lengths):
+            n_tokens = length // 4  # same as quick_tok_estimate
+            too_many_tokens = embed_obj.max_batch_tokens and batch_tokens + n_tokens > embed_obj.max_batch_tokens
+            if i > start and (i - start >= embed_obj.max_batch_size or too_many_tokens):
+                batches.append((start, i))
+                start = i
+                batch_tokens = 0
+            batch_tokens += n_tokens
+        if start < len(store):
+            batches.append((start, len(store)))
+
+        max_in_flight = 2 * embed_obj.max_concurrency
         new_chunk_file = tempfile.NamedTemporaryFile(delete=False)
-
-        with open(new_chunk_file.name, 'wb') as fhand:
-            for i, chunk in enumerate(self.get_chunks()):
-                chunk.embedding = total[i]
-                pickle.dump(chunk, fhand)
-        
+        with ChunkStoreWriter(new_chunk_file.name, normalized=True) as writer, ThreadPoolExecutor(max_workers=embed_obj.max_concurrency) as executor:
+            futures = {}
+            n_submitted = 0
+            for b, (start, end) in enumerate(batches):
+                while n_submitted < len(batches) and n_submitted < b + max_in_flight:
+                    sub_start, sub_end = batches[n_submitted]
+                    futures[n_submitted] = executor.submit(_embed_batch, [store.txt(i) for i in range(sub_start, sub_end)])
+                    n_submitted += 1
+                embeddings = futures.pop(b).result()
+                writer.add_many(store.get_chunks(range(start, end), with_embedding=False), embeddings)
+                if on_progress:
+                    on_progress(end / len(store))
+
+            if writer.n >= ANN_INDEX_MIN_CHUNKS:
+                for name, array in zip(IVF_SECTIONS, build_ivf_index(writer.pending_embeddings())):
+                    writer.add_section(name, array)
+
+        store.close()
         os.remove(self.chunk_filename)
-        self.chunk_filename = new_chunk_file
+        self.chunk_filename = new_chunk_file.name
         return new_chunk_file.name
 
     
-    # Returns name of tempfile that stores chunks as pickle
+    # Returns name of tempfile that stores the chunk store (without embeddings)
     def _make_chunks(self, force_ocr=False, is_synthetic=False):
 
         MIN_CHAR_LENGTH_WARN = 100
@@ -855,7 +1244,7 @@ class ResourceRetriever():
             splitsville = text_splitter.split_text(text)
             
             serialized_file = tempfile.NamedTemporaryFile(delete=False)
-            with open(serialized_file.name, 'wb') as ser:
+            with ChunkStoreWriter(serialized_file.name) as writer:
                 if not len(splitsville):
                     self.size = 0
                     self.chunk_lengths = []
@@ -867,7 +1256,7 @@ class ResourceRetriever():
                     self.chunks.append(chunk)
                     self.size += 1
                     self.chunk_lengths.append(len(txt))
-                    pickle.dump(chunk, ser)
+                    writer.add(chunk.index, chunk.source_name, chunk.txt)
 
                 return serialized_file.name
 
@@ -936,7 +1325,7 @@ class ResourceRetriever():
             data = loader.load_and_split(text_splitter=text_splitter)
 
             bad_doc = False
-            with open(serialized_file.name, 'wb') as ser:
+            with ChunkStoreWriter(serialized_file.name) as writer:
                 for i, x in enumerate(data):
                     txt = x.page_content
                     if i < 3:  # Do some checks to see if the file is readable, in the first two chunks.
@@ -955,7 +1344,7 @@ class ResourceRetriever():
 
                     chunk = Chunk(i, chunk_name, x.page_content)
                     size += 1
-                    pickle.dump(chunk, ser)
+                    writer.add(chunk.index, chunk.source_name, chunk.txt)
                     total_char_size += sum(c.isalnum() for c in x.page_content)
                     chunk_lengths.append(len(x.page_content))
                     chunk_names.append(chunk_name)
@@ -993,7 +1382,7 @@ class ResourceRetriever():
                 break
         system_prompt = get_auto_desc_system_prompt(first_few)
         prompt = "Please write the brief description, starting with a verb."
-        desc = self.lm.run(prompt, system_prompt=system_prompt)
+        desc = run_governed(self.lm, prompt, system_prompt=system_prompt, cache=True, priority=BACKGROUND)
         # Remove quotes if it starts with quotes
         if desc[0] == '"':
             desc = desc[1:len(desc)-1]
@@ -1012,6 +1401,7 @@ class ResourceRetriever():
                 'skip_embedding': self.skip_embedding,
                 'embedding_fn_code': self.embedding_fn_code,
                 'force_ocr': self.force_ocr
-            }
+            },
+            'embeddings_normalized': self.embeddings_normalized if self.chunk_filename else False
         }
         return make_json_serializable(x)
\ No newline at end of file
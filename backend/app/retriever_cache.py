@@ -0,0 +1,181 @@
+from collections import OrderedDict
+from threading import Lock
+import json
+import os
+import sys
+import redis
+from .utils import make_json_serializable
+from .chunk_store import ChunkStore
+from .configs.user_config import RETRIEVER_CACHE_MAX_BYTES
+from .configs.conn_config import POOLER_CONNECTION_PARAMS
+
+"""
+
+In-process LRU cache of loaded ResourceRetriever data (the local chunk file plus its chunk names/lengths).
+
+Without it, every chat / search / quiz request re-runs the MySQL lookup, the download from storage, and the parse of every resource.
+Entries are keyed on the resource, the retriever type, and every field that consistency_check looks at,
+so a hit is always consistent; when a resource or its stored retrievers are deleted, entries for that resource are dropped.
+That goes for every process: invalidating bumps the resource's version in Redis, and entries made under an older version are dropped when they're looked up.
+
+The cache owns the chunk files of its entries: they're deleted on eviction/invalidation, not by the ResourceRetriever.
+A hit comes with the chunk store already opened (memory-mapped), so whoever has it can keep using it after the file is deleted.
+(A ResourceRetriever whose file disappears before it opens it simply reloads it - see ResourceRetriever._get_store.)
+
+"""
+
+# Same as in consistency_check
+CACHE_KEY_RETRIEVER_OPTIONS = [
+    'chunk_size_tokens',
+    'chunk_overlap_tokens',
+    'skip_embedding',
+    'embedding_fn_code'
+]
+
+
+def make_retriever_cache_key(resource_manifest, retriever_type_name, retriever_options):
+    manifest = json.dumps(make_json_serializable(resource_manifest), sort_keys=True, default=str)
+    options = tuple(retriever_options.get(k) for k in CACHE_KEY_RETRIEVER_OPTIONS)
+    return (resource_manifest['id'], retriever_type_name, manifest, options)
+
+
+VERSION_KEY = "retriever_cache_version:{}"  # per resource id
+
+
+class RetrieverCacheEntry():
+    def __init__(self, chunk_filename, size, chunk_lengths, chunk_names) -> None:
+        self.chunk_filename = chunk_filename
+        self.size = size
+        self.chunk_lengths = chunk_lengths
+        self.chunk_names = chunk_names
+        self.version = None  # of its resource, when it was loaded
+        # The chunk file dominates; names and lengths are a rough estimate
+        self.nbytes = os.path.getsize(chunk_filename) + sum(len(x) for x in chunk_names) + 8 * len(chunk_lengths)
+
+    def open(self) -> ChunkStore:
+        store = ChunkStore(self.chunk_filename)
+        store._load_sections()
+        return store
+
+
+class RetrieverCache():
+    def __init__(self, max_bytes) -> None:
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.entries = OrderedDict()  # key -> RetrieverCacheEntry, least recently used first
+        self.redis = redis.Redis(**POOLER_CONNECTION_PARAMS)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # The resource's current version, to be read before loading its data (and given to get and put); None for merged indices, or if redis can't be reached
+    def version_of(self, key):
+        if key[0] == 'merged':  # keyed by their contents, so never stale
+            return None
+        try:
+            return int(self.redis.get(VERSION_KEY.format(key[0])) or 0)
+        except redis.RedisError as e:
+            print(f"Retriever cache couldn't reach redis: {e}", file=sys.stderr)
+            return None
+
+    # Returns (entry, its chunk store opened) or (None, None)
+    def get(self, key, version=None):
+        with self.lock:
+            entry: RetrieverCacheEntry = self.entries.get(key)
+            if entry is not None and version is not None and entry.version != version:
+                # Invalidated by another process
+                self._remove(key)
+                self.invalidations += 1
+                entry = None
+            store = None
+            if entry is not None:
+                # Opened under the lock, so the file can't be evicted in between
+                try:
+                    store = entry.open()
+                except (FileNotFoundError, ValueError):
+                    # Someone cleaned up the tempfile out from under us
+                    self._remove(key)
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry, store
+
+    # Takes ownership of the entry's chunk file if it returns True
+    # version is what version_of gave before the data was loaded (so an invalidation while loading isn't missed)
+    def put(self, key, entry: RetrieverCacheEntry, version=None):
+        if entry.nbytes > self.max_bytes:
+            return False
+        entry.version = version
+        with self.lock:
+            if key in self.entries:
+                if self.entries[key].chunk_filename == entry.chunk_filename:
+                    self.entries[key].version = version
+                    self.entries.move_to_end(key)
+                    return True
+                self._remove(key)
+            self.entries[key] = entry
+            self.nbytes += entry.nbytes
+            while self.nbytes > self.max_bytes and len(self.entries):
+                old_key = next(iter(self.entries))
+                self._remove(old_key)
+                self.evictions += 1
+            return True
+
+    def owns(self, chunk_filename):
+        with self.lock:
+            return any(x.chunk_filename == chunk_filename for x in self.entries.values())
+
+    # Drops every entry for any of the resource ids, here and (by bumping their versions) in every other process
+    def invalidate_resources(self, resource_ids):
+        resource_ids = set(resource_ids)
+        if len(resource_ids):
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for resource_id in resource_ids:
+                    pipe.incr(VERSION_KEY.format(resource_id))
+                pipe.execute()
+            except redis.RedisError as e:
+                print(f"Retriever cache couldn't reach redis; other processes may keep stale entries: {e}", file=sys.stderr)
+        with self.lock:
+            to_remove = [k for k in self.entries if k[0] in resource_ids]
+            for key in to_remove:
+                self._remove(key)
+            self.invalidations += len(to_remove)
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries.keys()):
+                self._remove(key)
+
+    # Needs the lock
+    def _remove(self, key):
+        entry: RetrieverCacheEntry = self.entries.pop(key)
+        self.nbytes -= entry.nbytes
+        try:
+            os.remove(entry.chunk_filename)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Couldn't remove cached chunk file {entry.chunk_filename}: {e}", file=sys.stderr)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+
+RETRIEVER_CACHE = RetrieverCache(max_bytes=RETRIEVER_CACHE_MAX_BYTES)
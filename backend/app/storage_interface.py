@@ -25,7 +25,7 @@ def replace_asset_file(from_key, path, tmp_path, use_data=None):
 def upload_retriever(resource_id, file_path, retriever_type_name):
     suggested_path = ["retriever_storage", str(resource_id['id']), retriever_type_name]
     fs: FileStorage = FS_PROVIDERS[DEFAULT_STORAGE_OPTION]
-    db_path = fs.upload_file(suggested_path, file_path, "pkl")
+    db_path = fs.upload_file(suggested_path, file_path, "chunks")  # see chunk_store.py for the format
     return db_path, fs.code
 
 
@@ -36,6 +36,13 @@ def upload_inter_asset_retriever(file_path):
     return db_path, fs.code
 
 
+def upload_merged_retriever(file_path):
+    suggested_path = ["merged_retriever_storage"]
+    fs: FileStorage = FS_PROVIDERS[DEFAULT_STORAGE_OPTION]
+    db_path = fs.upload_file(suggested_path, file_path, "chunks")  # see merged_index.py
+    return db_path, fs.code
+
+
 def upload_media(file_path, ext):
     suggested_path = ["media_storage"]
     fs: FileStorage = FS_PROVIDERS[DEFAULT_STORAGE_OPTION]
@@ -51,7 +58,7 @@ def delete_resources_from_storage(asset_resources):
 
 
 # Downloads file (from s3) into tempfile path file, set up by the user
-# asset_resource is entry in asset_resources or asset_retrieval_sources or inter_asset_retrieval_storage row
+# asset_resource is entry in asset_resources or asset_retrieval_sources or inter_asset_retrieval_storage or merged_retrieval_storage row
 def download_file(tempfile_path, asset_resource):
     fs: FileStorage = FS_PROVIDERS[asset_resource['from']]
     fs.download_file(tempfile_path, asset_resource['path'])
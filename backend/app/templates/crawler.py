@@ -23,6 +23,7 @@ from ..exceptions import ScraperUnavailable, QueueDuplicate, QueueFull
 from ..user import get_user_search_engine_code
 from ..integrations.web import SearchEngine, SEARCH_PROVIDERS, SearchResult
 from ..integrations.lm import LM, LM_PROVIDERS, HIGH_PERFORMANCE_CHAT_MODEL, VISION_MODEL, get_safe_retrieval_context_length
+from ..lm_governor import run_governed, BACKGROUND
 import sys
 import os
 import json
@@ -474,7 +475,7 @@ def scrape_for_crawler(user, asset_id, website_id, website_data=None, db=None):
                                 encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
                                 encoded_string = f"data:{ss_type};base64,{encoded_string}"
                                 images.append(encoded_string)
-                        resp = lm.run(txt, system_prompt=system_prompt, images=images, make_json=True)
+                        resp = run_governed(lm, txt, system_prompt=system_prompt, images=images, make_json=True, priority=BACKGROUND)
                         my_json = json.loads(resp)
                         quality_code = my_json['quality_code']
                     else:
@@ -483,7 +484,7 @@ def scrape_for_crawler(user, asset_id, website_id, website_data=None, db=None):
                         # Shorten text so that it fits with model
                         get_token_estimate(text)
                         txt = get_scrape_quality_user_text(scrape.url, text)
-                        resp = lm.run(txt, system_prompt=system_prompt, make_json=True)
+                        resp = run_governed(lm, txt, system_prompt=system_prompt, make_json=True, priority=BACKGROUND)
                         my_json = json.loads(resp)
                         quality_code = my_json['quality_code']
                 except Exception as _:
@@ -522,7 +523,7 @@ def scrape_for_crawler(user, asset_id, website_id, website_data=None, db=None):
                     MAX_RELEVANCE = 5
                     system_prompt = get_eval_system(SOURCE_TYPES, topic, 5, 5)
                     txt = get_eval_user(scrape.url, text)
-                    res = eval_lm.run(txt, system_prompt=system_prompt, make_json=True)
+                    res = run_governed(eval_lm, txt, system_prompt=system_prompt, make_json=True, priority=BACKGROUND)
                     my_json = json.loads(res)
                     source_type_code = my_json['source_type_code']
                     if source_type_code not in CODE_TO_SOURCE_TYPES:
@@ -874,7 +875,7 @@ def get_manifest(user: User):
             SELECT * FROM asset_metadata
             WHERE `asset_id`=%s AND `key`=%s AND JSON_EXTRACT(`value`, '$.website_id') IN ({website_ids_str});
         """
-        db = get_db()
+        db = get_db(read_only=True)
         curr = db.cursor()
         curr.execute(sql, (asset_id, SCRAPE_QUEUE))
         queued = curr.fetchall()
@@ -1224,7 +1225,7 @@ def suggest_questions(user: User):
     topic = request.json.get('topic')
     lm: LM = LM_PROVIDERS[HIGH_PERFORMANCE_CHAT_MODEL]
     sys_prompt = get_suggest_from_topic_system(n=10)
-    resp = lm.run(topic, system_prompt=sys_prompt, make_json=True)
+    resp = run_governed(lm, topic, system_prompt=sys_prompt, make_json=True)
     try:
         obj = json.loads(resp)
         queries = obj['queries']
@@ -9,6 +9,7 @@ from flask_cors import cross_origin
 from ..template_response import MyResponse
 from ..db import get_db
 from ..integrations.lm import LM, LM_PROVIDERS, FAST_CHAT_MODEL, BALANCED_CHAT_MODEL, HIGH_PERFORMANCE_CHAT_MODEL, LMStreamResponse
+from ..lm_governor import run_governed, stream_governed
 from ..prompts.curriculum_prompts import (
     get_brainstorm_system_prompt,
     get_to_structured_system_prompt,
@@ -181,7 +182,7 @@ def brainstorm(user: User):
 
     lm: LM = LM_PROVIDERS[HIGH_PERFORMANCE_CHAT_MODEL]
     def gen():
-        for stream_resp in lm.stream(user_text, context=context, system_prompt=system_prompt, show_reasoning=False):
+        for stream_resp in stream_governed(lm, user_text, context=context, system_prompt=system_prompt, show_reasoning=False):
             stream_resp: LMStreamResponse
             yield stream_resp.text
     return gen()
@@ -204,7 +205,7 @@ def desc(user: User):
     lm: LM = LM_PROVIDERS[BALANCED_CHAT_MODEL]
     
     def gen():
-        for stream_resp in lm.stream(title, system_prompt=system_prompt, show_reasoning=False):
+        for stream_resp in stream_governed(lm, title, system_prompt=system_prompt, show_reasoning=False):
             stream_resp: LMStreamResponse
             yield stream_resp.text
     return gen()
@@ -213,7 +214,7 @@ def desc(user: User):
 def to_structured(text):
     system_prompt = get_to_structured_system_prompt()
     lm: LM = LM_PROVIDERS[BALANCED_CHAT_MODEL]
-    result_str = lm.run(text, system_prompt=system_prompt, make_json=True)
+    result_str = run_governed(lm, text, system_prompt=system_prompt, make_json=True, cache=True)
     result = []
     tries = 0
     MAX_TRIES = 2
@@ -290,7 +291,7 @@ def link_given_results(results, prompt, title, context=[]):
     while tries < MAX_TRIES:
         try:
             lm: LM = LM_PROVIDERS[HIGH_PERFORMANCE_CHAT_MODEL]
-            gen = lm.run(txt, system_prompt=system_prompt)
+            gen = run_governed(lm, txt, system_prompt=system_prompt)
             nums = list(set([int(x.strip()) for x in gen.split("\n")]))  # remove duplicates
             for num in nums:
                 if num > len(results):
@@ -370,10 +371,10 @@ def build_from_folder(user: User):
         brainstorm_system = get_fake_brainstorm_system_prompt(sources)
         brainstorm_user = get_fake_brainstorm_prompt(sources)
         lm: LM = LM_PROVIDERS[FAST_CHAT_MODEL]
-        first_brainstorm_response = lm.run(brainstorm_user, system_prompt=brainstorm_system)
+        first_brainstorm_response = run_governed(lm, brainstorm_user, system_prompt=brainstorm_system)
 
         brainstorm2_system_prompt = get_brainstorm_system_prompt(None, None, None)
-        second_brainstorm_response = lm.run(first_brainstorm_response, system_prompt=brainstorm2_system_prompt)
+        second_brainstorm_response = run_governed(lm, first_brainstorm_response, system_prompt=brainstorm2_system_prompt)
 
         yield DIVIDER_TEXT + json.dumps({'text': 'Structuring (2/3)'})
 
@@ -13,6 +13,7 @@ from ..prompts.detached_chat_prompts import pure_detached_chat_system_prompt, ma
 from flask_cors import cross_origin
 from ..template_response import MyResponse
 from ..integrations.lm import LM, LM_PROVIDERS, FAST_CHAT_MODEL
+from ..lm_governor import run_governed
 import sys
 from ..configs.str_constants import CHAT_CONTEXT
 from ..worker import task_new_desc
@@ -40,7 +41,7 @@ def make_title(user: User):
         return MyResponse(True, {'title': asset_row['title']}).to_json()
 
     lm: LM = LM_PROVIDERS[FAST_CHAT_MODEL]
-    new_title = lm.run(txt, system_prompt=make_title_system_prompt()).replace("\"", "")
+    new_title = run_governed(lm, txt, system_prompt=make_title_system_prompt()).replace("\"", "")
 
     sql = """
         UPDATE assets SET `title`=%s WHERE `id`=%s
@@ -14,7 +14,7 @@ from flask import (
     Blueprint
 )
 from flask_cors import cross_origin
-from ..asset_actions import get_asset
+from ..asset_actions import get_permitted_assets
 from ..configs.str_constants import *
 from .template import Template
 import json
@@ -145,6 +145,7 @@ class Folder(Template):
         self.chattable = True
         self.summarizable = False
         self.make_retriever_on_upload = False
+        self.includes_retrieval_sources = True
         self.code = "folder"
 
 
@@ -224,7 +225,7 @@ class Folder(Template):
 
         curr = db.cursor()
 
-        this_asset = get_asset(user, asset_id)
+        this_asset = get_permitted_assets(user, [asset_id], db=db).get(int(asset_id))
 
         dirpath = tempfile.mkdtemp()
 
@@ -237,21 +238,11 @@ class Folder(Template):
         curr.execute(sql, (asset_id,))
         top_level = curr.fetchall()
 
-        permissioning_string = get_permissioning_string(user)
+        source_ids = [int(x['value']) for x in top_level]
+        permitted = get_permitted_assets(user, source_ids, db=db)  # one query for all of them (and remembered for nested folders)
     
-        for source_id in map(lambda x: x['value'], top_level):
-            sql = f"""
-                    WITH a as (
-                        SELECT *
-                        FROM assets
-                        WHERE `id` = %s
-                    )
-                    SELECT DISTINCT a.* FROM a
-                    LEFT JOIN asset_permissions ap ON a.id = ap.asset_id OR a.group_id = ap.group_id
-                    WHERE {permissioning_string}
-                    """
-            curr.execute(sql, (source_id,))
-            asset_row = curr.fetchone()
+        for source_id in source_ids:
+            asset_row = permitted.get(source_id)
             if not asset_row:
                 continue
 
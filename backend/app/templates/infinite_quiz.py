@@ -15,6 +15,7 @@ import random
 from ..asset_actions import get_asset, get_asset_metadata, get_asset_resources, get_sources, get_or_create_retriever, set_sources, has_asset_title_been_updated, mark_asset_title_as_updated
 from .quiz import generate_question, generate_questions_lc
 from ..integrations.lm import LM, LM_PROVIDERS, FAST_CHAT_MODEL, BALANCED_CHAT_MODEL
+from ..lm_governor import run_governed
 from ..prompts.quiz_prompts import get_question_grader_system_prompt, get_question_grader_prompt, make_title_user_prompt, make_title_system_prompt
 from ..utils import deduplicate
 from ..configs.str_constants import MULTIPLE_CHOICE, SHORT_ANSWER, ASSET_STATE
@@ -42,7 +43,7 @@ def make_title(user: User):
     
     txt = make_title_user_prompt(sources)
     lm: LM = LM_PROVIDERS[FAST_CHAT_MODEL]
-    new_title = lm.run(txt, system_prompt=make_title_system_prompt()).replace("\"", "")
+    new_title = run_governed(lm, txt, system_prompt=make_title_system_prompt()).replace("\"", "")
 
     sql = """
         UPDATE assets SET `title`=%s WHERE `id`=%s
@@ -139,7 +140,7 @@ def grade(user: User):
         return MyResponse(False, reason="Undefined answer or response").to_json()
 
     lm: LM = LM_PROVIDERS[BALANCED_CHAT_MODEL]
-    resp = lm.run(get_question_grader_prompt(answer, response, max_points), system_prompt=get_question_grader_system_prompt(),make_json=True)
+    resp = run_governed(lm, get_question_grader_prompt(answer, response, max_points), system_prompt=get_question_grader_system_prompt(),make_json=True)
 
     return MyResponse(True, json.loads(resp)).to_json()
 
@@ -6,7 +6,7 @@ from flask import Blueprint, request
 from ..template_response import MyResponse
 from ..asset_actions import (
     get_asset, set_sources, get_asset_metadata, save_asset_metadata,
-    get_assets, has_asset_title_been_updated, mark_asset_title_as_updated,
+    get_permitted_assets, has_asset_title_been_updated, mark_asset_title_as_updated,
     upload_asset
 )
 from ..configs.str_constants import ASSET_STATE
@@ -23,6 +23,7 @@ from flask_socketio import Namespace, emit, join_room, leave_room, rooms
 import hashlib
 from ..utils import text_from_html, get_token_estimate, get_current_utc_time
 from ..integrations.lm import LM, LM_PROVIDERS, FAST_CHAT_MODEL, get_safe_retrieval_context_length
+from ..lm_governor import run_governed
 from ..configs.user_config import APP_NAME
 from ..prompts.prompt_fragments import get_basic_ai_identity, get_citation_prompt
 from ..utils import get_unique_id
@@ -192,7 +193,7 @@ def get_notebook(user: User, asset_id, no_update=False, db=None):
         
         if len(to_update):
             new_blocks = []
-            updated_assets = get_assets(user, [x['id'] for x in to_update], db=db, no_commit=True)
+            updated_assets = list(get_permitted_assets(user, [x['id'] for x in to_update], db=db, no_commit=True).values())
             for block in blocks:
                 block_type: BlockType = get_block_by_type(block['type'])
                 if block_type.has_sources:
@@ -330,7 +331,7 @@ def key_points(user: User):
     system_prompt = get_key_points_system_prompt(block_texts)
     user_prompt = get_key_points_user_prompt()
 
-    llm_text = lm.run(user_prompt, system_prompt=system_prompt, make_json=True)
+    llm_text = run_governed(lm, user_prompt, system_prompt=system_prompt, make_json=True)
 
     try:
         llm_json = json.loads(llm_text)
@@ -367,7 +368,7 @@ def outline(user: User):
     # Arbitrary formula, but seems about right (see desmos plot)
     user_prompt = get_outline_user_prompt(max_n=(int(len(blocks) / (.5 * math.sqrt(len(blocks))))))
 
-    llm_text = lm.run(user_prompt, system_prompt=system_prompt, make_json=True)
+    llm_text = run_governed(lm, user_prompt, system_prompt=system_prompt, make_json=True)
 
     try:
         llm_json = json.loads(llm_text)
@@ -380,7 +381,7 @@ def outline(user: User):
     new_title_data = {}
     has_been_edited = has_asset_title_been_updated(asset_id, db=db)
     if not has_been_edited:
-        new_title_str = lm.run("\n".join(block_texts), system_prompt=make_title_system_prompt(), make_json=True)
+        new_title_str = run_governed(lm, "\n".join(block_texts), system_prompt=make_title_system_prompt(), make_json=True)
         new_title = None
         try:
             new_title_json = json.loads(new_title_str)
@@ -14,6 +14,7 @@ from ..template_response import MyResponse
 from ..db import get_db, needs_db
 from ..batch_and_stream_lm import stream_batched_lm
 from ..integrations.lm import LM, LM_PROVIDERS, LONG_CONTEXT_CHAT_MODEL, ALT_LONG_CONTEXT_MODEL, BALANCED_CHAT_MODEL, FAST_CHAT_MODEL, DEFAULT_CHAT_MODEL
+from ..lm_governor import run_governed, stream_governed
 from ..prompts.quiz_prompts import (
     get_question_grader_system_prompt, get_question_grader_prompt,
     get_create_question_system_prompt_mcq, get_create_question_prompt_mcq,
@@ -63,7 +64,7 @@ def generate_question(ret: Retriever, qtype=None, prev_q_texts=[], mcq_prob=.75)
         prompt = get_create_question_prompt_mcq(chunks)
         tries = 0
         while tries < 2:
-            resp = lm.run(prompt, system_prompt=sys_prompt, make_json=True)
+            resp = run_governed(lm, prompt, system_prompt=sys_prompt, make_json=True)
             try:
                 my_json = json.loads(resp)
                 question = my_json['question']
@@ -102,7 +103,7 @@ def generate_question(ret: Retriever, qtype=None, prev_q_texts=[], mcq_prob=.75)
         prompt = get_create_question_prompt_sa(chunks)
         tries = 0
         while tries < 2:
-            resp = lm.run(prompt, system_prompt=sys_prompt, make_json=True)
+            resp = run_governed(lm, prompt, system_prompt=sys_prompt, make_json=True)
             try:
                 my_json = json.loads(resp)
                 question = my_json['question']
@@ -136,7 +137,7 @@ def generate_questions_lc(ret: Retriever, qtype, n, prev_q_texts=[], points=1, s
         sys_prompt, prompt = qtheme.get_mcq_prompts(n, prev_q_texts, difficulty, chunks)
         tries = 0
         while tries < 2:
-            resp = lm.run(prompt, system_prompt=sys_prompt, make_json=True, temperature=TEMPERATURE)
+            resp = run_governed(lm, prompt, system_prompt=sys_prompt, make_json=True, temperature=TEMPERATURE)
             try:
                 my_json = json.loads(resp)
                 full_questions = qtheme.process_response_mcq(my_json)
@@ -181,7 +182,7 @@ def generate_questions_lc(ret: Retriever, qtype, n, prev_q_texts=[], points=1, s
         # Expectation is to get: {'questions': [{'text': '', 'answer': ''}, ...]}
         tries = 0
         while tries < 2:
-            resp = lm.run(prompt, system_prompt=sys_prompt, make_json=True, temperature=TEMPERATURE)
+            resp = run_governed(lm, prompt, system_prompt=sys_prompt, make_json=True, temperature=TEMPERATURE)
             try:
                 my_json = json.loads(resp)
                 full_questions = qtheme.process_response_sa(my_json)
@@ -617,7 +618,7 @@ def explain(user: User):
     prompt = get_explain_prompt(question['text'], user_answer, correct_answer)
 
     def gen():
-        for stream_resp in lm.stream(prompt, system_prompt=system_prompt, show_reasoning=False):
+        for stream_resp in stream_governed(lm, prompt, system_prompt=system_prompt, show_reasoning=False):
             yield stream_resp.text
 
     return gen()
@@ -641,7 +642,7 @@ def get_matching_assets(user: User):
     user_prompt = get_matching_assets_user_prompt(asset_rows, answer)
 
     lm: LM = LM_PROVIDERS[FAST_CHAT_MODEL]
-    raw_out = lm.run(user_prompt, system_prompt=sys_prompt, make_json=True)
+    raw_out = run_governed(lm, user_prompt, system_prompt=sys_prompt, make_json=True)
     letter_choices = json.loads(raw_out)['choices']
     index_choices = ["ABCDEFGHIJKLMNOPQRSTUVWXYZ".find(l.upper()) for l in letter_choices]
     chosen_assets = [asset_rows[x] for x in index_choices]
@@ -10,7 +10,7 @@ from ..template_response import response_from_resource
 import tempfile
 from ..storage_interface import download_file
 from ..prompts.detached_chat_prompts import mixed_detached_chat_system_prompt
-from ..asset_actions import get_asset
+from ..asset_actions import get_asset, get_permitted_assets
 from ..retriever import Chunk
 from ..utils import deduplicate
 from ..prompts.prompt_fragments import get_basic_ai_identity, get_citation_prompt, get_web_citation_prompt
@@ -45,6 +45,8 @@ class Template(ABC):
 
     make_retriever_on_upload: bool = True  # Need to be chattable and this true to make retriever on upload
 
+    includes_retrieval_sources: bool = False  # whether get_asset_resources is just the resources of its retrieval sources (like a folder)
+
     # Allowed endpoints is like, ['reminder', ...] - see /email blueprint.
     # Allowed endpoints needs implemented associated functions (see class methods below)
     email_rules: EmailRules = EmailRules()
@@ -204,36 +206,60 @@ class Template(ABC):
 
         return total_results
     
+    # Gets the resources of the asset's retrieval sources, and of theirs (for templates with includes_retrieval_sources), etc.
+    # Breadth first: one query for each level's retrieval sources and one for their permissions,
+    # plus one for the resources of all the assets on the level that use the default get_asset_resources.
     @needs_db
     def _get_asset_resources_include_retrieval_sources(self, user: User, asset_id, exclude=[], db=None):
+        from .templates import get_template_by_code  # lazy importing to break circular dependency
+
         curr = db.cursor()
         total_results = []
-        visited_asset_ids = list(exclude)
-
-        def rec(x):
-            visited_asset_ids.append(x)
-            asset_row = get_asset(user, x)
-            if asset_row:
-                from .templates import get_template_by_code
-                tmp: Template = get_template_by_code(asset_row['template'])
-                resources = tmp.get_asset_resources(user, x, exclude=visited_asset_ids)
-                total_results.extend(resources)
-
-
-        sql = f"""
-        SELECT * FROM asset_metadata
-        WHERE `key` = '{RETRIEVAL_SOURCE}' AND `asset_id` = %s
-        """
-        curr.execute(sql, (asset_id,))
-
-        results = curr.fetchall()
+        visited_asset_ids = {int(x) for x in exclude if str(x).isdigit()}
+        visited_asset_ids.add(int(asset_id))
+
+        level = [int(asset_id)]
+        while len(level):
+            sql = f"""
+            SELECT * FROM asset_metadata
+            WHERE `key` = '{RETRIEVAL_SOURCE}' AND `asset_id` IN ({','.join([str(x) for x in level])})
+            """
+            curr.execute(sql)
+            results = curr.fetchall()
+
+            source_ids = deduplicate([int(meta['value']) for meta in results if int(meta['value']) not in visited_asset_ids])
+            visited_asset_ids.update(source_ids)
+            if not len(source_ids):
+                break
+
+            permitted = get_permitted_assets(user, source_ids, db=db)
+
+            next_level = []
+            default_resources_ids = []
+            for source_id in source_ids:
+                if source_id not in permitted:
+                    continue
+                tmp: Template = get_template_by_code(permitted[source_id]['template'])
+                if tmp.includes_retrieval_sources:
+                    next_level.append(source_id)
+                elif type(tmp).get_asset_resources is Template.get_asset_resources:
+                    default_resources_ids.append(source_id)
+                else:
+                    total_results.extend(tmp.get_asset_resources(user, source_id, exclude=list(visited_asset_ids), db=db))
+
+            # Permissions were checked above
+            if len(default_resources_ids):
+                sql = f"""
+                    SELECT asset_resources.*, assets.creator_id, assets.group_id
+                    FROM asset_resources
+                    JOIN assets ON asset_resources.asset_id = assets.id
+                    WHERE `asset_id` IN ({','.join([str(x) for x in default_resources_ids])}) AND `name` LIKE '{MAIN_FILE}'
+                """
+                curr.execute(sql)
+                total_results.extend(curr.fetchall())
+
+            level = next_level
 
-        if results:
-            for meta in results:
-                val = int(meta['value'])
-                if val not in visited_asset_ids:
-                    rec(val)
-        
         # Deduplicate asset resources as necessary
         deduplicated = deduplicate(total_results, key=lambda x: x['id'])
         return deduplicated
@@ -9,6 +9,7 @@ from ..auth import User, token_required
 from ..db import needs_db
 from ..template_response import MyResponse
 from ..integrations.lm import LM_PROVIDERS, LM, LONG_CONTEXT_CHAT_MODEL
+from ..lm_governor import stream_governed
 from ..configs.str_constants import USER_TEXT_EDITOR_PROMPTS, DIVIDER_TEXT
 import json
 from .template import Template
@@ -130,7 +131,7 @@ def ai_continue(user: User):
             system_prompt = get_editor_continue_system_prompt(**user_system_prompt_kwargs)
     
     def stream_ai():
-        for x in lm.stream(context, system_prompt=system_prompt, show_reasoning=False):
+        for x in stream_governed(lm, context, system_prompt=system_prompt, show_reasoning=False):
             yield x.text + DIVIDER_TEXT
 
     return stream_ai()
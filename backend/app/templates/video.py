@@ -220,6 +220,7 @@ class Video(Template):
         url = request.form.get('url')
         try:
             transcribe_and_upload(asset_id, url, asset_title, db=db, no_commit=True)
+            db.flush()  # its statements are deferred until sent, so that any errors in them are caught here
         except ValueError as e:
             print(f"Exception on video upload: url is not of youtube; url={url}")
             return False, "Please use the URL of a YouTube video"
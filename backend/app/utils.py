@@ -1,6 +1,7 @@
 import string
 import random
-from datetime import datetime, timezone
+from datetime import datetime, date, timezone
+from decimal import Decimal
 import pickle
 import tiktoken
 from bs4 import BeautifulSoup
@@ -10,6 +11,7 @@ from urllib.parse import urlparse
 import re
 import os
 from urllib.parse import unquote
+import numpy as np
 
 
 def get_unique_id():
@@ -135,24 +137,48 @@ def get_token_estimate(txt):
     return len(tokens)
 
 
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+DATE_FORMAT = "%Y-%m-%d"
+
+
+# How a value from the database reaches callers, whichever way it came (db pooler over JSON or msgpack, or direct mode):
+# datetimes and dates become strings, and Decimals (from SUM, AVG, DECIMAL columns) become ints if they're whole or floats otherwise
+def make_json_scalar(x):
+    # datetime is a subclass of date, so it goes first
+    if isinstance(x, datetime):
+        return x.strftime(DATETIME_FORMAT)
+    elif isinstance(x, date):
+        return x.strftime(DATE_FORMAT)
+    elif isinstance(x, Decimal):
+        return int(x) if x == x.to_integral_value() else float(x)
+    return x
+
+
 def make_json_serializable(data):
-    # Go through data recursively and convert datetimes to strings
+    # Go through data recursively and convert datetimes, dates and Decimals (see make_json_scalar)
     def rec(x):
         # Note: converts tuple to list
         if isinstance(x, list) or isinstance(x, tuple):
             return [rec(y) for y in x]
         elif isinstance(x, dict):
             return {rec(key): rec(val) for key, val in x.items()}
-        elif isinstance(x, datetime):
-            return x.strftime("%Y-%m-%d %H:%M:%S")
         else:
-            return x
+            return make_json_scalar(x)
 
     new_data = rec(data)
 
     return new_data
 
 
+# L2-normalizes each row of a 2D array of embeddings (as float32), so that cosine similarity becomes a dot product
+# Zero rows stay zero
+def normalize_embeddings(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeddings / norms
+
+
 # In truth, there is no way to do this. A valid email can be anything with an @ sign.
 # However, here we verify that there is something before and after the @ sign as well
 # You should only use this for determining whether to send an unnecessary email; for perfect verification, you'll need something else.
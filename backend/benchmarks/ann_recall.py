@@ -0,0 +1,123 @@
+import argparse
+import sys
+import time
+import numpy as np
+from app.ann_index import IVFIndex, build_ivf_index, default_nprobe, recall_at_k
+from app.chunk_store import ChunkStore
+from app.configs.user_config import ANN_INDEX_MIN_CHUNKS, ANN_NPROBE
+from app.utils import normalize_embeddings
+
+"""
+
+Recall@k and query time of the IVF index (see ann_index.py) against exact search, for tuning ANN_INDEX_MIN_CHUNKS and ANN_NPROBE in user_config.py.
+
+By default the embeddings are synthetic: unit vectors scattered around --topics random directions, which clusters them like real text embeddings do
+(uniformly random vectors have no structure for an index to use, which makes recall look far worse than it is).
+Queries are drawn the same way, so they aren't chunks themselves. With --store, the embeddings of a real chunk store are used instead,
+and the queries are some of its chunks, nudged.
+
+From the backend directory:
+    python3 -m benchmarks.ann_recall --chunks 20000 100000 1000000 --nprobe 4 8 16 32
+    python3 -m benchmarks.ann_recall --store /path/to/resource.chunks
+
+Prints, per chunk count and nprobe: recall@k, the fraction of chunks scored, and median query time for the index and for exact search.
+Exits with 1 if recall at the configured nprobe is under --min-recall.
+
+"""
+
+
+def clustered_embeddings(rng: np.random.Generator, n, dim, topics, spread, centers=None):
+    if centers is None:
+        centers = normalize_embeddings(rng.standard_normal((topics, dim), dtype=np.float32))
+    noise = rng.standard_normal((n, dim), dtype=np.float32) * (spread / np.sqrt(dim))
+    return normalize_embeddings(centers[rng.integers(0, len(centers), size=n)] + noise), centers
+
+
+def load_store(path, n_queries, spread, rng: np.random.Generator):
+    store = ChunkStore(path)
+    if not store.has_embeddings:
+        raise ValueError(f"{path} has no embeddings")
+    embeddings = store.embeddings if store.normalized else normalize_embeddings(store.embeddings)
+    picks = np.asarray(embeddings[rng.choice(len(embeddings), size=n_queries, replace=False)])
+    noise = rng.standard_normal(picks.shape, dtype=np.float32) * (spread / np.sqrt(store.dim))
+    return embeddings, normalize_embeddings(picks + noise)
+
+
+def median_ms(f, queries):
+    times = []
+    for query_vec in queries:
+        start = time.perf_counter()
+        f(query_vec)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1000
+
+
+def exact_top_k(embeddings, query_vec, k):
+    points = embeddings @ query_vec
+    return np.argpartition(-points, k-1)[:k] if k < len(points) else np.arange(len(points))
+
+
+def ann_top_k(embeddings, index: IVFIndex, query_vec, k, nprobe):
+    candidates = index.candidates(query_vec, nprobe=nprobe)
+    points = np.asarray(embeddings[candidates]) @ query_vec
+    return candidates[np.argpartition(-points, k-1)[:k]] if k < len(points) else candidates
+
+
+def report(label, embeddings, queries, args):
+    start = time.perf_counter()
+    index = IVFIndex(*build_ivf_index(embeddings, nlist=args.nlist))
+    build = time.perf_counter() - start
+    configured = ANN_NPROBE or default_nprobe(index.nlist)
+    exact = median_ms(lambda q: exact_top_k(embeddings, q, args.k), queries)
+    print(f"{label}: nlist={index.nlist}, built in {build:.1f}s; exact search {exact:.2f}ms", flush=True)
+
+    recall_at_configured = None
+    for nprobe in sorted(set((args.nprobe or []) + [configured])):
+        nprobe = min(nprobe, index.nlist)
+        recall = recall_at_k(embeddings, queries, k=args.k, nprobe=nprobe, index=index)
+        scored = np.mean([len(index.candidates(q, nprobe=nprobe)) for q in queries]) / len(embeddings)
+        ann = median_ms(lambda q: ann_top_k(embeddings, index, q, args.k, nprobe), queries)
+        mark = "  <- configured" if nprobe == configured else ""
+        print(f"    nprobe={nprobe:<5} recall@{args.k}={recall:.3f}  scored={scored:.1%}  {ann:.2f}ms ({exact / ann:.1f}x){mark}", flush=True)
+        if nprobe == configured:
+            recall_at_configured = recall
+    return recall_at_configured
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k and query time of the IVF index against exact search")
+    parser.add_argument('--chunks', type=int, nargs='+', default=[20_000, 100_000, 1_000_000])
+    parser.add_argument('--store', default=None, help="a chunk store to take the embeddings from, instead of synthetic ones")
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--topics', type=int, default=500, help="synthetic embeddings: number of directions they cluster around")
+    parser.add_argument('--spread', type=float, default=1.0, help="how far embeddings (and queries) are from their topic; higher = less clustered")
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nlist', type=int, default=None, help="IVF lists (default: ~sqrt(chunks), as the retriever builds them)")
+    parser.add_argument('--nprobe', type=int, nargs='+', default=None, help="also try these (the configured ANN_NPROBE is always tried)")
+    parser.add_argument('--min-recall', type=float, default=.9)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"ANN_INDEX_MIN_CHUNKS={ANN_INDEX_MIN_CHUNKS}, ANN_NPROBE={ANN_NPROBE}", flush=True)
+    recalls = []
+    if args.store:
+        embeddings, queries = load_store(args.store, args.queries, args.spread, rng)
+        recalls.append(report(f"{args.store} ({len(embeddings)} chunks)", embeddings, queries, args))
+    else:
+        for n in args.chunks:
+            embeddings, centers = clustered_embeddings(rng, n, args.dim, args.topics, args.spread)
+            queries, _ = clustered_embeddings(rng, args.queries, args.dim, args.topics, args.spread, centers=centers)
+            recalls.append(report(f"{n} chunks", embeddings, queries, args))
+            del embeddings
+
+    ok = all(x >= args.min_recall for x in recalls)
+    if not ok:
+        print(f"FAIL: recall@{args.k} at the configured nprobe is under {args.min_recall}", file=sys.stderr)
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import argparse
+import random
+import string
+import time
+import zlib
+from datetime import datetime, timedelta
+from decimal import Decimal
+from app.pooler_codec import CODECS, encode_message, decode_message
+
+"""
+
+Encode / decode cost and payload size of the db pooler's wire codecs (see pooler_codec.py), on results shaped like the big ones it carries.
+
+Each table is made up of rows like SELECT * over assets, jobs_storage and asset_metadata (ints, short and long strings, JSON text, datetimes, a Decimal or two),
+wrapped in the response envelope the pooler sends back. Doesn't need the database, Redis or the pooler.
+
+From the backend directory:
+    python3 -m benchmarks.codec_bench --rows 100 1000 10000
+
+Prints, per table, row count and codec: encode and decode time (best of --repeat), and bytes on the wire (and zlib'd, for reference).
+
+"""
+
+
+def rand_text(n):
+    return ''.join(random.choices(string.ascii_letters + '     .,', k=n))
+
+
+def asset_row(i):
+    return {
+        'id': i,
+        'title': rand_text(40),
+        'preview_desc': rand_text(200),
+        'template': 'document',
+        'author_name': rand_text(12),
+        'creator': i % 97,
+        'lm_desc': rand_text(300),
+        'time_uploaded': datetime(2024, 1, 1) + timedelta(minutes=i),
+        'total_size': Decimal(random.randint(0, 10**9)),  # from a SUM
+    }
+
+
+def jobs_storage_row(i):
+    return {
+        'id': i,
+        'job_id': i // 100,
+        'resource_id': None,
+        'key': 'chunk',
+        'value': rand_text(1500),  # an LM response
+        'metadata': '{"chunk_index": %d, "chunk_name": "%s"}' % (i, rand_text(20)),
+        'time_uploaded': datetime(2024, 1, 1) + timedelta(seconds=i),
+    }
+
+
+def asset_metadata_row(i):
+    return {
+        'id': i,
+        'asset_id': i // 10,
+        'user_id': i % 13,
+        'needs_edit_permission': i % 2,
+        'key': 'scrape_queue',
+        'value': rand_text(60),
+        'time_uploaded': datetime(2024, 1, 1) + timedelta(seconds=i),
+        'avg_score': Decimal('3.1415'),  # from an AVG
+    }
+
+
+TABLES = {
+    'assets': asset_row,
+    'jobs_storage': jobs_storage_row,
+    'asset_metadata': asset_metadata_row,
+}
+
+
+def best_time(f, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode / decode cost and payload size of the db pooler's wire codecs")
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--tables', nargs='+', choices=list(TABLES), default=list(TABLES))
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    print(f"{'table':<16}{'rows':>8}  {'codec':<8}{'encode ms':>11}{'decode ms':>11}{'bytes':>12}{'zlib bytes':>12}")
+    for table in args.tables:
+        for n in args.rows:
+            message = {'data': [TABLES[table](i) for i in range(n)], 'error': None}  # like the pooler's responses
+            for codec in CODECS:
+                payload = encode_message(message, codec=codec)
+                encode = best_time(lambda: encode_message(message, codec=codec), args.repeat)
+                decode = best_time(lambda: decode_message(payload), args.repeat)
+                print(f"{table:<16}{n:>8}  {codec:<8}{encode * 1000:>11.2f}{decode * 1000:>11.2f}{len(payload):>12}{len(zlib.compress(payload)):>12}", flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app.db import PooledConn, ProxyDB
+from app.db_direct import DirectConn
+
+"""
+
+Request latency through the db pooler (over Redis) vs. direct mode (in process; see db_direct.py), on the same queries.
+
+Each "request" does what a typical endpoint does with its connection: a few point reads, a page of rows, a streamed read (optional), and a commit,
+on a new connection (like needs_db), from --threads threads at once. Only reads: nothing is written to the database.
+Needs MySQL up, and for the pooler mode, Redis and the pooler, as in the container.
+
+From the backend directory:
+    python3 -m benchmarks.db_latency --requests 2000 --threads 16
+
+Prints p50 / p99 request latency and throughput for each mode.
+
+"""
+
+MODES = {
+    'pooler': PooledConn,
+    'direct': DirectConn,
+}
+
+POINT_READ = "SELECT * FROM assets WHERE `id` = %s"
+PAGE_READ = "SELECT * FROM assets ORDER BY `id` DESC LIMIT %s"
+STREAM_READ = "SELECT * FROM asset_metadata LIMIT %s"
+
+
+def percentile(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))] if xs else float('nan')
+
+
+def get_asset_ids(conn_cls, n):
+    db = ProxyDB(conn_cls())
+    try:
+        curr = db.cursor()
+        curr.execute("SELECT `id` FROM assets ORDER BY `id` DESC LIMIT %s", (n,))
+        return [x['id'] for x in curr.fetchall()] or [1]
+    finally:
+        db.close()
+
+
+def request(conn_cls, i, asset_ids, args):
+    start = time.perf_counter()
+    db = ProxyDB(conn_cls())
+    try:
+        curr = db.cursor()
+        for k in range(args.point_reads):
+            curr.execute(POINT_READ, (asset_ids[(i + k) % len(asset_ids)],))
+            curr.fetchone()
+        curr.execute(PAGE_READ, (args.page_size,))
+        curr.fetchall()
+        if args.stream_rows:
+            for _ in curr.stream(STREAM_READ, (args.stream_rows,)):
+                pass
+        db.commit()
+    finally:
+        db.close()
+    return time.perf_counter() - start
+
+
+def run_mode(name, args):
+    conn_cls = MODES[name]
+    asset_ids = get_asset_ids(conn_cls, 100)
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        list(executor.map(lambda i: request(conn_cls, i, asset_ids, args), range(args.warmup)))
+        start = time.perf_counter()
+        latencies = list(executor.map(lambda i: request(conn_cls, i, asset_ids, args), range(args.requests)))
+        elapsed = time.perf_counter() - start
+    print(f"{name}: {args.requests} requests in {elapsed:.2f}s ({args.requests / elapsed:.0f}/s); latency p50={percentile(latencies, .5) * 1000:.2f}ms p99={percentile(latencies, .99) * 1000:.2f}ms", flush=True)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Request latency through the db pooler vs. direct mode")
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES))
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=100, help="requests before timing (connections, caches)")
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--point-reads', type=int, default=3, help="per request")
+    parser.add_argument('--page-size', type=int, default=100, help="rows in the page read")
+    parser.add_argument('--stream-rows', type=int, default=0, help="rows streamed per request (0 for none)")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.modes:
+        try:
+            results[name] = run_mode(name, args)
+        except Exception as e:
+            print(f"{name}: failed: {e}", file=sys.stderr)
+    if 'pooler' in results and 'direct' in results:
+        ratio = percentile(results['pooler'], .5) / percentile(results['direct'], .5)
+        print(f"pooler p50 / direct p50: {ratio:.2f}")
+    sys.exit(0 if len(results) == len(args.modes) else 1)
+
+
+if __name__ == '__main__':
+    main()
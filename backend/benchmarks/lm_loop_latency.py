@@ -0,0 +1,153 @@
+import sys
+if __name__ == '__main__' and '--serve' not in sys.argv and '--no-gevent' not in sys.argv:
+    from gevent import monkey
+    monkey.patch_all()  # as the server's worker class does, before anything else is imported
+
+import argparse
+import asyncio
+import json
+import subprocess
+import threading
+import time
+
+"""
+
+Latency of LM calls made on the LM loop (see get_lm_loop in integrations/lm.py) from sync code, under gevent as in the server.
+
+Starts a stub LM server (a plain asyncio server in another process, answering after --delay), then has --callers threads (greenlets, under gevent)
+each make --calls calls through run_on_lm_loop, the way batch_and_stream_lm.py does: some CPU-bound work on the loop (--loop-cpu), a POST on the pooled async client,
+and some work on the loop's executor.
+Meanwhile, a heartbeat sleeps for 10ms at a time and records how late it wakes up, which is how long the hub (and so every request) was held up.
+
+From the backend directory:
+    python3 -m benchmarks.lm_loop_latency --callers 200 --calls 20
+    python3 -m benchmarks.lm_loop_latency --no-gevent  # for comparison
+
+Prints p50 / p99 latency and heartbeat lag; exits with 1 if any call failed or the heartbeat was late by more than --max-lag.
+
+"""
+
+HEARTBEAT = .01  # in seconds
+STUB_RESPONSE = json.dumps({'choices': [{'message': {'role': 'assistant', 'content': 'ok'}}]}).encode('utf-8')
+
+
+def percentile(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))] if xs else float('nan')
+
+
+async def serve(port, delay):
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                length = 0
+                for line in head.split(b'\r\n'):
+                    if line.lower().startswith(b'content-length:'):
+                        length = int(line.split(b':')[1])
+                if length:
+                    await reader.readexactly(length)
+                await asyncio.sleep(delay)
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n' % len(STUB_RESPONSE) + STUB_RESPONSE)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', port, backlog=1024)
+    print(server.sockets[0].getsockname()[1], flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+def start_stub_server(delay):
+    proc = subprocess.Popen([sys.executable, __file__, '--serve', '--delay', str(delay)], stdout=subprocess.PIPE, text=True)
+    port = int(proc.stdout.readline())
+    return proc, f"http://127.0.0.1:{port}/v1/chat/completions"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency of LM calls on the LM loop, and how much they hold up the gevent hub")
+    parser.add_argument('--callers', type=int, default=200, help="concurrent callers (greenlets under gevent)")
+    parser.add_argument('--calls', type=int, default=20, help="per caller")
+    parser.add_argument('--delay', type=float, default=.05, help="the stub server's response time, in seconds")
+    parser.add_argument('--loop-cpu', type=float, default=.002, help="CPU time spent on the loop per call, in seconds")
+    parser.add_argument('--max-lag', type=float, default=.1, help="allowed heartbeat lag, in seconds")
+    parser.add_argument('--no-gevent', action='store_true', help="don't monkey patch (as in celery or scripts)")
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        asyncio.run(serve(0, args.delay))
+        return
+
+    from app.integrations.lm import run_on_lm_loop, get_async_http_client
+
+    proc, url = start_stub_server(args.delay)
+
+    async def call():
+        # CPU-bound work on the loop itself, like the governor's token estimates for long prompts
+        until = time.perf_counter() + args.loop_cpu
+        while time.perf_counter() < until:
+            pass
+        client = get_async_http_client(url)
+        resp = await client.post(url, json={'model': 'stub', 'messages': [{'role': 'user', 'content': 'hi'}]})
+        resp.raise_for_status()
+        # Some sync work on the loop's executor, like the governor's and the cache's redis calls
+        resp_json = await asyncio.get_running_loop().run_in_executor(None, json.loads, resp.text)
+        return resp_json['choices'][0]['message']['content']
+
+    latencies = []
+    errors = []
+    lags = []
+    done = threading.Event()
+
+    def caller():
+        for _ in range(args.calls):
+            start = time.perf_counter()
+            try:
+                run_on_lm_loop(call()).result()
+                latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                errors.append(e)
+
+    def heartbeat():
+        last = time.perf_counter()
+        while not done.is_set():
+            time.sleep(HEARTBEAT)
+            now = time.perf_counter()
+            lags.append(max(0, now - last - HEARTBEAT))
+            last = now
+
+    try:
+        run_on_lm_loop(call()).result()  # warm up (the client, its first connection)
+        beat = threading.Thread(target=heartbeat, daemon=True)
+        beat.start()
+        start = time.perf_counter()
+        callers = [threading.Thread(target=caller, daemon=True) for _ in range(args.callers)]
+        for x in callers:
+            x.start()
+        for x in callers:
+            x.join()
+        elapsed = time.perf_counter() - start
+        done.set()
+        beat.join()
+    finally:
+        proc.terminate()
+
+    mode = "no gevent" if args.no_gevent else "gevent"
+    print(f"{mode}: {len(latencies)} calls in {elapsed:.2f}s ({len(latencies) / elapsed:.0f}/s), {len(errors)} errors")
+    print(f"latency p50={percentile(latencies, .5) * 1000:.1f}ms p99={percentile(latencies, .99) * 1000:.1f}ms (stub server: {args.delay * 1000:.0f}ms)")
+    print(f"heartbeat lag p99={percentile(lags, .99) * 1000:.1f}ms max={max(lags, default=0) * 1000:.1f}ms")
+    ok = not errors and max(lags, default=0) <= args.max_lag
+    if errors:
+        print(f"FAIL: first error: {errors[0]!r}", file=sys.stderr)
+    elif not ok:
+        print(f"FAIL: the heartbeat was held up for more than {args.max_lag * 1000:.0f}ms", file=sys.stderr)
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
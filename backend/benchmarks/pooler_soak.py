@@ -0,0 +1,120 @@
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import psutil
+import redis
+from app.configs.conn_config import POOLER_CONNECTION_PARAMS
+from app.db import PooledConn, ProxyDB
+from app.pooler_codec import decode_message
+
+"""
+
+Soak test for the db pooler's id and cursor reaping (see reap_idle in db_pooler.py).
+
+Drives a lot of short-lived connections and cursors through a running pooler, leaving some of them open on purpose (like callers that crash),
+and checks that the pooler's live ids and cursors and its memory come back down once the abandoned ones have been idle for longer than IDLE_TTL.
+Needs the pooler, Redis and MySQL up, as in the container, and takes a while: abandoned ids are only reaped after 30 minutes.
+
+From the backend directory:
+    python3 -m benchmarks.pooler_soak --cursors 1000000
+
+Exits with 1 if memory or the live counts didn't settle.
+
+"""
+
+POOLER_STATS_KEY = 'pooler_stats'  # see db_pooler.py
+IDLE_TTL = 30 * 60  # in seconds; as in db_pooler.py
+REAP_INTERVAL = 60  # in seconds
+
+
+def find_pooler():
+    for proc in psutil.process_iter(['cmdline']):
+        cmdline = proc.info['cmdline'] or []
+        if any('app.db_pooler' in x for x in cmdline):
+            return proc
+    return None
+
+
+def pooler_stats(r: redis.Redis):
+    payload = r.get(POOLER_STATS_KEY)
+    return decode_message(payload)[0] if payload else {}
+
+
+def sample(r: redis.Redis, proc: psutil.Process, label):
+    stats = pooler_stats(r)
+    rss = proc.memory_info().rss / 1e6 if proc else None
+    point = {
+        'label': label,
+        'rss_mb': rss,
+        'live_ids': stats.get('live_ids'),
+        'live_cursors': stats.get('live_cursors'),
+        'cursor_locks': stats.get('cursor_locks'),
+        'reaped_ids': stats.get('reaped_ids'),
+        'reaped_cursors': stats.get('reaped_cursors'),
+    }
+    print(" ".join(f"{k}={v:.1f}" if isinstance(v, float) else f"{k}={v}" for k, v in point.items()), flush=True)
+    return point
+
+
+# One short-lived cursor; every abandon_every-th one is left open, along with its connection
+def use_cursor(i, abandon_every):
+    db = ProxyDB(PooledConn(consistent_conn=(i % 3 == 0)))
+    curr = db.cursor()
+    curr.execute("SELECT 1 AS x")
+    curr.fetchall()
+    if abandon_every and i % abandon_every == 0:
+        return
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak test for the db pooler's reaping of idle ids and cursors")
+    parser.add_argument('--cursors', type=int, default=1_000_000)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--abandon-every', type=int, default=100, help="every nth cursor and connection is never closed (0 for none)")
+    parser.add_argument('--sample-every', type=int, default=50_000, help="in cursors")
+    parser.add_argument('--settle', type=int, default=IDLE_TTL + 3 * REAP_INTERVAL, help="seconds to wait at the end, for abandoned ids to be reaped")
+    parser.add_argument('--max-growth-mb', type=float, default=50, help="allowed RSS growth over the sample after warm up")
+    parser.add_argument('--max-live', type=int, default=100, help="allowed live ids / cursors once settled")
+    args = parser.parse_args()
+
+    r = redis.Redis(**POOLER_CONNECTION_PARAMS)
+    proc = find_pooler()
+    if proc is None:
+        print("Couldn't find the db pooler process; memory won't be checked.", file=sys.stderr)
+
+    points = [sample(r, proc, 'start')]
+    start = time.time()
+    done = 0
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        while done < args.cursors:
+            n = min(args.sample_every, args.cursors - done)
+            list(executor.map(lambda i: use_cursor(i, args.abandon_every), range(done, done + n)))
+            done += n
+            points.append(sample(r, proc, f"{done} cursors, {done / (time.time() - start):.0f}/s"))
+
+    settle_until = time.time() + args.settle
+    while time.time() < settle_until:
+        time.sleep(min(60, max(0, settle_until - time.time())))
+        points.append(sample(r, proc, f"settling, {max(0, settle_until - time.time()):.0f}s left"))
+
+    ok = True
+    final = points[-1]
+    for key in ('live_ids', 'live_cursors', 'cursor_locks'):
+        if final[key] is not None and final[key] > args.max_live:
+            print(f"FAIL: {key} is still {final[key]} after settling", file=sys.stderr)
+            ok = False
+    if proc is not None and len(points) > 2:
+        warm = points[min(2, len(points) - 1)]  # after the first batch or so, once the pools and caches are warm
+        growth = final['rss_mb'] - warm['rss_mb']
+        print(f"RSS growth since warm up: {growth:.1f} MB")
+        if growth > args.max_growth_mb:
+            print(f"FAIL: RSS grew by {growth:.1f} MB (allowed {args.max_growth_mb} MB)", file=sys.stderr)
+            ok = False
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from app.chunk_store import ChunkStore, ChunkStoreWriter
+from app.retriever import _score_store, _top_k
+from app.utils import normalize_embeddings
+
+"""
+
+Cost of scoring a query against a resource's chunks: the old path vs. the current one (see _score_store in retriever.py).
+
+- old: the chunks' embeddings are lists of floats in memory (as they were in pickled retrievers); every query builds a float64 array from them
+  and calls sklearn's cosine_similarity, which normalizes every row again, then sorts all the scores.
+  If sklearn isn't installed, an equivalent NumPy version is used (the same float64 work).
+- new: the embeddings were normalized once when embedded and sit in a memory-mapped chunk store; a query is one float32 matrix-vector product
+  and a partial sort for the top k.
+
+Embeddings are random unit vectors; the ANN index isn't used (see ann_recall.py for that). Doesn't need the database or an embedding API.
+
+From the backend directory:
+    python3 -m benchmarks.scoring_bench --chunks 10000 100000 1000000 --dim 1536
+
+Prints, per chunk count and path: the first query (after opening / building) and the median of --queries more, in ms.
+The old path keeps n * dim Python floats around, so it's skipped when that would take more than --max-old-mb.
+
+"""
+
+BUILD_BATCH_SIZE = 10_000
+PYTHON_FLOAT_LIST_BYTES = 8 + 24  # a list slot + a float object, per number
+
+try:
+    from sklearn.metrics import pairwise
+    OLD_PATH_NAME = "old (sklearn)"
+except ImportError:
+    pairwise = None
+    OLD_PATH_NAME = "old (numpy equiv.)"
+
+
+# What sklearn's cosine_similarity does for dense input
+def _old_cosine_similarity(x, y):
+    if pairwise is not None:
+        return pairwise.cosine_similarity(x, y, dense_output=True)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    x_norms = np.linalg.norm(x, axis=1, keepdims=True)
+    y_norms = np.linalg.norm(y, axis=1, keepdims=True)
+    x_norms[x_norms == 0] = 1
+    y_norms[y_norms == 0] = 1
+    return (x / x_norms) @ (y / y_norms).T
+
+
+def random_embeddings(rng: np.random.Generator, n, dim):
+    return normalize_embeddings(rng.standard_normal((n, dim), dtype=np.float32))
+
+
+def build_store(path, n, dim, seed):
+    rng = np.random.default_rng(seed)
+    with ChunkStoreWriter(path, normalized=True) as writer:
+        for start in range(0, n, BUILD_BATCH_SIZE):
+            batch = random_embeddings(rng, min(BUILD_BATCH_SIZE, n - start), dim)
+            for i, embedding in enumerate(batch):
+                writer.add(start + i, "bench", "", embedding=embedding)
+
+
+def old_query(embedding_lists, query, k):
+    embeddings = np.array(embedding_lists)
+    sims = _old_cosine_similarity([query], embeddings)
+    points = np.array(sims[0])
+    return points.argsort()[::-1][:k]
+
+
+def new_query(store: ChunkStore, query_vec, k):
+    points, positions = _score_store(store, query_vec, use_ann=False)
+    return positions[_top_k(points, k)]
+
+
+def time_queries(f, queries):
+    times = []
+    for query in queries:
+        start = time.perf_counter()
+        f(query)
+        times.append(time.perf_counter() - start)
+    return times[0], float(np.median(times[1:])) if len(times) > 1 else times[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cost of scoring a query against a resource's chunks, old path vs. current")
+    parser.add_argument('--chunks', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--k', type=int, default=50)
+    parser.add_argument('--max-old-mb', type=float, default=2000, help="skip the old path when its lists of floats would take more than this")
+    parser.add_argument('--dir', default=None, help="where to write the chunk stores (a temp dir by default)")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        print(f"{'chunks':>10}  {'path':<20}{'setup s':>9}{'first ms':>11}{'median ms':>11}", flush=True)
+        for n in args.chunks:
+            rng = np.random.default_rng(n)
+            queries = random_embeddings(rng, args.queries + 1, args.dim)
+
+            path = os.path.join(tmp_dir, f"bench_{n}.chunks")
+            start = time.perf_counter()
+            build_store(path, n, args.dim, seed=n)
+            store = ChunkStore(path)
+            setup = time.perf_counter() - start
+            first, median = time_queries(lambda q: new_query(store, q, args.k), queries)
+            print(f"{n:>10}  {'new':<20}{setup:>9.1f}{first * 1000:>11.2f}{median * 1000:>11.2f}", flush=True)
+
+            old_mb = n * args.dim * PYTHON_FLOAT_LIST_BYTES / 1e6
+            if old_mb > args.max_old_mb:
+                print(f"{n:>10}  {OLD_PATH_NAME:<20}  skipped: would need ~{old_mb:.0f} MB of lists (--max-old-mb {args.max_old_mb:.0f})", flush=True)
+            else:
+                start = time.perf_counter()
+                embedding_lists = [x.astype(np.float64).tolist() for x in store.embeddings]
+                setup = time.perf_counter() - start
+                first, median = time_queries(lambda q: old_query(embedding_lists, q.tolist(), args.k), queries)
+                print(f"{n:>10}  {OLD_PATH_NAME:<20}{setup:>9.1f}{first * 1000:>11.2f}{median * 1000:>11.2f}", flush=True)
+                del embedding_lists
+
+            store.close()
+            os.remove(path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# So the tests can import the app package when run from anywhere (e.g., python -m pytest backend/tests)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,149 @@
+import os
+import pickle
+import numpy as np
+import pytest
+from app.chunk_store import ChunkStore, ChunkStoreWriter, convert_legacy_chunk_file, copy_with_ann_index, is_chunk_store
+from app.utils import normalize_embeddings
+
+
+# What the old retriever pickled, one after another (the real one is retriever.Chunk; the loader only needs the attributes)
+class LegacyChunk():
+    def __init__(self, index, source_name, txt, embedding=None) -> None:
+        self.index = index
+        self.source_name = source_name
+        self.txt = txt
+        self.embedding = embedding
+
+
+# Chunk indices out of order and with a repeat, as when a resource is re-chunked and appended to
+INDICES = [3, 0, 7, 1, 3, 12]
+TEXTS = ["three", "zero", "séven ✓", "", "three again", "twelve " * 100]
+
+
+def write_store(path, embeddings=None, normalized=False):
+    with ChunkStoreWriter(path, normalized=normalized) as writer:
+        for i, (index, txt) in enumerate(zip(INDICES, TEXTS)):
+            writer.add(index, f"source {i % 2}", txt, embedding=None if embeddings is None else embeddings[i])
+    return ChunkStore(path)
+
+
+@pytest.fixture
+def embeddings():
+    return normalize_embeddings(np.random.default_rng(0).standard_normal((len(INDICES), 8)))
+
+
+def test_write_and_read_back(tmp_path, embeddings):
+    store = write_store(tmp_path / "x.chunks", embeddings, normalized=True)
+    assert is_chunk_store(store.path)
+    assert len(store) == len(INDICES)
+    assert store.normalized and store.has_embeddings
+    assert [store.txt(i) for i in range(len(store))] == TEXTS
+    assert store.names == [f"source {i % 2}" for i in range(len(INDICES))]
+    assert store.indices.tolist() == INDICES
+    assert store.lengths == [len(x) for x in TEXTS]
+    assert store.embeddings.dtype == np.float32
+    assert np.allclose(store.embeddings, embeddings)
+
+
+def test_without_embeddings(tmp_path):
+    store = write_store(tmp_path / "x.chunks")
+    assert not store.has_embeddings
+    assert store.embeddings is None
+    assert store.ann_index is None
+    assert store.txt(2) == "séven ✓"
+
+
+def test_empty_store(tmp_path):
+    with ChunkStoreWriter(tmp_path / "x.chunks") as writer:
+        pass
+    store = ChunkStore(writer.path)
+    assert len(store) == 0
+    assert store.positions_of([0, 1]).tolist() == [-1, -1]
+
+
+def test_positions_of(tmp_path):
+    store = write_store(tmp_path / "x.chunks")
+    # The first position with each index; -1 for ones that aren't there (including past either end)
+    assert store.positions_of([12, 3, 0, 5, 1, 7, -1, 100]).tolist() == [5, 0, 1, -1, 3, 2, -1, -1]
+    assert store.positions_of([]).tolist() == []
+    assert store.positions_of(7).tolist() == [2]
+
+
+def test_reopened_after_pickling(tmp_path):
+    store = write_store(tmp_path / "x.chunks")
+    store.txt(0)
+    assert store.is_open
+    copy = pickle.loads(pickle.dumps(store))
+    assert not copy.is_open
+    assert copy.positions_of([1]).tolist() == [3]
+
+
+def test_mixing_chunks_with_and_without_embeddings_is_refused(tmp_path):
+    writer = ChunkStoreWriter(tmp_path / "x.chunks")
+    writer.add(0, "a", "x", embedding=[1., 0.])
+    with pytest.raises(ValueError):
+        writer.add(1, "a", "y")
+    with pytest.raises(ValueError):
+        writer.add(1, "a", "y", embedding=[1., 0., 0.])
+    writer.abort()
+
+
+def test_nothing_is_written_on_an_exception(tmp_path):
+    path = tmp_path / "x.chunks"
+    with pytest.raises(RuntimeError):
+        with ChunkStoreWriter(path) as writer:
+            writer.add(0, "a", "x")
+            raise RuntimeError()
+    assert not os.path.exists(path)
+
+
+def test_convert_legacy_chunk_file(tmp_path):
+    src = tmp_path / "legacy"
+    raw = [[3., 4.], [0., 0.], [1., 1.]]
+    with open(src, 'wb') as fhand:
+        for i, embedding in enumerate(raw):
+            pickle.dump(LegacyChunk(i * 2, "src", f"chunk {i}", embedding=embedding), fhand)
+
+    store = ChunkStore(convert_legacy_chunk_file(src, tmp_path / "x.chunks"))
+    assert len(store) == 3
+    assert store.normalized
+    assert store.indices.tolist() == [0, 2, 4]
+    assert [store.txt(i) for i in range(3)] == ["chunk 0", "chunk 1", "chunk 2"]
+    # Unit length, except for the zero vector, which stays zero
+    assert np.allclose(store.embeddings, [[.6, .8], [0., 0.], [2 ** -.5, 2 ** -.5]])
+
+
+def test_convert_legacy_chunk_file_without_embeddings(tmp_path):
+    src = tmp_path / "legacy"
+    with open(src, 'wb') as fhand:
+        pickle.dump(LegacyChunk(0, "src", "only"), fhand)
+    store = ChunkStore(convert_legacy_chunk_file(src, tmp_path / "x.chunks"))
+    assert not store.has_embeddings
+    assert store.txt(0) == "only"
+
+
+def test_copy_with_ann_index(tmp_path):
+    pytest.importorskip('app.retriever')
+    embeddings = normalize_embeddings(np.random.default_rng(1).standard_normal((300, 16)))
+    with ChunkStoreWriter(tmp_path / "x.chunks", normalized=True) as writer:
+        for i, embedding in enumerate(embeddings):
+            writer.add(i, "src", str(i), embedding=embedding)
+    store = ChunkStore(copy_with_ann_index(writer.path, tmp_path / "y.chunks"))
+    assert store.has_ann_index and store.normalized
+    assert store.txt(299) == "299"
+    assert np.allclose(store.embeddings, embeddings)
+    # Every chunk is in exactly one list
+    index = store.ann_index
+    assert sorted(index.order.tolist()) == list(range(300))
+    # Probing every list gives every chunk
+    assert index.candidates(embeddings[0], nprobe=index.nlist).tolist() == list(range(300))
+
+
+def test_get_chunks_by_indices(tmp_path, embeddings):
+    pytest.importorskip('app.retriever')
+    store = write_store(tmp_path / "x.chunks", embeddings)
+    chunks = store.get_chunks_by_indices([7, 5, 3])
+    assert chunks[1] is None
+    assert (chunks[0].index, chunks[0].txt) == (7, "séven ✓")
+    assert (chunks[2].index, chunks[2].txt) == (3, "three")
+    assert np.allclose(chunks[0].embedding, embeddings[2])
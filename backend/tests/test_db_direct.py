@@ -0,0 +1,127 @@
+import gc
+import pytest
+from app.db_direct import Stream, CONNECTION_LOCKS, LOADS, STREAMS, LOAD_LOCK, _drain_stream
+
+INDEX = 0
+
+
+# An unbuffered cursor's side of a stream: rows come out fetchmany at a time; fail_after makes the fetch after that many rows raise
+class FakeCursor():
+    def __init__(self, n, fail_after=None) -> None:
+        self.rows = [{'id': i} for i in range(n)]
+        self.pos = 0
+        self.fail_after = fail_after
+        self.closed = False
+
+    def fetchmany(self, size):
+        if self.fail_after is not None and self.pos >= self.fail_after:
+            raise ConnectionError("lost the connection")
+        batch = self.rows[self.pos:self.pos+size]
+        self.pos += len(batch)
+        return batch
+
+    def close(self):
+        self.closed = True
+
+
+# As DirectConn._acquire leaves the connection for a stream
+def open_stream(curr, batch_size=2):
+    with LOAD_LOCK:
+        LOADS[INDEX] += 1
+    assert CONNECTION_LOCKS[INDEX].acquire(timeout=1)
+    return Stream(INDEX, curr, batch_size)
+
+
+def is_released():
+    if not CONNECTION_LOCKS[INDEX].acquire(blocking=False):
+        return False
+    CONNECTION_LOCKS[INDEX].release()
+    return LOADS[INDEX] == 0 and STREAMS[INDEX] is None
+
+
+@pytest.fixture(autouse=True)
+def released_after():
+    yield
+    gc.collect()
+    assert is_released()
+
+
+def test_reading_to_the_end_gives_back_the_connection():
+    curr = FakeCursor(5)
+    stream = open_stream(curr)
+    assert not is_released()
+    assert [x['id'] for x in stream] == [0, 1, 2, 3, 4]
+    assert is_released()
+    assert curr.closed
+    assert list(stream) == []
+
+
+def test_reads_a_batch_at_a_time():
+    curr = FakeCursor(10)
+    stream = open_stream(curr, batch_size=3)
+    assert next(stream)['id'] == 0
+    assert curr.pos == 3
+    stream.close()
+
+
+def test_closing_early_gives_back_the_connection():
+    curr = FakeCursor(100)
+    stream = open_stream(curr)
+    next(stream)
+    stream.close()
+    assert is_released()
+    assert curr.closed
+    assert [x['id'] for x in stream] == [1]  # only what was already read
+
+
+def test_dropping_it_gives_back_the_connection():
+    curr = FakeCursor(100)
+    stream = open_stream(curr)
+    next(stream)
+    del stream
+    gc.collect()
+    assert is_released()
+    assert curr.closed
+
+
+def test_dropping_it_unread_gives_back_the_connection():
+    open_stream(FakeCursor(100))
+    gc.collect()
+    assert is_released()
+
+
+def test_an_error_reading_gives_back_the_connection():
+    stream = open_stream(FakeCursor(10, fail_after=4))
+    assert [next(stream)['id'] for _ in range(4)] == [0, 1, 2, 3]
+    with pytest.raises(ConnectionError):
+        next(stream)
+    assert is_released()
+
+
+def test_draining_gives_back_the_connection_and_keeps_the_rows():
+    curr = FakeCursor(7)
+    stream = open_stream(curr)
+    next(stream)
+    _drain_stream(INDEX)  # as whoever needs the connection next does
+    assert is_released()
+    assert curr.pos == 7
+    assert [x['id'] for x in stream] == [1, 2, 3, 4, 5, 6]
+
+
+def test_an_error_draining_goes_to_the_reader_after_the_rows_before_it():
+    stream = open_stream(FakeCursor(10, fail_after=4))
+    _drain_stream(INDEX)
+    assert is_released()
+    assert [next(stream)['id'] for _ in range(4)] == [0, 1, 2, 3]
+    with pytest.raises(ConnectionError):
+        next(stream)
+
+
+def test_a_new_stream_on_the_connection_isnt_given_back_by_an_old_one():
+    old = open_stream(FakeCursor(2))
+    list(old)
+    new = open_stream(FakeCursor(2))
+    old.close()
+    assert STREAMS[INDEX] is new.ref
+    assert not is_released()
+    new.close()
@@ -0,0 +1,124 @@
+import sqlite3
+import pytest
+from app import db as db_module
+from app.db import PooledConn, ProxyDB
+
+
+# Runs the client's messages the way db_pooler.py does (a batch stops at the first error, which names the op, and only the closes after it still run),
+# over a sqlite database instead of MySQL
+class FakePooler():
+    def __init__(self, path) -> None:
+        self.path = path
+        self.conns = {}
+        self.cursors = {}
+        self.messages = []
+
+    def __call__(self, redis, options):
+        self.messages.append(options)
+        ops = options['ops'] if options['type'] == 'batch' else [options]
+        results = []
+        for i, op in enumerate(ops):
+            try:
+                results.append(self.run(op))
+            except Exception as e:
+                for x in ops[i+1:]:
+                    if x['type'] == 'close_connection' or (x['type'] == 'cursor_function' and x['name'] == 'close'):
+                        self.run(x)
+                raise Exception(f"Error passed from db pool: Command {i} ({op['type']} {op.get('name', '')}) of batch failed: {e!r}. Args were: {op.get('args', [])}.")
+        return results if options['type'] == 'batch' else results[0]
+
+    def run(self, op):
+        if op['type'] == 'new_connection':
+            self.conns[op['db_id']] = sqlite3.connect(self.path)
+        elif op['type'] == 'close_connection':
+            self.conns.pop(op['db_id']).close()
+        elif op['type'] == 'commit':
+            self.conns[op['db_id']].commit()
+        elif op['type'] == 'new_cursor':
+            self.cursors[op['curr_id']] = self.conns[op['db_id']].cursor()
+        elif op['type'] == 'cursor_function':
+            curr = self.cursors[op['curr_id']]
+            if op['name'] == 'execute':
+                sql, *args = op['args']
+                curr.execute(sql.replace('%s', '?'), *args)
+            elif op['name'] == 'fetchall':
+                names = [x[0] for x in curr.description]
+                return [dict(zip(names, row)) for row in curr.fetchall()]
+            elif op['name'] == 'close':
+                self.cursors.pop(op['curr_id']).close()
+        return True
+
+
+@pytest.fixture
+def pooler(tmp_path, monkeypatch):
+    pooler = FakePooler(str(tmp_path / "db.sqlite"))
+    with sqlite3.connect(pooler.path) as conn:
+        conn.execute("CREATE TABLE notes (id INTEGER PRIMARY KEY, txt TEXT)")
+        conn.execute("INSERT INTO notes (id, txt) VALUES (1, 'first')")
+    monkeypatch.setattr(db_module, 'exec_via_redis', pooler)
+    return pooler
+
+
+def note_ids(pooler):
+    with sqlite3.connect(pooler.path) as conn:
+        return [x[0] for x in conn.execute("SELECT id FROM notes ORDER BY id")]
+
+
+def test_a_failing_execute_raises_from_the_fetch_that_sends_it(pooler):
+    db = ProxyDB(PooledConn())
+    curr = db.cursor()
+    assert curr.execute("SELECT * FROM no_such_table") is None
+    assert pooler.messages == []
+    with pytest.raises(Exception, match=r"execute\) of batch failed.*no_such_table"):
+        curr.fetchall()
+    assert len(pooler.messages) == 1  # new connection, new cursor, execute and fetchall in one go
+
+
+def test_a_failing_execute_raises_from_the_commit_and_what_follows_it_is_skipped(pooler):
+    db = ProxyDB(PooledConn())
+    curr = db.cursor()
+    curr.execute("INSERT INTO notes (id, txt) VALUES (%s, %s)", (2, 'second'))
+    curr.execute("INSERT INTO notes (id, txt) VALUES (%s, %s)", (1, 'duplicate'))
+    curr.execute("INSERT INTO notes (id, txt) VALUES (%s, %s)", (3, 'third'))
+    with pytest.raises(Exception, match=r"UNIQUE constraint failed.*'duplicate'"):
+        db.commit()
+    assert note_ids(pooler) == [1]  # nothing was committed
+    assert pooler.cursors == {}  # but the cursor was still closed
+
+
+def test_flush_raises_without_committing(pooler):
+    db = ProxyDB(PooledConn())
+    curr = db.cursor()
+    curr.execute("INSERT INTO notes (id, txt) VALUES (%s, %s)", (2, 'second'))
+    db.flush()
+    assert note_ids(pooler) == [1]  # sent, but not committed
+    curr.execute("INSERT INTO notes (id, txt) VALUES (%s, %s)", (1, 'duplicate'))
+    with pytest.raises(Exception, match="UNIQUE constraint failed"):
+        db.flush()
+    # The failed op isn't sent again, and the connection can still be used
+    curr = db.cursor()
+    curr.execute("SELECT COUNT(*) AS n FROM notes")
+    assert curr.fetchall() == [{'n': 2}]
+    db.commit(close=True)
+    assert note_ids(pooler) == [1, 2]
+
+
+def test_a_try_around_only_the_execute_doesnt_catch_its_error(pooler):
+    db = ProxyDB(PooledConn())
+    curr = db.cursor()
+    try:
+        curr.execute("INSERT INTO notes (id, txt) VALUES (%s, %s)", (1, 'duplicate'))
+    except Exception:
+        pytest.fail("execute never raises")
+    # It comes from whatever sends next, even on another cursor
+    other = db.cursor()
+    other.execute("SELECT * FROM notes")
+    with pytest.raises(Exception, match="UNIQUE constraint failed"):
+        other.fetchall()
+
+
+def test_nothing_is_sent_for_an_unused_connection(pooler):
+    db = ProxyDB(PooledConn())
+    db.cursor()
+    db.commit(close=True)
+    assert pooler.messages == []
@@ -0,0 +1,61 @@
+import sqlite3
+import pytest
+from app.db import fetch_page_with_total
+
+
+# Enough of a cursor for fetch_page_with_total, over sqlite (which has window functions too); rows are dicts, like pymysql's DictCursor
+class SqliteCursor():
+    def __init__(self, conn):
+        self.curr = conn.cursor()
+        self.statements = []
+
+    def execute(self, sql):
+        self.statements.append(sql)
+        self.curr.execute(sql)
+
+    def fetchall(self):
+        names = [x[0] for x in self.curr.description]
+        return [dict(zip(names, row)) for row in self.curr.fetchall()]
+
+    def fetchone(self):
+        rows = self.fetchall()
+        return rows[0] if rows else None
+
+
+@pytest.fixture
+def curr():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE assets (id INTEGER PRIMARY KEY, title TEXT, template TEXT)")
+    conn.executemany("INSERT INTO assets (id, title, template) VALUES (?, ?, ?)", [(i, f"Asset {i:02}", 'folder' if i % 3 == 0 else 'document') for i in range(1, 26)])
+    yield SqliteCursor(conn)
+    conn.close()
+
+
+BODY = "WITH docs AS (SELECT * FROM assets WHERE template = 'document') SELECT *, 1 AS score FROM docs"
+
+
+def test_page_and_total_in_one_statement(curr):
+    rows, total = fetch_page_with_total(curr, BODY, "a.score DESC, title ASC", 5, 5)
+    assert total == 17
+    assert [x['title'] for x in rows] == ["Asset 08", "Asset 10", "Asset 11", "Asset 13", "Asset 14"]
+    assert all(set(x) == {'id', 'title', 'template', 'score'} for x in rows)
+    assert len(curr.statements) == 1
+
+
+def test_last_partial_page(curr):
+    rows, total = fetch_page_with_total(curr, BODY, "id", 5, 15)
+    assert total == 17
+    assert [x['id'] for x in rows] == [23, 25]
+
+
+def test_page_past_the_end_still_counts(curr):
+    rows, total = fetch_page_with_total(curr, BODY, "id", 5, 100)
+    assert rows == []
+    assert total == 17
+    assert len(curr.statements) == 2
+
+
+def test_nothing_matches(curr):
+    rows, total = fetch_page_with_total(curr, "SELECT * FROM assets WHERE template = 'quiz'", "id", 5, 0)
+    assert (rows, total) == ([], 0)
+    assert len(curr.statements) == 1
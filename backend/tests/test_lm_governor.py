@@ -0,0 +1,132 @@
+import asyncio
+import time
+import uuid
+from types import SimpleNamespace
+import pytest
+import redis
+from app import lm_governor
+from app.lm_governor import Governor, get_retry_after, has_limits, INTERACTIVE, BACKGROUND, DEFAULT_RETRY_AFTER, RESERVE
+
+
+def make_lm(requests_per_minute=None, tokens_per_minute=None):
+    return SimpleNamespace(code=f"test_lm_{uuid.uuid4().hex}", requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+
+
+def error_with(status_code=429, headers=None):
+    e = Exception()
+    e.response = SimpleNamespace(status_code=status_code, headers=headers or {})
+    return e
+
+
+def test_retry_after():
+    assert get_retry_after(Exception()) is None
+    assert get_retry_after(error_with(500, {'retry-after': '5'})) is None
+    assert get_retry_after(error_with(headers={'retry-after': '5'})) == 5
+    assert get_retry_after(error_with(headers={'retry-after-ms': '1500', 'retry-after': '5'})) == 1.5
+    assert get_retry_after(error_with()) == DEFAULT_RETRY_AFTER
+    assert get_retry_after(error_with(headers={'retry-after': 'soon'})) == DEFAULT_RETRY_AFTER
+    later = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(time.time() + 30))
+    assert 25 < get_retry_after(error_with(headers={'retry-after': later})) <= 30
+    earlier = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(time.time() - 30))
+    assert get_retry_after(error_with(headers={'retry-after': earlier})) == 0
+
+
+def test_without_limits_only_retry_after_applies():
+    governor = Governor()
+    lm = make_lm()
+    assert not has_limits(lm)
+    assert governor._take(lm, 10**9, BACKGROUND) == 0
+    governor.blocked_until[lm.code] = time.time() + 5
+    assert 4 < governor._take(lm, 1, INTERACTIVE) <= 5
+
+
+def test_waiting_calls_go_in_order_of_priority():
+    governor = Governor()
+    lm = make_lm()
+    order = []
+
+    async def call(name, priority):
+        await governor.acquire(lm, 1, priority)
+        order.append(name)
+
+    async def main():
+        # Held up by a 429 until every call is waiting
+        governor.blocked_until[lm.code] = time.time() + .2
+        await asyncio.gather(call('background 1', BACKGROUND), call('interactive 1', INTERACTIVE), call('background 2', BACKGROUND), call('interactive 2', INTERACTIVE))
+
+    asyncio.run(main())
+    assert order == ['interactive 1', 'interactive 2', 'background 1', 'background 2']
+
+
+@pytest.fixture(scope='module')
+def needs_redis():
+    try:
+        lm_governor.r.ping()
+    except redis.RedisError:
+        pytest.skip("needs Redis (at POOLER_CONNECTION_PARAMS)")
+
+
+# The token buckets themselves are a script in Redis
+@pytest.mark.usefixtures('needs_redis')
+class TestBuckets():
+    @pytest.fixture(autouse=True)
+    def clean_up(self):
+        self.codes = []
+        yield
+        for code in self.codes:
+            lm_governor.r.delete(*lm_governor._keys(code))
+
+    def lm(self, **kwargs):
+        lm = make_lm(**kwargs)
+        self.codes.append(lm.code)
+        return lm
+
+    def test_requests_per_minute(self):
+        governor = Governor()
+        lm = self.lm(requests_per_minute=2)
+        assert governor._take(lm, 1, INTERACTIVE) == 0
+        assert governor._take(lm, 1, INTERACTIVE) == 0
+        # Empty; one request comes back every 30 seconds
+        assert 29 < governor._take(lm, 1, INTERACTIVE) <= 30
+
+    def test_tokens_per_minute(self):
+        governor = Governor()
+        lm = self.lm(tokens_per_minute=1000)
+        assert governor._take(lm, 600, INTERACTIVE) == 0
+        # 400 left, so 200 more to wait for, at 1000 a minute
+        assert 11.5 < governor._take(lm, 600, INTERACTIVE) <= 12
+        # A failed take takes nothing
+        assert governor._take(lm, 400, INTERACTIVE) == 0
+
+    def test_calls_bigger_than_the_bucket_take_all_of_it(self):
+        governor = Governor()
+        lm = self.lm(tokens_per_minute=1000)
+        assert governor._take(lm, 5000, INTERACTIVE) == 0
+        assert governor._take(lm, 1, INTERACTIVE) > 0
+
+    def test_both_buckets_must_have_enough(self):
+        governor = Governor()
+        lm = self.lm(requests_per_minute=100, tokens_per_minute=1000)
+        assert governor._take(lm, 1000, INTERACTIVE) == 0
+        assert governor._take(lm, 100, INTERACTIVE) > 0
+        lm = self.lm(requests_per_minute=1, tokens_per_minute=10**6)
+        assert governor._take(lm, 1, INTERACTIVE) == 0
+        assert governor._take(lm, 1, INTERACTIVE) > 0
+
+    def test_background_calls_leave_the_reserve(self):
+        governor = Governor()
+        lm = self.lm(requests_per_minute=10)
+        taken = 0
+        while governor._take(lm, 1, BACKGROUND) == 0:
+            taken += 1
+        assert taken == round(10 * (1 - RESERVE))
+        # What's left is for interactive calls
+        for _ in range(round(10 * RESERVE)):
+            assert governor._take(lm, 1, INTERACTIVE) == 0
+        assert governor._take(lm, 1, INTERACTIVE) > 0
+
+    def test_back_off_blocks_every_process(self):
+        lm = self.lm(requests_per_minute=100)
+        asyncio.run(Governor().back_off(lm, 5))
+        # Another process's governor sees it too
+        assert 4 < Governor()._take(lm, 1, INTERACTIVE) <= 5
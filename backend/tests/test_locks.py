@@ -0,0 +1,108 @@
+import threading
+import time
+import uuid
+import pytest
+import redis
+from app import locks
+from app.locks import acquire_lock, release_lock, is_locked, held_lock_token
+
+try:
+    locks.r.ping()
+except redis.RedisError:
+    pytest.skip("needs Redis (at POOLER_CONNECTION_PARAMS)", allow_module_level=True)
+
+
+@pytest.fixture
+def name():
+    name = f"test_lock_{uuid.uuid4().hex}"
+    yield name
+    while release_lock(name):
+        pass
+    locks.r.delete(*locks._keys(name))
+
+
+# Runs f in another thread (so as a different holder) and returns what it returned
+def in_other_thread(f):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(f()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def test_acquire_and_release(name):
+    token = acquire_lock(name)
+    assert token is not None
+    assert is_locked(name)
+    assert held_lock_token(name) == token
+    assert release_lock(name)
+    assert not is_locked(name)
+    assert held_lock_token(name) is None
+    assert not release_lock(name)  # not held anymore
+
+
+def test_reentrant_for_the_same_holder(name):
+    token = acquire_lock(name)
+    assert acquire_lock(name) == token
+    assert release_lock(name)
+    assert is_locked(name)  # taken twice, released once
+    assert release_lock(name)
+    assert not is_locked(name)
+
+
+def test_other_holders_wait_until_released(name):
+    acquire_lock(name)
+    assert in_other_thread(lambda: acquire_lock(name, timeout=.2)) is None
+    release_lock(name)
+
+    # Now held by another thread, until it's told to let go
+    taken, let_go = threading.Event(), threading.Event()
+
+    def holder():
+        acquire_lock(name)
+        taken.set()
+        let_go.wait()
+        release_lock(name)
+
+    thread = threading.Thread(target=holder)
+    thread.start()
+    taken.wait()
+    assert acquire_lock(name, timeout=.2) is None
+    let_go.set()
+    thread.join()
+    assert acquire_lock(name, timeout=.2) is not None
+
+
+def test_fencing_tokens_go_up(name):
+    first = acquire_lock(name)
+    release_lock(name)
+    second = acquire_lock(name)
+    release_lock(name)
+    assert second > first
+
+
+def test_waiters_wake_on_release(name):
+    acquire_lock(name)
+    got = []
+
+    def waiter():
+        start = time.time()
+        got.append(acquire_lock(name, timeout=10))
+        got.append(time.time() - start)
+        release_lock(name)
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    time.sleep(.2)
+    release_lock(name)
+    thread.join()
+    assert got[0] is not None
+    assert got[1] < 2  # woken by the release, not by the lease running out or polling
+
+
+def test_a_holder_that_dies_only_holds_others_up_for_its_lease(name):
+    # Taken as if by another process that then died: nobody releases it or renews its lease
+    assert locks._ACQUIRE(keys=[locks._keys(name)[0], locks._keys(name)[2]], args=[300])
+    start = time.time()
+    assert acquire_lock(name, timeout=5) is not None
+    assert time.time() - start < 2
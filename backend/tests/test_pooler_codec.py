@@ -0,0 +1,72 @@
+import msgpack
+import pytest
+from datetime import datetime, date
+from decimal import Decimal
+from app.pooler_codec import encode_message, decode_message, CODECS, EXT_DATETIME, EXT_DATE, EXT_DECIMAL
+from app.utils import make_json_serializable
+
+
+# Like a page of SELECT * over assets / jobs: every type pymysql gives back
+ROWS = [
+    {
+        'id': i,
+        'title': f"Asset {i} – ünïcode",
+        'desc': None,
+        'score': i / 7,
+        'total_size': Decimal(i * 1000),  # SUM(...) of an INT column
+        'avg_rating': Decimal('4.25'),  # AVG(...)
+        'time_uploaded': datetime(2024, 5, 6, 7, 8, 9, 123456),
+        'day': date(2024, 5, 6),
+        'flags': (1, 2),
+        'metadata': {'nested': [Decimal('1.5'), datetime(2020, 1, 1)]},
+    }
+    for i in range(50)
+]
+
+
+@pytest.mark.parametrize('codec', list(CODECS))
+def test_round_trip_gives_the_normalized_values(codec):
+    data, name = decode_message(encode_message(ROWS, codec=codec))
+    assert name == codec
+    assert data == make_json_serializable(ROWS)
+
+
+def test_codecs_give_identical_values():
+    from_json, _ = decode_message(encode_message(ROWS, codec='json'))
+    from_msgpack, _ = decode_message(encode_message(ROWS, codec='msgpack'))
+    assert from_json == from_msgpack
+    # Same types too (1 == 1.0 == True would hide a difference)
+    for a, b in zip(from_json, from_msgpack):
+        assert {k: type(v) for k, v in a.items()} == {k: type(v) for k, v in b.items()}
+
+
+def test_normalized_types():
+    row, _ = decode_message(encode_message(ROWS[3], codec='msgpack'))
+    assert row['time_uploaded'] == "2024-05-06 07:08:09"
+    assert row['day'] == "2024-05-06"
+    assert row['total_size'] == 3000 and isinstance(row['total_size'], int)
+    assert row['avg_rating'] == 4.25 and isinstance(row['avg_rating'], float)
+    assert row['flags'] == [1, 2]
+
+
+def test_old_msgpack_extension_types_decode_to_the_same_values():
+    payload = CODECS['msgpack'].tag + msgpack.packb({
+        'time': msgpack.ExtType(EXT_DATETIME, b"2024-05-06 07:08:09"),
+        'day': msgpack.ExtType(EXT_DATE, b"2024-05-06"),
+        'sum': msgpack.ExtType(EXT_DECIMAL, b"12"),
+        'avg': msgpack.ExtType(EXT_DECIMAL, b"1.5"),
+    }, use_bin_type=True)
+    data, name = decode_message(payload)
+    assert name == 'msgpack'
+    assert data == {'time': "2024-05-06 07:08:09", 'day': "2024-05-06", 'sum': 12, 'avg': 1.5}
+    assert isinstance(data['sum'], int)
+
+
+def test_untagged_and_str_payloads_are_json():
+    assert decode_message('{"a": 1}') == ({'a': 1}, 'json')
+    assert decode_message(b'[1, 2]') == ([1, 2], 'json')
+
+
+def test_unknown_types_are_refused():
+    with pytest.raises(TypeError):
+        encode_message({'x': object()}, codec='msgpack')
@@ -0,0 +1,89 @@
+import pytest
+from app.query_metrics import QueryStats, fingerprint, is_write, OTHER_FINGERPRINT, FINGERPRINT_MAX_LENGTH
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ("SELECT * FROM assets WHERE id = %s", "SELECT * FROM assets WHERE id = ?"),
+    ("SELECT * FROM assets WHERE id = 42", "SELECT * FROM assets WHERE id = ?"),
+    ("SELECT * FROM assets WHERE score > 0.75", "SELECT * FROM assets WHERE score > ?"),
+    ("SELECT * FROM assets WHERE title = 'it''s' AND author = \"x\"", "SELECT * FROM assets WHERE title = ? AND author = ?"),
+    ("SELECT * FROM assets WHERE title = 'a\\'b'", "SELECT * FROM assets WHERE title = ?"),
+    ("SELECT * FROM assets WHERE id IN (1, 2, 3)", "SELECT * FROM assets WHERE id IN (?+)"),
+    ("SELECT * FROM assets WHERE id IN (%s,%s)", "SELECT * FROM assets WHERE id IN (?+)"),
+    ("SELECT * FROM assets WHERE id = %(id)s", "SELECT * FROM assets WHERE id = ?"),
+    ("SELECT *\n  FROM   assets -- trailing\n WHERE /* inline */ id = 1", "SELECT * FROM assets WHERE id = ?"),
+    ("SELECT * FROM table2 WHERE col_3 = 1", "SELECT * FROM table2 WHERE col_3 = ?"),
+])
+def test_fingerprint(sql, expected):
+    assert fingerprint(sql) == expected
+
+
+def test_statements_that_differ_only_in_literals_share_a_fingerprint():
+    a = fingerprint("SELECT * FROM asset_permissions WHERE asset_id IN (1, 2, 3) AND user_id = 9")
+    b = fingerprint("SELECT * FROM asset_permissions WHERE asset_id IN (4,5) AND user_id = 10")
+    assert a == b
+
+
+def test_fingerprint_is_truncated():
+    assert len(fingerprint("SELECT " + ", ".join(f"col{i}" for i in range(1000)))) == FINGERPRINT_MAX_LENGTH
+
+
+@pytest.mark.parametrize('sql', [
+    "SELECT * FROM assets",
+    "  select 1",
+    "WITH a AS (SELECT 1) SELECT * FROM a",
+    "(SELECT 1) UNION (SELECT 2)",
+    "SHOW TABLES",
+    "EXPLAIN SELECT 1",
+    "/* tagged */ SELECT 1",
+    "SELECT * FROM assets WHERE title = 'for update'",
+])
+def test_reads(sql):
+    assert not is_write('execute', [sql])
+
+
+@pytest.mark.parametrize('sql', [
+    "INSERT INTO assets (title) VALUES ('x')",
+    "UPDATE assets SET title = 'x'",
+    "DELETE FROM assets",
+    "REPLACE INTO asset_metadata VALUES (1)",
+    "CREATE TABLE x (id INT)",
+    "SET @x = 1",
+    "/* SELECT */ DELETE FROM assets",
+    "SELECT * FROM assets WHERE id = 1 FOR UPDATE",
+    "SELECT * FROM assets WHERE id = 1 for share",
+    "SELECT * FROM assets WHERE id = 1 LOCK IN SHARE MODE",
+])
+def test_writes(sql):
+    assert is_write('execute', [sql])
+    assert is_write('executemany', [sql, []])
+
+
+def test_only_executing_counts():
+    assert not is_write('fetchall', [])
+    assert not is_write('close', [])
+    assert is_write('execute', [])  # can't tell, so assume the worst
+
+
+def test_query_stats_adds_up_per_endpoint_and_fingerprint():
+    stats = QueryStats(slow_query_seconds=1)
+    stats.record('a', 'SELECT ?', execution=.5, lock_wait=.1)
+    stats.record('a', 'SELECT ?', execution=.25)
+    stats.record('a', 'SELECT ?', count=0, serialization=.05)
+    stats.record(None, 'SELECT ?', execution=2, sql="SELECT 1")
+    snapshot = stats.snapshot()
+    by_endpoint = {x['endpoint']: x for x in snapshot['statements']}
+    assert by_endpoint['a']['count'] == 2
+    assert by_endpoint['a']['execution'] == pytest.approx(.75)
+    assert by_endpoint['a']['max_execution'] == pytest.approx(.5)
+    assert by_endpoint['a']['serialization'] == pytest.approx(.05)
+    assert by_endpoint['none']['count'] == 1
+    assert [x['sql'] for x in snapshot['slow']] == ["SELECT 1"]
+
+
+def test_query_stats_caps_fingerprints():
+    stats = QueryStats(max_fingerprints=2)
+    for i in range(5):
+        stats.record('a', f"fp{i}", execution=.01)
+    fps = {x['fingerprint']: x['count'] for x in stats.snapshot()['statements']}
+    assert fps == {'fp0': 1, 'fp1': 1, OTHER_FINGERPRINT: 3}
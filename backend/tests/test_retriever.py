@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('app.retriever')
+from app.retriever import Chunk, Retriever, _dup_score, _top_k, _cosine_scores
+
+
+def test_top_k_is_best_first_with_ties_to_the_lower_index():
+    points = np.array([.1, .9, .5, .9, .3])
+    assert _top_k(points, 3).tolist() == [1, 3, 2]
+    assert _top_k(points, 10).tolist() == [1, 3, 2, 4, 0]
+    assert _top_k(points, 0).tolist() == []
+
+
+def test_cosine_scores_of_unnormalized_embeddings():
+    embeddings = np.array([[3., 4.], [0., 0.], [1., 0.]], dtype=np.float32)
+    assert np.allclose(_cosine_scores(embeddings, np.array([1., 0.], dtype=np.float32)), [.6, 0., 1.])
+
+
+def test_dup_score():
+    txt = "the quick brown fox jumps over the lazy dog and then runs off into the woods"
+    assert _dup_score(txt, txt) == 1
+    assert _dup_score(txt, "something else entirely, with no words in common at all here") == 0
+    assert _dup_score("", "") == 1
+
+
+# Enough of a Retriever for _diverse_top_k: chunks by (resource, position)
+class FakeRetriever():
+    _diverse_top_k = Retriever._diverse_top_k
+
+    def __init__(self, txts_by_resource) -> None:
+        self.resources = list(range(len(txts_by_resource)))
+        self.txts_by_resource = txts_by_resource
+        self.read = []
+
+    def _chunk_at(self, ret_index, pos):
+        self.read.append((int(ret_index), int(pos)))
+        return Chunk(int(pos), f"resource {ret_index}", self.txts_by_resource[ret_index][pos])
+
+
+ORIGINAL = "one two three four five six seven eight nine ten eleven twelve thirteen fourteen"
+NEAR_COPY = ORIGINAL + " fifteen"
+OTHER = "alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu nu xi"
+THIRD = "red orange yellow green blue indigo violet black white grey pink brown gold silver"
+
+
+def test_diverse_top_k_drops_text_duplicates():
+    ret = FakeRetriever([[ORIGINAL, NEAR_COPY, OTHER, THIRD]])
+    points = np.array([.9, .8, .7, .6])
+    chosen = ret._diverse_top_k(points, np.zeros(4, dtype=np.int64), np.arange(4), 3)
+    assert [x.txt for x in chosen] == [ORIGINAL, OTHER, THIRD]
+    # A higher cutoff lets the near copy through
+    chosen = ret._diverse_top_k(points, np.zeros(4, dtype=np.int64), np.arange(4), 3, dup_cutoff=.95)
+    assert [x.txt for x in chosen] == [ORIGINAL, NEAR_COPY, OTHER]
+
+
+def test_diverse_top_k_checks_additional_sources_too():
+    ret = FakeRetriever([[NEAR_COPY, OTHER]])
+    chosen = ret._diverse_top_k(np.array([.9, .5]), np.zeros(2, dtype=np.int64), np.arange(2), 2, chosen_txts=[ORIGINAL])
+    assert [x.txt for x in chosen] == [OTHER]
+
+
+def test_diverse_top_k_rewards_unrepresented_resources():
+    ret = FakeRetriever([[ORIGINAL, OTHER], [THIRD]])
+    points = np.array([.9, .8, .6])
+    ret_indices = np.array([0, 0, 1])
+    positions = np.array([0, 1, 0])
+    chosen = ret._diverse_top_k(points, ret_indices, positions, 2, diversity_reward=1.5)
+    assert [x.txt for x in chosen] == [ORIGINAL, THIRD]  # .6 * 1.5 beats .8
+    # Only what was looked at is read
+    assert sorted(ret.read) == [(0, 0), (1, 0)]
@@ -135,7 +135,8 @@ CREATE TABLE jobs (
     `asset_id` INT,
     `metadata` JSON,
     `kind` TEXT, 
-    `time_uploaded` DATETIME DEFAULT CURRENT_TIMESTAMP
+    `time_uploaded` DATETIME DEFAULT CURRENT_TIMESTAMP,
+    `time_last_update` DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP  /* a running job that hasn't been updated in a while has likely died */
 );
 
 
@@ -230,6 +231,32 @@ CREATE TABLE inter_asset_retrieval_storage (
 );
 
 
+DROP TABLE IF EXISTS merged_retrieval_storage;
+
+CREATE TABLE merged_retrieval_storage (
+    `id` INT PRIMARY KEY AUTO_INCREMENT,
+    `asset_id` INT,
+    `key` VARCHAR(64),
+    `from` TEXT,
+    `path` TEXT,
+    `metadata` JSON,
+    `time_uploaded` DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+
+DROP TABLE IF EXISTS embedding_cache;
+
+CREATE TABLE embedding_cache (
+    `embedding_fn_code` VARCHAR(255),
+    `text_hash` CHAR(64),  /* sha256 of the embedded text */
+    `embedding` MEDIUMTEXT,  /* base64 float32 */
+    `time_uploaded` DATETIME DEFAULT CURRENT_TIMESTAMP,
+    `time_last_used` DATETIME DEFAULT CURRENT_TIMESTAMP,  /* for pruning; see embedding_cache.py */
+    PRIMARY KEY (`embedding_fn_code`, `text_hash`),
+    INDEX (`time_last_used`)
+);
+
+
 DROP TABLE IF EXISTS media_data;
 
 CREATE TABLE media_data (
@@ -300,6 +327,9 @@ CREATE INDEX idx_timestamp ON notifications (`timestamp`);
 
 CREATE INDEX idx_group_id ON inter_asset_retrieval_storage (group_id);
 
+CREATE INDEX idx_asset_id ON merged_retrieval_storage (asset_id);
+CREATE INDEX idx_key ON merged_retrieval_storage (`key`);
+
 CREATE INDEX idx_product_id ON asset_groups (product_id);
 
 /* For natural language queries. */